@@ -0,0 +1,239 @@
+# ./benchmarks/bench_backfill.py
+# Backfill the bronze day partitions of hourly relevés written before the schema (strings only) with
+# shared/backfill.py, on process pools of several sizes, against the Data Lake stand-in of
+# benchmarks/stand_ins.py kept in a temporary directory shared by the processes.
+# Then interrupt a backfill with a corrupt file: the next run only runs the days left,
+# and running the whole range again rewrites the same daily files.
+# Then a cloud ETL backfill over extracts landed in the flat layout on chosen days and archived since,
+# with a day without extracts.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_backfill --days 28 --workers 1 4 8 --latency 20
+import argparse
+import datetime
+import io
+import logging
+import tempfile
+import time
+import warnings
+
+import pandas as pd
+
+from benchmarks import stand_ins
+from benchmarks.bench_process_relational_data import COLUMNS, GROUPBY_COLUMNS, make_extract
+from benchmarks.stand_ins import StandInBlob, make_ckan_records
+from shared.backfill import (
+    KIND_BRONZE,
+    KIND_CLOUDETL,
+    get_backfill_file_name,
+    get_checkpoint_location,
+    get_job_id,
+    run_backfill,
+)
+from shared.clients import (
+    get_blob_account_url,
+    get_blob_service_client,
+    get_datalake_account_url,
+    get_datalake_service_client,
+)
+from shared.cloudetl import LAYOUT_FLAT, archive_cooltier_blob_file, list_landed_blob_files
+from shared.compaction import DAILY_FILE_NAME
+from shared.datalake import get_partition_path
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.parquet import write_parquet
+
+DATASET_NAME = "Releve_horaire_urgences_7jours"
+ACCOUNT_NAME = "benchadls"
+CONTAINER_NAME = "bench"
+DIRECTORY_NAME = "bronze"
+CREDENTIAL = "credential"
+
+# Hourly relevés are ingested some minutes after their update
+INGEST_DELAY = pd.Timedelta(minutes=20)
+
+
+def get_file_system_client():
+    return get_datalake_service_client(
+        get_datalake_account_url(ACCOUNT_NAME), CREDENTIAL).get_file_system_client(CONTAINER_NAME)
+
+
+# Write a file per hourly relevé, with the string columns of the files written before the schema
+def write_hourly_files(days):
+    file_system_client = get_file_system_client()
+    df = pd.DataFrame(make_ckan_records(100 * 24 * days))
+
+    for updated, rows in df.groupby(DEFAULT_WATERMARK_COLUMN):
+        ingested = pd.Timestamp(updated) + INGEST_DELAY
+        buffer = write_parquet(rows, sort_columns=(DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN))
+        file_system_client.get_file_client(
+            f"{get_partition_path(DIRECTORY_NAME, DATASET_NAME, ingested)}/{ingested.strftime('%H:00:00')}.parquet"
+        ).upload_data(buffer.getvalue(), overwrite=True)
+
+    ingested = pd.to_datetime(df[DEFAULT_WATERMARK_COLUMN]) + INGEST_DELAY
+    return ingested.min().date(), ingested.max().date(), len(df)
+
+
+def get_job(start, end):
+    return {
+        "kind": KIND_BRONZE,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "datalake_account_name": ACCOUNT_NAME,
+        "datalake_container_name": CONTAINER_NAME,
+        "datalake_directory_name": DIRECTORY_NAME,
+        "dataset_name": DATASET_NAME,
+    }
+
+
+# Daily files of the range: their rows, and whether their update times are timestamps
+def read_daily_files(start, end):
+    file_system_client = get_file_system_client()
+    files = {}
+    for day in pd.date_range(start, end):
+        data = file_system_client.get_file_client(
+            f"{get_partition_path(DIRECTORY_NAME, DATASET_NAME, day)}/{DAILY_FILE_NAME}").download_file().readall()
+        files[day.date()] = data
+    frames = [pd.read_parquet(io.BytesIO(data)) for data in files.values()]
+    typed = all(pd.api.types.is_datetime64_any_dtype(frame[DEFAULT_WATERMARK_COLUMN]) for frame in frames)
+    return files, sum(map(len, frames)), typed
+
+
+# Land extracts at the root of the ingest container, created on the days given, and archive them
+# as the cloud ETL does: their archive copies are created now, with the landing time kept on them.
+# A blob archived before the landing time was kept, its copy created on undated_day, is added to the archive
+# container: it is dated by the creation time of its copy.
+def archive_flat_extracts(days, per_day, undated_day):
+    blob_service_client = get_blob_service_client(get_blob_account_url(ACCOUNT_NAME), CREDENTIAL)
+    container_client = blob_service_client.get_container_client("ingest")
+    for day in days:
+        created = datetime.datetime.combine(day, datetime.time(12), datetime.timezone.utc)
+        for index in range(per_day):
+            data = make_extract(1000, index).to_csv(index=False).encode()
+            container_client.blobs[f"extract_{day:%Y%m%d}_{index}.csv"] = StandInBlob(data, created)
+
+    outcomes = archive_cooltier_blob_file(
+        blob_service_client, get_blob_account_url(ACCOUNT_NAME) + "/", "ingest", "archive",
+        list_landed_blob_files(container_client, days[0]))
+    assert set(outcomes.values()) == {"archived"}, outcomes
+
+    created = datetime.datetime.combine(undated_day, datetime.time(12), datetime.timezone.utc)
+    blob_service_client.get_container_client("archive").blobs["extract_undated.csv"] = StandInBlob(
+        make_extract(1000).to_csv(index=False).encode(), created)
+
+
+def get_cloudetl_job(start, end):
+    return {
+        "kind": KIND_CLOUDETL,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "storage_account_url": get_blob_account_url(ACCOUNT_NAME),
+        "source_container": "archive",
+        "archived": True,
+        "layout": LAYOUT_FLAT,
+        "datalake_account_name": ACCOUNT_NAME,
+        "datalake_container_name": CONTAINER_NAME,
+        "dir_name": "silver",
+        "file_format": "parquet",
+        "file_prefix": "financial_demo",
+        "columns": COLUMNS,
+        "groupby_columns": GROUPBY_COLUMNS,
+    }
+
+
+def backfill(job, workers, directory, latency):
+    start = time.perf_counter()
+    result = run_backfill(
+        job, max_workers=workers, azure_credential=CREDENTIAL,
+        initializer=stand_ins.install, initargs=(latency, directory))
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=28, help="days of hourly relevés backfilled")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8], help="processes of the pool")
+    parser.add_argument("--latency", type=float, default=20.0, help="ms per stand-in request")
+    args = parser.parse_args()
+
+    # the failures of the interrupted backfill are expected
+    logging.disable(logging.ERROR)
+    warnings.simplefilter("ignore")
+    latency = args.latency / 1000
+
+    print(f"{args.days} days of hourly relevés cast to the schema and compacted")
+    print(f'{"workers":>7} {"days":>5} {"rows":>8} {"s":>8} {"days/s":>7}')
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            stand_ins.install(latency, directory)
+            start, end, rows = write_hourly_files(args.days)
+            job = get_job(start, end)
+
+            result, seconds = backfill(job, workers, directory, latency)
+            _, daily_rows, typed = read_daily_files(start, end)
+            assert not result["failed"] and daily_rows == rows and typed, (result, daily_rows, rows, typed)
+            print(f"{workers:>7} {len(result['completed']):>5} {daily_rows:>8} {seconds:>8.2f} "
+                  f"{len(result['completed']) / seconds:>7.1f}")
+
+    # resume: a corrupt file fails its day, the next run only runs that day
+    with tempfile.TemporaryDirectory() as directory:
+        stand_ins.install(0, directory)
+        start, end, rows = write_hourly_files(args.days)
+        job = get_job(start, end)
+
+        file_system_client = get_file_system_client()
+        broken_day = start + (end - start) / 2
+        broken_path = f"{get_partition_path(DIRECTORY_NAME, DATASET_NAME, broken_day)}/12:00:00.parquet"
+        data = file_system_client.get_file_client(broken_path).download_file().readall()
+        file_system_client.get_file_client(broken_path).upload_data(b"not parquet", overwrite=True)
+
+        result, _ = backfill(job, max(args.workers), directory, 0)
+        print(f"interrupted: {len(result['completed'])} completed, failed {result['failed']}")
+        assert result["failed"] == [broken_day.isoformat()]
+
+        file_system_client.get_file_client(broken_path).upload_data(data, overwrite=True)
+        result, _ = backfill(job, max(args.workers), directory, 0)
+        print(f"resumed: {result['skipped']} skipped, completed {result['completed']}")
+        assert result["completed"] == [broken_day.isoformat()] and result["skipped"] == len(
+            pd.date_range(start, end)) - 1
+
+        # the whole range again, without the checkpoint: every day rewrites its own daily file
+        files, daily_rows, _ = read_daily_files(start, end)
+        file_system_client.get_file_client(
+            f"{get_checkpoint_location(job)[2]}/{get_job_id(job)}.json").delete_file()
+        result, _ = backfill(job, max(args.workers), directory, 0)
+        rerun_files, rerun_rows, _ = read_daily_files(start, end)
+        assert rerun_rows == daily_rows == rows and rerun_files.keys() == files.keys()
+        print(f"rerun: {len(result['completed'])} days rewritten, {rerun_rows} rows, "
+              f"{sum(files[day] == rerun_files[day] for day in files)} daily files unchanged")
+
+    # cloud ETL, flat layout: the extracts of a day are those landed on it, a day without any is empty
+    with tempfile.TemporaryDirectory() as directory:
+        stand_ins.install(0, directory)
+        start = datetime.date(2014, 7, 1)
+        days = [start + datetime.timedelta(days=offset) for offset in range(4)]
+        archive_flat_extracts(days[:2] + days[3:], 3, days[1])
+        job = get_cloudetl_job(days[0], days[-1])
+
+        result, _ = backfill(job, max(args.workers), directory, 0)
+        print(f"cloudetl, flat layout: completed {result['completed']}, empty {result['empty']}, "
+              f"failed {result['failed']}")
+        assert not result["failed"] and result["empty"] == [days[2].isoformat()], result
+        assert result["completed"] == [day.isoformat() for day in days], result
+
+        file_system_client = get_file_system_client()
+        units_sold = {}
+        for day in days[:2] + days[3:]:
+            data = file_system_client.get_file_client(
+                f"silver/{get_backfill_file_name('financial_demo', day, 'parquet')}").download_file().readall()
+            units_sold[day] = pd.read_parquet(io.BytesIO(data))["total_units_sold"].sum()
+
+        # the blob archived without its landing time is aggregated with the extracts of the day of its copy
+        assert units_sold[days[0]] == units_sold[days[3]] < units_sold[days[1]], units_sold
+
+        # the empty day is checkpointed too, the next run has nothing left to run
+        result, _ = backfill(job, max(args.workers), directory, 0)
+        assert not result["completed"] and not result["failed"] and result["skipped"] == 4, result
+
+
+if __name__ == "__main__":
+    main()
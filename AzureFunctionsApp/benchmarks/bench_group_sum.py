@@ -0,0 +1,74 @@
+# ./benchmarks/bench_group_sum.py
+# Sum gross sales per group in chunks with the GroupSumAccumulator of the bounded-memory cloud ETL,
+# and in one groupby sum over the same rows, for inputs of many to a single group. Both must give the same sums.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_group_sum --rows 1000000 --chunksize 100000 --groups 400 4 1
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from shared.cloudetl import GroupSumAccumulator
+
+GROUPBY_COLUMNS = ['segment', 'sale_month']
+AGGREGATIONS = {'total_units_sold': 'units_sold', 'total_gross_sales': 'gross_sales'}
+
+
+def make_rows(rows, groups, seed=0):
+    rng = np.random.default_rng(seed)
+    group = rng.integers(0, groups, rows)
+    return pd.DataFrame({
+        'segment': (group // 12).astype(str),
+        'sale_month': group % 12 + 1,
+        'units_sold': rng.integers(200, 5000, rows),
+        'gross_sales': rng.integers(100, 1_500_000, rows) / 100,
+    })
+
+
+def accumulate(df, chunksize):
+    accumulator = GroupSumAccumulator(GROUPBY_COLUMNS, AGGREGATIONS)
+    for start in range(0, len(df), chunksize):
+        accumulator.add(df.iloc[start:start + chunksize])
+    return accumulator.result()
+
+
+def group_sum(df):
+    return df.groupby(GROUPBY_COLUMNS, as_index=False).agg(
+        **{name: (column, 'sum') for name, column in AGGREGATIONS.items()})
+
+
+def best_of(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    parser.add_argument('--groups', type=int, nargs='+', default=[400, 4, 1])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{args.rows} rows in chunks of {args.chunksize}')
+    print(f'{"groups":>7} {"chunks (s)":>11} {"groupby (s)":>12} {"ratio":>7}')
+
+    for groups in args.groups:
+        df = make_rows(args.rows, groups)
+        chunked, chunked_time = best_of(lambda: accumulate(df, args.chunksize), args.repeat)
+        expected, expected_time = best_of(lambda: group_sum(df), args.repeat)
+
+        pd.testing.assert_frame_equal(expected, chunked, check_exact=True)
+
+        print(f'{groups:>7} {chunked_time:>11.3f} {expected_time:>12.3f} '
+              f'{chunked_time / expected_time:>6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# ./benchmarks/bench_html_text.py
+# Compare the original article text extraction (BeautifulSoup with html.parser) and the lxml extractor
+# on the saved pages of benchmarks/fixtures, from the page bytes to the normalized text.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_html_text --repeat 20
+import argparse
+import html
+import json
+import os
+import re
+import time
+import warnings
+
+from bs4 import BeautifulSoup
+
+from shared import html_text
+from shared.transform import get_html_text, normalize_text, remove_html_tags
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+# Original implementation, kept as the reference output
+def remove_html_tags_legacy(html_text):
+    return html.escape(re.compile(r"<[^>]+>").sub("", str(html_text)))
+
+
+def get_html_text_legacy(page_html):
+    soup = BeautifulSoup(page_html, "html.parser")
+    text = soup.find_all("p", text=True)
+    return remove_html_tags_legacy(str(text))
+
+
+def normalize_text_legacy(text_string):
+    lower_string = text_string.lower()
+    no_number_string = re.sub(r"\d+", "", lower_string)
+    no_punc_string = re.sub(
+        r"(@\[A-Za-z0-9]+)|([^0-9A-Za-z \t])|(\w+:\/\/\S+)|^rt|http.+?",
+        "",
+        no_number_string,
+    )
+    no_wspace_string = no_punc_string.strip()
+    json_bytes = no_wspace_string.encode()
+    return json.dumps(json_bytes.decode("utf-8", errors="ignore"))
+
+
+# Page bytes to normalized text, as clean_documents does
+def clean_legacy(page_html):
+    return normalize_text_legacy(remove_html_tags_legacy(get_html_text_legacy(page_html)))
+
+
+def clean_with(extractor):
+    def clean(page_html):
+        return normalize_text(remove_html_tags(get_html_text(page_html, extractor)))
+    return clean
+
+
+def load_fixtures():
+    fixtures = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith(".html"):
+            with open(os.path.join(FIXTURES_DIR, name), "rb") as fixture_file:
+                fixtures[name] = fixture_file.read()
+    return fixtures
+
+
+# Best documents per second over repeat runs
+def docs_per_second(function, pages, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            function(page)
+        timings.append(time.perf_counter() - start)
+    return len(pages) / min(timings)
+
+
+# Whether the lxml extractor parsed the page itself or fell back to html.parser
+def uses_lxml(page_html):
+    markup = html_text.UnicodeDammit(page_html, is_html=True).unicode_markup
+    return bool(markup) and html_text.is_lxml_safe(markup)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    fixtures = load_fixtures()
+    candidates = {
+        "legacy": clean_legacy,
+        html_text.HTML_PARSER_EXTRACTOR: clean_with(html_text.HTML_PARSER_EXTRACTOR),
+        html_text.LXML_EXTRACTOR: clean_with(html_text.LXML_EXTRACTOR),
+    }
+
+    print(f'{"fixture":<28} {"KiB":>5} {"parser":>7} ' + " ".join(f"{name + ' docs/s':>18}" for name in candidates) + "  identical")
+
+    for name, page in fixtures.items():
+        expected = clean_legacy(page)
+        rates = [docs_per_second(function, [page], args.repeat) for function in candidates.values()]
+        identical = all(function(page) == expected for function in candidates.values())
+        parser_used = "lxml" if uses_lxml(page) else "html"
+        print(
+            f"{name:<28} {len(page) // 1024:>5} {parser_used:>7} "
+            + " ".join(f"{rate:>18.1f}" for rate in rates)
+            + f"  {'yes' if identical else 'NO'}"
+        )
+
+    pages = list(fixtures.values())
+    rates = [docs_per_second(function, pages, args.repeat) for function in candidates.values()]
+    print(f'{"all fixtures":<28} {sum(map(len, pages)) // 1024:>5} {"":>7} ' + " ".join(f"{rate:>18.1f}" for rate in rates))
+    print(f"speedup of {html_text.LXML_EXTRACTOR} over legacy: {rates[-1] / rates[0]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
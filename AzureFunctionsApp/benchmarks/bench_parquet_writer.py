@@ -0,0 +1,115 @@
+# ./benchmarks/bench_parquet_writer.py
+# Compare the original hourly write (DataFrame.to_parquet with gzip), the pipe-delimited csv of blob_storage
+# and the shared parquet writer (shared/parquet.py) with each codec, on CKAN records built from the fixtures:
+# encoded size, write time, full read time, and a read of one establishment with filters pushed down,
+# with the row groups the statistics let the reader skip.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_parquet_writer --rows 500000 --row-group-size 16384
+import argparse
+import io
+import statistics
+import time
+import warnings
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from benchmarks.stand_ins import make_ckan_records
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.parquet import write_parquet
+
+SORT_COLUMNS = (DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN)
+
+
+def write_legacy(df, row_group_size):
+    return df.to_parquet(compression="gzip")
+
+
+def write_csv(df, row_group_size):
+    return df.to_csv(index=False, sep="|").encode()
+
+
+def get_writer(compression):
+    def write(df, row_group_size):
+        return write_parquet(
+            df, sort_columns=SORT_COLUMNS, compression=compression, row_group_size=row_group_size).getvalue()
+    return write
+
+
+WRITERS = {
+    "legacy to_parquet gzip": write_legacy,
+    "csv, sep |": write_csv,
+    "shared zstd, sorted": get_writer("zstd"),
+    "shared snappy, sorted": get_writer("snappy"),
+    "shared gzip, sorted": get_writer("gzip"),
+}
+
+
+def median_seconds(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def read_full(name, data):
+    if name.startswith("csv"):
+        return pd.read_csv(io.BytesIO(data), sep="|", dtype={DEFAULT_ESTABLISHMENT_COLUMN: str})
+    return pq.read_table(pa.BufferReader(data)).to_pandas()
+
+
+def read_establishment(name, data, establishment):
+    if name.startswith("csv"):
+        df = read_full(name, data)
+        return df[df[DEFAULT_ESTABLISHMENT_COLUMN] == establishment]
+    return pq.read_table(
+        pa.BufferReader(data), filters=[(DEFAULT_ESTABLISHMENT_COLUMN, "==", establishment)]).to_pandas()
+
+
+# Row groups whose statistics may hold the establishment, out of all of them
+def count_row_groups(name, data, establishment):
+    if name.startswith("csv"):
+        return "-"
+
+    metadata = pq.ParquetFile(pa.BufferReader(data)).metadata
+    index = metadata.schema.to_arrow_schema().get_field_index(DEFAULT_ESTABLISHMENT_COLUMN)
+    read = 0
+    for row_group in range(metadata.num_row_groups):
+        column_statistics = metadata.row_group(row_group).column(index).statistics
+        if column_statistics is None or not column_statistics.has_min_max or (
+                column_statistics.min <= establishment <= column_statistics.max):
+            read += 1
+    return f"{read}/{metadata.num_row_groups}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--row-group-size", type=int, default=None,
+                        help="rows per row group of the shared writer, PARQUET_ROW_GROUP_SIZE by default")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    df = pd.DataFrame(make_ckan_records(args.rows))
+    establishment = df[DEFAULT_ESTABLISHMENT_COLUMN].iloc[len(df) // 2]
+
+    print(f"{args.rows} rows, filter {DEFAULT_ESTABLISHMENT_COLUMN} == {establishment!r}")
+    print(f'{"writer":<24} {"MiB":>7} {"write ms":>9} {"read ms":>8} {"filtered ms":>12} {"row groups":>11}')
+
+    for name, writer in WRITERS.items():
+        write_time, data = median_seconds(lambda: writer(df, args.row_group_size), args.repeat)
+        read_time, _ = median_seconds(lambda: read_full(name, data), args.repeat)
+        filtered_time, filtered = median_seconds(lambda: read_establishment(name, data, establishment), args.repeat)
+
+        print(f"{name:<24} {len(data) / 2 ** 20:>7.2f} {write_time * 1000:>9.1f} {read_time * 1000:>8.1f} "
+              f"{filtered_time * 1000:>12.1f} {count_row_groups(name, data, establishment):>11}"
+              f"   {len(filtered)} rows")
+
+
+if __name__ == "__main__":
+    main()
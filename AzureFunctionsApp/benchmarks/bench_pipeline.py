@@ -0,0 +1,208 @@
+# ./benchmarks/bench_pipeline.py
+# Run the pipelines end to end, offline, against the stand-ins of benchmarks/stand_ins.py:
+#   ingest  ingest_from_api, CKAN pages to a bronze parquet file and its state
+#   etl     return_blob_files and run_cloud_etl, csv extracts to an aggregated parquet file, then archived
+#   clean   clean_documents, article pages downloaded, extracted and normalized (without the article cache)
+# Every stage runs in its own process so that its peak RSS is its own.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_pipeline --scale 4 --repeat 10
+#   python -m benchmarks.bench_pipeline --stages etl --chunksize 50000 --latency 5
+import argparse
+import datetime
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+
+STAGES = ["ingest", "etl", "clean"]
+
+# Work of one invocation at scale 1
+INGEST_ROWS = 50_000
+ETL_BLOBS = 20
+ETL_ROWS_PER_BLOB = 10_000
+CLEAN_DOCUMENTS = 200
+
+ETL_COLUMNS = ["segment", "country", "units_sold", "gross_sales", "date"]
+ETL_GROUPBY_COLUMNS = ["segment", "country", "sale_year", "sale_month"]
+
+# Names of the stand-in accounts, containers and directories
+BENCH_ENVIRONMENT = {
+    "ADLS_RESOURCE_NAME": "benchadls",
+    "ADLS_CONTAINER_NAME": "bench",
+    "ADLS_DIRECTORY_NAME_BRONZE": "bronze",
+    "ADLS_DIRECTORY_NAME": "silver",
+    "ABS_RESOURCE_NAME": "benchabs",
+    "ABS_CONTAINER_NAME_INGEST": "ingest",
+    "ABS_CONTAINER_NAME_ARCHIVE": "archive",
+    "ARTICLE_CACHE_DIR": "",
+}
+
+
+def get_peak_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Each setup returns the number of items of an invocation, and the invocation itself
+def setup_ingest(scale, args, store, server_url):
+    from shared.ingest import ingest_from_api
+
+    url = f"{server_url}/api/3/action/datastore_search?resource_id=bench"
+    runs = iter(range(sys.maxsize))
+
+    # a new dataset name per run, so that the state of the previous run does not skip the download,
+    # cast with the schema of the hourly relevés as the registry resources are
+    def invoke():
+        resource = {"schema": "Releve_horaire_urgences_7jours"}
+        assert ingest_from_api(url, f"bench_{next(runs)}", resource) == "uploaded"
+
+    return int(INGEST_ROWS * scale), invoke
+
+
+def setup_etl(scale, args, store, server_url):
+    from benchmarks.bench_process_relational_data import make_extract
+    from shared.cloudetl import LAYOUT_DATE_PREFIX, get_landing_blob_name, return_blob_files, run_cloud_etl
+    from shared.clients import get_blob_account_url, get_blob_service_client, get_datalake_account_url, get_datalake_service_client
+
+    env = os.environ
+    blobs = max(1, int(ETL_BLOBS * scale))
+    extract = make_extract(ETL_ROWS_PER_BLOB).to_csv(index=False).encode()
+
+    storage_account_url = get_blob_account_url(env["ABS_RESOURCE_NAME"]) + "/"
+    service_client = get_blob_service_client(storage_account_url, "credential")
+    container_client = service_client.get_container_client(env["ABS_CONTAINER_NAME_INGEST"])
+    datalake_service_client = get_datalake_service_client(get_datalake_account_url(env["ADLS_RESOURCE_NAME"]), "credential")
+    today = datetime.datetime.utcnow().date()
+
+    # the landed extracts are archived by every run, they land again before the next one
+    def land():
+        for index in range(blobs):
+            container_client.upload_blob(get_landing_blob_name(f"extract_{index}.csv", today), extract, overwrite=True)
+
+    def invoke():
+        blob_file_list = return_blob_files(container_client, today.isoformat(), "%Y-%m-%d", layout=LAYOUT_DATE_PREFIX)
+        outcomes = run_cloud_etl(
+            service_client=service_client,
+            storage_account_url=storage_account_url,
+            source_container=env["ABS_CONTAINER_NAME_INGEST"],
+            archive_container=env["ABS_CONTAINER_NAME_ARCHIVE"],
+            source_container_client=container_client,
+            blob_file_list=blob_file_list,
+            columns=ETL_COLUMNS,
+            groupby_columns=ETL_GROUPBY_COLUMNS,
+            datalake_service_client=datalake_service_client,
+            filesystem_name=env["ADLS_CONTAINER_NAME"],
+            dir_name=env["ADLS_DIRECTORY_NAME"],
+            file_format="parquet",
+            file_prefix="bench",
+            chunksize=args.chunksize,
+        )
+        assert len(outcomes) == blobs and set(outcomes.values()) == {"archived"}
+
+    return blobs * ETL_ROWS_PER_BLOB, invoke, land
+
+
+def setup_clean(scale, args, store, server_url):
+    from shared.transform import clean_documents
+
+    documents = max(1, int(CLEAN_DOCUMENTS * scale))
+
+    def invoke():
+        items = [
+            {"url": f"{server_url}/articles/{index}.html", "name": f"<b>Article {index}</b>", "description": "Urgences"}
+            for index in range(documents)
+        ]
+        results = clean_documents(items)
+        assert not any("fetch_error" in item for item in results)
+
+    return documents, invoke
+
+
+SETUPS = {"ingest": setup_ingest, "etl": setup_etl, "clean": setup_clean}
+
+
+# Child process: run the invocations of one stage, print their timings as JSON
+def run_stage(stage, args):
+    from benchmarks import stand_ins
+
+    os.environ.update(BENCH_ENVIRONMENT)
+    logging.disable(logging.WARNING)
+    warnings.simplefilter("ignore")
+
+    store = stand_ins.install(latency=args.latency / 1000)
+    records = stand_ins.make_ckan_records(int(INGEST_ROWS * args.scale)) if stage == "ingest" else ()
+    server = stand_ins.start_http_server(store, records)
+
+    setup = SETUPS[stage](args.scale, args, store, stand_ins.get_server_url(server))
+    items, invoke = setup[:2]
+    prepare = setup[2] if len(setup) > 2 else None
+    setup_rss = get_peak_rss_mib()
+
+    timings = []
+    calls = []
+    for _ in range(args.warmup + args.repeat):
+        if prepare:
+            prepare()
+        calls_before = store.calls
+        start = time.perf_counter()
+        invoke()
+        timings.append(time.perf_counter() - start)
+        calls.append(store.calls - calls_before)
+
+    server.shutdown()
+    print(json.dumps({
+        "stage": stage,
+        "items": items,
+        "timings": timings[args.warmup:],
+        "calls": calls[-1],
+        "setup_rss_mib": setup_rss,
+        "peak_rss_mib": get_peak_rss_mib(),
+    }))
+
+
+def get_percentiles(timings):
+    if len(timings) == 1:
+        return timings * 3
+    cuts = statistics.quantiles(timings, n=100, method="inclusive")
+    return [cuts[49], cuts[94], cuts[98]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the rows, blobs and documents of an invocation")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds added to every stand-in storage and HTTP call")
+    parser.add_argument("--chunksize", type=int, default=None, help="run_cloud_etl in bounded-memory mode")
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args.run_stage, args)
+        return
+
+    print(f'{"stage":<7} {"items":>9} {"calls":>6} {"items/s":>10} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"setup MiB":>10} {"peak MiB":>9}')
+
+    for stage in args.stages:
+        command = [sys.executable, "-m", "benchmarks.bench_pipeline", "--run-stage", stage] + [
+            argument for argument in sys.argv[1:] if argument != "--stages" and argument not in STAGES
+        ]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+
+        p50, p95, p99 = get_percentiles(result["timings"])
+        print(
+            f'{stage:<7} {result["items"]:>9} {result["calls"]:>6} {result["items"] / p50:>10.0f} '
+            f"{p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {p99 * 1000:>9.1f} "
+            f'{result["setup_rss_mib"]:>10.0f} {result["peak_rss_mib"]:>9.0f}'
+        )
+
+
+if __name__ == "__main__":
+    main()
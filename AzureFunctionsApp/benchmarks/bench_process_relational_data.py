@@ -0,0 +1,117 @@
+# ./benchmarks/bench_process_relational_data.py
+# Compare the original and the vectorized process_relational_data on synthetic extracts.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_process_relational_data --rows 2000000 --repeat 3
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from shared.cloudetl import process_relational_data
+
+COLUMNS = ['segment', 'country', 'units_sold', 'gross_sales', 'date']
+GROUPBY_COLUMNS = ['segment', 'country', 'sale_year', 'sale_month']
+
+SEGMENTS = [' Government ', ' Midmarket ', ' Channel Partners ', ' Enterprise ', ' Small Business ']
+COUNTRIES = [' Canada ', ' Germany ', ' France ', ' Mexico ', ' United States of America ']
+PRODUCTS = [' Carretera ', ' Montana ', ' Paseo ', ' Velo ', ' VTT ', ' Amarilla ']
+
+
+# Original implementation, kept as the reference output
+def process_relational_data_legacy(df, columns, groupby_columns):
+    processed_df = df.rename(columns=lambda x: x.strip())
+
+    processed_df.columns = processed_df.columns.str.strip()
+    processed_df.columns = processed_df.columns.str.lower()
+    processed_df.columns = processed_df.columns.str.replace(' ', '_')
+    processed_df.columns = processed_df.columns.str.replace('(', '')
+    processed_df.columns = processed_df.columns.str.replace(')', '')
+
+    processed_df = processed_df.loc[:, columns]
+
+    processed_df.dropna(inplace=True)
+
+    df_obj_cols = processed_df.select_dtypes(['object'])
+    processed_df[df_obj_cols.columns] = df_obj_cols.apply(
+        lambda x: x.str.strip())
+
+    processed_df['date'] = pd.to_datetime(
+        processed_df['date'], errors='coerce')
+
+    processed_df['gross_sales'] = processed_df['gross_sales'].replace(
+        {r'\$': '', ',': ''}, regex=True).astype(float)
+
+    processed_df['sale_year'] = pd.DatetimeIndex(processed_df['date']).year
+    processed_df['sale_month'] = pd.DatetimeIndex(processed_df['date']).month
+
+    # the original passed the builtin sum, which pandas < 3 ran as the groupby sum, pandas 3 calls it as is
+    processed_df = processed_df.sort_values(by=['sale_year', 'sale_month']).groupby(
+        groupby_columns, as_index=False).agg(total_units_sold=('units_sold', 'sum'), total_gross_sales=('gross_sales', 'sum'))
+
+    return processed_df
+
+
+# Build an extract shaped like the financial sample csv files, as read by read_csv
+def make_extract(rows, seed=0):
+    rng = np.random.default_rng(seed)
+
+    dates = pd.date_range('2013-09-01', '2014-12-01', freq='MS').strftime('%m/%d/%Y').to_numpy()
+    units_sold = rng.integers(200, 5000, rows) + rng.choice([0.0, 0.5], rows)
+    gross_sales = rng.integers(100, 1_500_000, rows) / 100
+
+    df = pd.DataFrame({
+        ' Segment ': rng.choice(SEGMENTS, rows),
+        'Country': rng.choice(COUNTRIES, rows),
+        ' Product ': rng.choice(PRODUCTS, rows),
+        ' Units Sold ': units_sold,
+        ' Gross Sales ': [f' ${value:,.2f} ' for value in gross_sales],
+        'Date': rng.choice(dates, rows),
+        ' Month Name ': ' January ',
+    })
+
+    # a few empty rows, as found in the extracts
+    df.loc[rng.choice(rows, max(1, rows // 1000), replace=False), ' Units Sold '] = np.nan
+
+    return df
+
+
+def time_call(function, df, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(df, COLUMNS, GROUPBY_COLUMNS)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000, 1_000_000, 3_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"rows":>10} {"legacy (s)":>12} {"vectorized (s)":>15} {"speedup":>8}  identical')
+
+    for rows in args.rows:
+        df = make_extract(rows)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            legacy_df, legacy_time = time_call(process_relational_data_legacy, df, args.repeat)
+
+        new_df, new_time = time_call(process_relational_data, df, args.repeat)
+
+        try:
+            pd.testing.assert_frame_equal(legacy_df, new_df, check_exact=True)
+            identical = 'yes'
+        except AssertionError as e:
+            identical = f'NO: {e}'
+
+        print(f'{rows:>10} {legacy_time:>12.3f} {new_time:>15.3f} {legacy_time / new_time:>7.1f}x  {identical}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# ./benchmarks/bench_reader.py
+# Answer a single-establishment question over the bronze partitions of the Data Lake stand-in
+# (benchmarks/stand_ins.py): by downloading the whole days of the time range, as the analysis jobs did,
+# then with shared/reader.py, which only opens the files of the time range, reads the row groups that
+# may hold the establishment and the columns asked for, concurrently.
+# Then relevés of days before are ingested late, into the newest partition, and read back from their update time.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_reader --days 14 --hours 6 --latency 5
+#   python -m benchmarks.bench_reader --days 14 --hours 6 --compact
+import argparse
+import datetime
+import io
+import logging
+import time
+import warnings
+
+import pandas as pd
+
+from benchmarks import stand_ins
+from benchmarks.stand_ins import make_ckan_records
+from shared import compaction, metrics
+from shared.clients import get_datalake_account_url, get_datalake_service_client
+from shared.datalake import get_partition_path
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.parquet import write_parquet
+from shared.reader import DataLakeSource, RANGED_READ_MIN_SIZE, read_dataset
+from shared.schema import apply_schema, get_schema
+from shared.watermark_index import get_watermark_range, record_watermarks
+
+DATASET_NAME = "Releve_horaire_urgences_7jours"
+ACCOUNT_NAME = "benchadls"
+CONTAINER_NAME = "bench"
+DIRECTORY_NAME = "bronze"
+COLUMNS = [DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN, "Nombre_de_civieres_occupees"]
+
+# Hourly relevés are ingested some minutes after their update
+INGEST_DELAY = pd.Timedelta(minutes=20)
+
+
+# Write the file of rows ingested at a time, and record their update times, as ingest_from_api does
+def write_file(file_system_client, rows, ingested):
+    buffer = write_parquet(
+        rows, sort_columns=(DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN),
+        column_encoding=get_schema(DATASET_NAME)["column_encoding"])
+    file_name = f"{ingested.strftime('%H:00:00')}.parquet"
+    file_system_client.get_file_client(
+        f"{get_partition_path(DIRECTORY_NAME, DATASET_NAME, ingested)}/{file_name}").upload_data(
+        buffer.getvalue(), overwrite=True)
+    record_watermarks(
+        file_system_client, DIRECTORY_NAME, DATASET_NAME, DEFAULT_WATERMARK_COLUMN, ingested.date(),
+        {file_name: get_watermark_range(rows, DEFAULT_WATERMARK_COLUMN)})
+
+
+# Write a file per hourly relevé, and return the days written
+def write_hourly_files(file_system_client, days):
+    schema = get_schema(DATASET_NAME)
+    df = apply_schema(pd.DataFrame(make_ckan_records(100 * 24 * days)), schema, DATASET_NAME)
+
+    for updated, rows in df.groupby(DEFAULT_WATERMARK_COLUMN, observed=True):
+        write_file(file_system_client, rows, updated + INGEST_DELAY)
+
+    return sorted({(updated + INGEST_DELAY).date() for updated in df[DEFAULT_WATERMARK_COLUMN].unique()}), df
+
+
+# Download every file of the days of the time range, then filter, as the analysis jobs did
+def read_whole_days(file_system_client, start, end, establishment):
+    frames = []
+    day = start.date()
+    while day <= end.date():
+        directory = get_partition_path(DIRECTORY_NAME, DATASET_NAME, day)
+        for path in file_system_client.get_paths(path=directory, recursive=False):
+            data = file_system_client.get_file_client(path.name).download_file().readall()
+            metrics.record("download", http_calls=1, bytes_read=len(data))
+            frames.append(pd.read_parquet(io.BytesIO(data)))
+        metrics.record("list", http_calls=1)
+        day += datetime.timedelta(days=1)
+
+    df = pd.concat(frames, ignore_index=True)
+    updated = pd.to_datetime(df[DEFAULT_WATERMARK_COLUMN])
+    return df[(df[DEFAULT_ESTABLISHMENT_COLUMN].astype(str) == establishment)
+              & (updated >= start) & (updated < end)][COLUMNS]
+
+
+def measure(label, function):
+    with metrics.invocation(label) as invocation:
+        start = time.perf_counter()
+        df = function()
+        seconds = time.perf_counter() - start
+
+    stages = invocation.summary()["stages"]
+    http_calls = sum(stage["http_calls"] for stage in stages.values())
+    bytes_read = sum(stage["bytes_read"] for stage in stages.values())
+    print(f"{label:<16} {len(df):>6} {http_calls:>7} {bytes_read / 2 ** 10:>9.1f} {seconds * 1000:>9.1f}")
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=14, help="days of hourly relevés written")
+    parser.add_argument("--hours", type=int, default=6, help="length of the time range read")
+    parser.add_argument("--latency", type=float, default=5.0, help="ms per stand-in request")
+    parser.add_argument("--compact", action="store_true", help="compact the days into daily files first")
+    parser.add_argument("--row-group-size", type=int, default=compaction.DAILY_ROW_GROUP_SIZE,
+                        help="rows per row group of the daily files")
+    parser.add_argument("--ranged-read-min-size", type=int, default=RANGED_READ_MIN_SIZE)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    warnings.simplefilter("ignore")
+    stand_ins.install(latency=0)
+
+    file_system_client = get_datalake_service_client(
+        get_datalake_account_url(ACCOUNT_NAME), "credential").get_file_system_client(CONTAINER_NAME)
+    days, df = write_hourly_files(file_system_client, args.days)
+
+    if args.compact:
+        compaction.DAILY_ROW_GROUP_SIZE = args.row_group_size
+        for day in days:
+            compaction.compact_day(
+                "credential", ACCOUNT_NAME, CONTAINER_NAME, DIRECTORY_NAME, DATASET_NAME, day,
+                schema=get_schema(DATASET_NAME), watermark_column=DEFAULT_WATERMARK_COLUMN)
+
+    # the middle of the written relevés, for the middle establishment of the sample
+    start = (df[DEFAULT_WATERMARK_COLUMN].min() + (df[DEFAULT_WATERMARK_COLUMN].max()
+             - df[DEFAULT_WATERMARK_COLUMN].min()) / 2).floor("h").to_pydatetime()
+    end = start + datetime.timedelta(hours=args.hours)
+    establishment = str(df[DEFAULT_ESTABLISHMENT_COLUMN].iloc[50])
+
+    stand_ins.StandInDataLakeServiceClient.store.latency = args.latency / 1000
+    source = DataLakeSource(file_system_client, ranged_read_min_size=args.ranged_read_min_size)
+
+    print(f"{establishment} from {start} to {end}, {args.days} days {'compacted' if args.compact else 'hourly'}")
+    print(f'{"read":<16} {"rows":>6} {"calls":>7} {"KiB read":>9} {"ms":>9}')
+    expected = measure("whole days", lambda: read_whole_days(file_system_client, start, end, establishment))
+    result = measure("reader", lambda: read_dataset(
+        source, DIRECTORY_NAME, DATASET_NAME, start, end, columns=COLUMNS,
+        filters=[(DEFAULT_ESTABLISHMENT_COLUMN, "==", establishment)]))
+
+    assert len(expected) == len(result), (len(expected), len(result))
+    assert (pd.to_datetime(expected[DEFAULT_WATERMARK_COLUMN]).sort_values().to_numpy()
+            == result[DEFAULT_WATERMARK_COLUMN].sort_values().to_numpy()).all()
+
+    # a run catching up after an outage writes relevés of days before into the newest partition
+    first = df[DEFAULT_WATERMARK_COLUMN].min()
+    late = df[df[DEFAULT_WATERMARK_COLUMN] == first].copy()
+    late[DEFAULT_WATERMARK_COLUMN] = first - pd.Timedelta(days=3)
+    write_file(file_system_client, late, df[DEFAULT_WATERMARK_COLUMN].max() + INGEST_DELAY + pd.Timedelta(hours=1))
+
+    start = late[DEFAULT_WATERMARK_COLUMN].iloc[0].to_pydatetime()
+    result = measure("reader, late", lambda: read_dataset(
+        source, DIRECTORY_NAME, DATASET_NAME, start, start + datetime.timedelta(hours=1), columns=COLUMNS))
+    assert len(result) == len(late), (len(result), len(late))
+
+
+if __name__ == "__main__":
+    main()
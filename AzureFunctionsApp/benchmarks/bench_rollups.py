@@ -0,0 +1,197 @@
+# ./benchmarks/bench_rollups.py
+# Keep the daily and weekly rollups of shared/rollups.py up to date over the bronze partitions of the
+# Data Lake stand-in (benchmarks/stand_ins.py), one hourly relevé at a time as the ingestion does,
+# and compare a dashboard query over the whole history: reading the rollups, then re-aggregating the relevés.
+# The last hour is merged by two runs at once, half of the establishments each, as two workers may.
+# The rollups kept incrementally are checked against rollups computed at once from every relevé.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_rollups --days 14 56 --hours 12 --latency 5
+import argparse
+import datetime
+import logging
+import statistics
+import threading
+import time
+import warnings
+import zlib
+
+import pandas as pd
+
+from benchmarks import stand_ins
+from benchmarks.stand_ins import make_ckan_records
+from shared import rollups
+from shared.clients import get_datalake_account_url, get_datalake_service_client
+from shared.datalake import get_partition_path
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.parquet import write_parquet
+from shared.reader import DataLakeSource, read_dataset
+from shared.schema import apply_schema, get_schema
+from shared.watermark_index import get_watermark_range, record_watermarks
+
+DATASET_NAME = "Releve_horaire_urgences_7jours"
+ACCOUNT_NAME = "benchadls"
+CREDENTIAL = "credential"
+BRONZE_DIRECTORY_NAME = "bronze"
+GOLD_DIRECTORY_NAME = "gold"
+
+# Hourly relevés are ingested some minutes after their update
+INGEST_DELAY = pd.Timedelta(minutes=20)
+
+
+# Hourly relevés of the sample, with a region per health establishment
+def make_releves(hours):
+    df = pd.DataFrame(make_ckan_records(100 * hours))
+    df["Region"] = ["%02d" % (zlib.crc32(name.encode()) % 17 + 1) for name in df["Nom_etablissement"]]
+    return apply_schema(df, get_schema(DATASET_NAME), DATASET_NAME)
+
+
+# Write the bronze file of an hourly relevé and record its update times, as ingest_from_api does,
+# and return its ingestion time
+def ingest(file_system_client, rows):
+    ingested = rows[DEFAULT_WATERMARK_COLUMN].iloc[0] + INGEST_DELAY
+    buffer = write_parquet(
+        rows, sort_columns=(DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN),
+        column_encoding=get_schema(DATASET_NAME)["column_encoding"])
+    file_name = f"{ingested.strftime('%H:00:00')}.parquet"
+    file_system_client.get_file_client(
+        f"{get_partition_path(BRONZE_DIRECTORY_NAME, DATASET_NAME, ingested)}/{file_name}"
+    ).upload_data(buffer.getvalue(), overwrite=True)
+    record_watermarks(
+        file_system_client, BRONZE_DIRECTORY_NAME, DATASET_NAME, DEFAULT_WATERMARK_COLUMN, ingested.date(),
+        {file_name: get_watermark_range(rows, DEFAULT_WATERMARK_COLUMN)})
+    return ingested.to_pydatetime()
+
+
+def update(clock):
+    # the partitions are those of the relevés, not of the time of the run
+    rollups.get_partition_now = lambda: clock
+    return rollups.update_rollups(
+        CREDENTIAL, ACCOUNT_NAME, "bench", BRONZE_DIRECTORY_NAME, GOLD_DIRECTORY_NAME, DATASET_NAME)
+
+
+# Daily occupancy per establishment over the whole history, from the rollups
+def query_rollups(source, start, end):
+    df = rollups.read_rollups(source, GOLD_DIRECTORY_NAME, DATASET_NAME, "daily", "establishment", start, end)
+    return df[[rollups.PERIOD_COLUMN, DEFAULT_ESTABLISHMENT_COLUMN, "occupied_stretchers_mean",
+               "occupied_stretchers_max", "occupancy_rate"]]
+
+
+# The same, re-aggregated from every relevé
+def query_releves(source, start, end):
+    df = read_dataset(source, BRONZE_DIRECTORY_NAME, DATASET_NAME, start, end)
+    df["day"] = df[DEFAULT_WATERMARK_COLUMN].dt.normalize()
+    grouped = df.groupby(["day", DEFAULT_ESTABLISHMENT_COLUMN], observed=True)
+    return pd.DataFrame({
+        "occupied_stretchers_mean": grouped["Nombre_de_civieres_occupees"].mean(),
+        "occupied_stretchers_max": grouped["Nombre_de_civieres_occupees"].max(),
+        "occupancy_rate": grouped["Nombre_de_civieres_occupees"].sum()
+        / grouped["Nombre_de_civieres_fonctionnelles"].sum(),
+    }).reset_index()
+
+
+# Merge relevés into every rollup file, as update_rollups does, from two threads at once
+def merge_concurrently(file_system_client, frames):
+    def merge(df):
+        for period in rollups.PERIODS:
+            for level in rollups.LEVELS:
+                rollups.merge_into_rollups(
+                    file_system_client, "bench",
+                    rollups.get_rollup_directory(GOLD_DIRECTORY_NAME, DATASET_NAME, period, level),
+                    df, period, level)
+
+    threads = [threading.Thread(target=merge, args=(df,)) for df in frames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every rollup file holds the relevés of both runs
+    latest = pd.concat(frames).groupby(DEFAULT_ESTABLISHMENT_COLUMN, observed=True)[DEFAULT_WATERMARK_COLUMN].max()
+    for period in rollups.PERIODS:
+        for level in rollups.LEVELS:
+            directory = rollups.get_rollup_directory(GOLD_DIRECTORY_NAME, DATASET_NAME, period, level)
+            year = rollups.get_period_start(latest, period).max().year
+            _, watermarks, _ = rollups.read_rollup_file(
+                file_system_client, f"{directory}/{rollups.get_rollup_file_name(year)}")
+            lost = [establishment for establishment, watermark in latest.items()
+                    if pd.Timestamp(watermarks.get(str(establishment))) != watermark]
+            assert not lost, (directory, len(lost))
+
+
+def median_ms(function, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, result
+
+
+def run(days, hours, latency):
+    store = stand_ins.install(latency=0)
+    file_system_client = get_datalake_service_client(
+        get_datalake_account_url(ACCOUNT_NAME), CREDENTIAL).get_file_system_client("bench")
+    source = DataLakeSource(file_system_client)
+
+    releves = make_releves(24 * days + hours)
+    by_hour = [rows for _, rows in releves.groupby(DEFAULT_WATERMARK_COLUMN, observed=True)]
+
+    # the history, rolled up at once
+    for rows in by_hour[:-hours]:
+        clock = ingest(file_system_client, rows)
+    rollups.INITIAL_LOOKBACK = datetime.timedelta(days=days + 1)
+    update(clock)
+
+    # then one hour at a time
+    store.latency = latency / 1000
+    timings = []
+    for rows in by_hour[-hours:-1]:
+        clock = ingest(file_system_client, rows)
+        start = time.perf_counter()
+        update(clock)
+        timings.append(time.perf_counter() - start)
+
+    rows = by_hour[-1]
+    clock = ingest(file_system_client, rows)
+    establishments = rows[DEFAULT_ESTABLISHMENT_COLUMN].unique()
+    half = rows[DEFAULT_ESTABLISHMENT_COLUMN].isin(establishments[::2])
+    merge_concurrently(file_system_client, [rows[half], rows[~half]])
+
+    start, end = releves[DEFAULT_WATERMARK_COLUMN].min().normalize(), clock + datetime.timedelta(days=1)
+    rollup_ms, from_rollups = median_ms(lambda: query_rollups(source, start, end))
+    releve_ms, from_releves = median_ms(lambda: query_releves(source, start, end))
+
+    expected = from_releves.rename(columns={"day": rollups.PERIOD_COLUMN})
+    merged = from_rollups.merge(expected, on=[rollups.PERIOD_COLUMN, DEFAULT_ESTABLISHMENT_COLUMN])
+    assert len(merged) == len(from_rollups) == len(expected), (len(merged), len(from_rollups), len(expected))
+    # missing values are nan or <NA> depending on the dtype pandas infers, compare them with isna
+    for column in ("occupied_stretchers_mean", "occupied_stretchers_max", "occupancy_rate"):
+        left, right = merged[f"{column}_x"], merged[f"{column}_y"]
+        missing = pd.isna(left)
+        assert (missing == pd.isna(right)).all(), column
+        pd.testing.assert_series_equal(
+            left[~missing].astype(float), right[~missing].astype(float), check_names=False)
+
+    print(f"{days:>5} {len(releves):>8} {statistics.median(timings) * 1000:>11.1f} "
+          f"{rollup_ms:>11.1f} {releve_ms:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, nargs="+", default=[14, 56], help="days of history")
+    parser.add_argument("--hours", type=int, default=12, help="hourly relevés rolled up one at a time, 2 at least")
+    parser.add_argument("--latency", type=float, default=5.0, help="ms per stand-in request")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    warnings.simplefilter("ignore")
+
+    print("rollups kept hour by hour match the relevés re-aggregated")
+    print(f'{"days":>5} {"relevés":>8} {"update ms":>11} {"rollups ms":>11} {"relevés ms":>12}')
+    for days in args.days:
+        run(days, args.hours, args.latency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# ./benchmarks/bench_schema.py
+# Compare the CKAN records as ingest_from_api got them (every column an object column of strings)
+# with the records cast to the schema of the dataset (shared/schema.py): memory footprint of the frame,
+# time to cast it, and size of the parquet file written by the shared writer with the encodings of the schema.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_schema --rows 50000 500000
+import argparse
+import statistics
+import time
+import warnings
+
+import pandas as pd
+
+from benchmarks.stand_ins import make_ckan_records
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.parquet import get_buffer_size, write_parquet
+from shared.schema import apply_schema, get_schema
+
+DATASET_NAME = "Releve_horaire_urgences_7jours"
+SORT_COLUMNS = (DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[50_000, 500_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    schema = get_schema(DATASET_NAME)
+
+    print(f'{"rows":>8} {"frame":<7} {"memory MiB":>11} {"parquet MiB":>12} {"cast ms":>8}')
+    for rows in args.rows:
+        raw_df = pd.DataFrame(make_ckan_records(rows))
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            typed_df = apply_schema(raw_df, schema, DATASET_NAME)
+            timings.append(time.perf_counter() - start)
+
+        frames = (
+            ("raw", raw_df, None, None),
+            ("typed", typed_df, statistics.median(timings), schema["column_encoding"]),
+        )
+        for label, df, cast_time, column_encoding in frames:
+            memory = df.memory_usage(deep=True).sum()
+            size = get_buffer_size(write_parquet(df, sort_columns=SORT_COLUMNS, column_encoding=column_encoding))
+            print(f"{rows:>8} {label:<7} {memory / 2 ** 20:>11.2f} {size / 2 ** 20:>12.2f} "
+                  f'{"" if cast_time is None else f"{cast_time * 1000:.1f}":>8}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+# ./benchmarks/bench_sharded_etl.py
+# Run the cloud ETL in one invocation (run_cloud_etl) and fanned out over queue workers (shared/sharded_etl.py)
+# on the same landed extracts, against the in-memory stand-ins of benchmarks/stand_ins.py, and compare the results.
+# The work items are drained from the stand-in queues one at a time and timed, the wall time of a run on
+# several instances is projected from them: enqueue, then the work items spread over the instances, then the reduce.
+# Then two reducers of the same run start at once: one merges the partials, the other finds the run locked or done.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_sharded_etl --blobs 64 --rows 20000 --instances 1 4 16
+import argparse
+import datetime
+import json
+import logging
+import heapq
+import threading
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from benchmarks import stand_ins
+from benchmarks.bench_process_relational_data import COLUMNS, GROUPBY_COLUMNS, make_extract
+from shared.cloudetl import LAYOUT_DATE_PREFIX, get_landing_blob_name, return_blob_files, run_cloud_etl
+from shared.clients import (
+    get_blob_account_url,
+    get_blob_service_client,
+    get_datalake_account_url,
+    get_datalake_service_client,
+    get_queue_account_url,
+    get_queue_client,
+)
+from shared.queues import REDUCE_QUEUE_NAME, SHARD_QUEUE_NAME
+from shared.sharded_etl import reduce_sharded_etl, run_shard, start_sharded_etl
+
+CREDENTIAL = "credential"
+STORAGE_ACCOUNT_URL = get_blob_account_url("benchabs") + "/"
+DATALAKE_ACCOUNT_URL = get_datalake_account_url("benchadls")
+QUEUE_ACCOUNT_URL = get_queue_account_url("benchabs")
+
+JOB = {
+    "storage_account_url": STORAGE_ACCOUNT_URL,
+    "source_container": "ingest",
+    "archive_container": "archive",
+    "datalake_account_url": DATALAKE_ACCOUNT_URL,
+    "filesystem_name": "bench",
+    "dir_name": "silver",
+    "file_format": "parquet",
+    "columns": COLUMNS,
+    "groupby_columns": GROUPBY_COLUMNS,
+}
+
+
+# Receive the messages of a queue until it is empty, returning the time taken by each one
+def drain(queue_client, handler):
+    timings = []
+    while (message := queue_client.receive_message()) is not None:
+        start = time.perf_counter()
+        handler(json.loads(message.content))
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+# Time to run the work items on a number of instances, each taking the next item when it is free
+def get_makespan(timings, instances):
+    free_at = [0.0] * instances
+    for timing in timings:
+        heapq.heappush(free_at, heapq.heappop(free_at) + timing)
+    return max(free_at)
+
+
+def land(container_client, blobs, extracts):
+    today = datetime.datetime.utcnow().date()
+    for index in range(blobs):
+        container_client.upload_blob(
+            get_landing_blob_name(f"extract_{index}.csv", today), extracts[index % len(extracts)], overwrite=True)
+
+
+def list_landed(container_client):
+    return return_blob_files(
+        container_client, datetime.datetime.utcnow().date().isoformat(), "%Y-%m-%d", layout=LAYOUT_DATE_PREFIX)
+
+
+def read_output(datalake_service_client, prefix):
+    file_system_client = datalake_service_client.get_file_system_client(JOB["filesystem_name"])
+    names = [path.name for path in file_system_client.get_paths(path=JOB["dir_name"], recursive=False)
+             if path.name.rsplit("/", 1)[-1].startswith(prefix)]
+    data = file_system_client.get_file_client(names[-1]).download_file().readall()
+    return pq.read_table(pa.BufferReader(data)).to_pandas()
+
+
+def run_single(blob_service_client, container_client, datalake_service_client, chunksize):
+    start = time.perf_counter()
+    run_cloud_etl(
+        service_client=blob_service_client,
+        storage_account_url=STORAGE_ACCOUNT_URL,
+        source_container=JOB["source_container"],
+        archive_container=JOB["archive_container"],
+        source_container_client=container_client,
+        blob_file_list=list_landed(container_client),
+        columns=COLUMNS,
+        groupby_columns=GROUPBY_COLUMNS,
+        datalake_service_client=datalake_service_client,
+        filesystem_name=JOB["filesystem_name"],
+        dir_name=JOB["dir_name"],
+        file_format=JOB["file_format"],
+        file_prefix="single",
+        chunksize=chunksize,
+    )
+    return time.perf_counter() - start
+
+
+# Returns the time to enqueue, of every work item and of the reduce that merged the partials
+def run_sharded(blob_service_client, container_client, datalake_service_client, blobs_per_shard, chunksize):
+    shard_queue_client = get_queue_client(QUEUE_ACCOUNT_URL, SHARD_QUEUE_NAME, CREDENTIAL)
+    reduce_queue_client = get_queue_client(QUEUE_ACCOUNT_URL, REDUCE_QUEUE_NAME, CREDENTIAL)
+
+    start = time.perf_counter()
+    start_sharded_etl(
+        shard_queue_client, datalake_service_client, dict(JOB, file_prefix="sharded", run_id="run"),
+        list_landed(container_client), blobs_per_shard, chunksize)
+    enqueue_time = time.perf_counter() - start
+
+    shard_timings = drain(shard_queue_client, lambda job: run_shard(
+        job, blob_service_client, datalake_service_client, reduce_queue_client))
+
+    results = []
+    reduce_timings = drain(reduce_queue_client, lambda job: results.append(
+        reduce_sharded_etl(job, blob_service_client, datalake_service_client)))
+
+    # one reduce request merges the partials, the others find the run done
+    assert results.count("reduced") == 1, results
+    return enqueue_time, shard_timings, reduce_timings[results.index("reduced")]
+
+
+# Reduce a run on two threads at once, once its partials are written
+def race_reducers(blob_service_client, container_client, datalake_service_client, blobs_per_shard, chunksize):
+    shard_queue_client = get_queue_client(QUEUE_ACCOUNT_URL, SHARD_QUEUE_NAME, CREDENTIAL)
+    reduce_queue_client = get_queue_client(QUEUE_ACCOUNT_URL, REDUCE_QUEUE_NAME, CREDENTIAL)
+
+    job = start_sharded_etl(
+        shard_queue_client, datalake_service_client, dict(JOB, file_prefix="race"),
+        list_landed(container_client), blobs_per_shard, chunksize)
+    drain(shard_queue_client, lambda job: run_shard(
+        job, blob_service_client, datalake_service_client, reduce_queue_client))
+    drain(reduce_queue_client, lambda job: None)
+
+    job = {key: value for key, value in job.items() if key != "blobs"}
+    barrier = threading.Barrier(2)
+    results = []
+
+    def reduce():
+        barrier.wait()
+        results.append(reduce_sharded_etl(job, blob_service_client, datalake_service_client))
+
+    threads = [threading.Thread(target=reduce) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blobs", type=int, default=64)
+    parser.add_argument("--rows", type=int, default=20_000, help="rows per blob")
+    parser.add_argument("--instances", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--blobs-per-shard", type=int, default=8)
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    warnings.simplefilter("ignore")
+    stand_ins.install()
+
+    blob_service_client = get_blob_service_client(STORAGE_ACCOUNT_URL, CREDENTIAL)
+    container_client = blob_service_client.get_container_client(JOB["source_container"])
+    datalake_service_client = get_datalake_service_client(DATALAKE_ACCOUNT_URL, CREDENTIAL)
+    extracts = [make_extract(args.rows, seed).to_csv(index=False).encode() for seed in range(4)]
+
+    land(container_client, args.blobs, extracts)
+    single_time = run_single(blob_service_client, container_client, datalake_service_client, args.chunksize)
+    expected = read_output(datalake_service_client, "single")
+
+    land(container_client, args.blobs, extracts)
+    enqueue_time, shard_timings, reduce_time = run_sharded(
+        blob_service_client, container_client, datalake_service_client, args.blobs_per_shard, args.chunksize)
+    result = read_output(datalake_service_client, "sharded")
+
+    # the partial sums are added in another order, float sums may differ in their last bits
+    try:
+        pd.testing.assert_frame_equal(expected, result, check_exact=False, rtol=1e-12)
+        max_difference = np.abs(expected["total_gross_sales"] - result["total_gross_sales"]).max()
+        print(f"sharded result matches the single run (max gross sales difference {max_difference:.1e})")
+    except AssertionError as e:
+        print(f"sharded result DIFFERS from the single run: {e}")
+
+    print(f"{len(shard_timings)} work items of {args.blobs_per_shard} blobs: "
+          f"enqueue {enqueue_time:.3f}s, work items {sum(shard_timings):.3f}s in total, reduce {reduce_time:.3f}s")
+    print(f'{"mode":<22} {"rows":>10} {"seconds":>9} {"speedup":>8}')
+    print(f'{"single invocation":<22} {args.blobs * args.rows:>10} {single_time:>9.3f} {1:>7.1f}x')
+
+    for instances in args.instances:
+        sharded_time = enqueue_time + get_makespan(shard_timings, instances) + reduce_time
+        print(f'{f"sharded, {instances} instances":<22} {args.blobs * args.rows:>10} {sharded_time:>9.3f} '
+              f'{single_time / sharded_time:>7.1f}x')
+
+    land(container_client, args.blobs, extracts)
+    results = race_reducers(
+        blob_service_client, container_client, datalake_service_client, args.blobs_per_shard, args.chunksize)
+    print(f"two reducers at once: {', '.join(results)}")
+    assert results.count("reduced") == 1, results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# ./benchmarks/bench_status.py
+# Answer "what is the current occupancy at establishment X" over the bronze partitions of the Data Lake stand-in
+# (benchmarks/stand_ins.py): by scanning the newest partition for the latest relevé, then from the in-memory
+# index of shared/status.py, by establishment, by region, and revalidated with its ETag. An establishment
+# that stopped reporting before the newest partition is still served from the relevés of the days before.
+# Then an ingestion updates the index, and a relevé written by another worker is picked up by a refresh.
+#
+#   cd AzureFunctionsApp
+#   python -m benchmarks.bench_status --days 2 --latency 5
+import argparse
+import datetime
+import json
+import logging
+import statistics
+import time
+import warnings
+
+import pandas as pd
+
+from benchmarks import stand_ins
+from benchmarks.bench_rollups import (
+    ACCOUNT_NAME,
+    BRONZE_DIRECTORY_NAME,
+    CREDENTIAL,
+    DATASET_NAME,
+    ingest,
+    make_releves,
+)
+from shared import status
+from shared.clients import get_datalake_account_url, get_datalake_service_client
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.reader import DataLakeSource, read_dataset
+
+
+def median_us(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e6, result
+
+
+# Latest relevé of an establishment, from the files of the newest partition
+def scan_latest(source, clock, establishment):
+    start = datetime.datetime.combine(clock.date(), datetime.time())
+    df = read_dataset(
+        source, BRONZE_DIRECTORY_NAME, DATASET_NAME, start, start + datetime.timedelta(days=1),
+        filters=[(DEFAULT_ESTABLISHMENT_COLUMN, "==", establishment)], time_column=None)
+    return df.sort_values(DEFAULT_WATERMARK_COLUMN).iloc[-1]
+
+
+def get_index(source, refresh_interval=3600):
+    return status.get_status_index(source, BRONZE_DIRECTORY_NAME, DATASET_NAME, refresh_interval=refresh_interval)
+
+
+def lookup(index, **filters):
+    return index.get_response(**filters)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=2, help="days of hourly relevés written")
+    parser.add_argument("--latency", type=float, default=5.0, help="ms per stand-in request")
+    parser.add_argument("--repeat", type=int, default=1000, help="lookups timed")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    warnings.simplefilter("ignore")
+
+    store = stand_ins.install(latency=0)
+    file_system_client = get_datalake_service_client(
+        get_datalake_account_url(ACCOUNT_NAME), CREDENTIAL).get_file_system_client("bench")
+    source = DataLakeSource(file_system_client)
+
+    releves = make_releves(24 * args.days + 2)
+    quiet = str(releves[DEFAULT_ESTABLISHMENT_COLUMN].iloc[0])
+    by_hour = [rows for _, rows in releves.groupby(DEFAULT_WATERMARK_COLUMN, observed=True)]
+
+    # the quiet establishment stops reporting a day before the newest relevé read by the warm
+    last_report = by_hour[-27][DEFAULT_WATERMARK_COLUMN].max()
+    by_hour = by_hour[:-26] + [rows[rows[DEFAULT_ESTABLISHMENT_COLUMN] != quiet] for rows in by_hour[-26:]]
+    for rows in by_hour[:-2]:
+        clock = ingest(file_system_client, rows)
+    status.get_partition_now = lambda: clock
+
+    store.latency = args.latency / 1000
+    establishment = str(releves[DEFAULT_ESTABLISHMENT_COLUMN].iloc[50])
+    region = str(releves.loc[releves[DEFAULT_ESTABLISHMENT_COLUMN] == establishment, "Region"].iloc[0])
+
+    print(f"current status of {establishment} (region {region}), {args.days} days of relevés, "
+          f"{args.latency} ms per request")
+    print(f'{"query":<24} {"us":>10} {"calls":>6}')
+
+    def report(label, us, calls):
+        print(f"{label:<24} {us:>10.1f} {calls:>6}")
+
+    calls = store.calls
+    scan_us, expected = median_us(lambda: scan_latest(source, clock, establishment), 3)
+    report("scan newest partition", scan_us, (store.calls - calls) // 3)
+
+    calls = store.calls
+    warm_us, index = median_us(lambda: get_index(source), 1)
+    report("warm index (once)", warm_us, store.calls - calls)
+
+    record = json.loads(lookup(index, establishments=[quiet]))["establishments"][0]
+    assert pd.Timestamp(record[DEFAULT_WATERMARK_COLUMN]) == last_report
+
+    calls = store.calls
+    establishment_us, body = median_us(lambda: lookup(get_index(source), establishments=[establishment]), args.repeat)
+    report("index, establishment", establishment_us, store.calls - calls)
+    region_us, _ = median_us(lambda: lookup(get_index(source), regions=[region]), args.repeat)
+    report("index, region", region_us, 0)
+    all_us, _ = median_us(lambda: lookup(get_index(source)), args.repeat)
+    report("index, all", all_us, 0)
+
+    _, etag = index.get_response(establishments=[establishment])
+    not_modified_us, matched = median_us(
+        lambda: status.matches_etag(etag, get_index(source).get_response(establishments=[establishment])[1]),
+        args.repeat)
+    report("index, 304", not_modified_us, 0)
+    assert matched
+
+    record = json.loads(body)["establishments"][0]
+    assert pd.Timestamp(record[DEFAULT_WATERMARK_COLUMN]) == expected[DEFAULT_WATERMARK_COLUMN]
+    assert record["Nombre_de_civieres_occupees"] == expected["Nombre_de_civieres_occupees"]
+
+    # an ingestion of this worker updates the index, the ETag changes
+    rows = by_hour[-2]
+    clock = ingest(file_system_client, rows)
+    update_us, updated = median_us(lambda: status.update_status_index(DATASET_NAME, rows), 1)
+    report("update on ingest", update_us, 0)
+    assert updated == rows[DEFAULT_ESTABLISHMENT_COLUMN].nunique()
+    assert not status.matches_etag(etag, index.get_response(establishments=[establishment])[1])
+
+    # a relevé ingested by another worker is read by the next refresh
+    rows = by_hour[-1]
+    clock = ingest(file_system_client, rows)
+    calls = store.calls
+    refresh_us, _ = median_us(lambda: get_index(source, refresh_interval=0), 1)
+    report("refresh (interval)", refresh_us, store.calls - calls)
+    record = json.loads(lookup(index, establishments=[establishment]))["establishments"][0]
+    assert pd.Timestamp(record[DEFAULT_WATERMARK_COLUMN]) == rows[DEFAULT_WATERMARK_COLUMN].max()
+
+
+if __name__ == "__main__":
+    main()
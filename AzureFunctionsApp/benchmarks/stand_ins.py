@@ -0,0 +1,523 @@
+# ./benchmarks/stand_ins.py
+# In-memory stand-ins for the Blob Storage, Data Lake and Storage Queue clients, and a local HTTP server
+# standing in for the CKAN API and the news article sites, so that the pipelines run offline.
+#
+# install() swaps the client classes used by shared.clients, and the Queue client class of the Queue SDK
+# that shared.clients imports on use, every module then gets the stand-ins.
+# install(directory=...) keeps the blobs and files in a local directory instead, shared by the processes
+# that install it, e.g. the workers of a process pool.
+import datetime
+import hashlib
+import io
+import json
+import os
+import itertools
+import pickle
+import threading
+import urllib.parse
+from collections import deque
+from collections.abc import MutableMapping
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+import azure.storage.queue
+import pandas as pd
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import BlobPrefix
+
+import shared.clients
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_RECORDS_FILE = os.path.join(APP_DIR, "df.parquet.gzip")
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Latency added to every stand-in storage and HTTP call, in seconds
+DEFAULT_LATENCY = 0.0
+
+
+# Bytes of the data given to an upload: bytes, text or a readable stream
+def to_bytes(data):
+    if hasattr(data, "read"):
+        data = data.read()
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return bytes(data)
+
+
+# ETag of stand-in data: its hash, so that a write of other content changes it
+def get_etag(data):
+    return f'"{hashlib.sha1(data).hexdigest()}"'
+
+
+# Check the etag and match_condition keywords of a Data Lake call against a stored file
+def check_match_condition(files, path, etag=None, match_condition=None, **kwargs):
+    exists = path in files
+    if match_condition == MatchConditions.IfMissing and exists:
+        raise ResourceExistsError(path)
+    if match_condition == MatchConditions.IfPresent and not exists:
+        raise ResourceNotFoundError(path)
+    if match_condition == MatchConditions.IfNotModified and (not exists or get_etag(files[path]) != etag):
+        raise ResourceModifiedError(path)
+    if match_condition == MatchConditions.IfModified and exists and get_etag(files[path]) == etag:
+        raise ResourceModifiedError(path)
+
+
+class StandInDirectoryFiles(MutableMapping):
+    # Blobs or files of a container kept in a local directory, one pickle per name
+    def __init__(self, directory):
+        self.directory = directory
+        self.temp_directory = f"{directory}.tmp"
+
+    def _path(self, name):
+        return os.path.join(self.directory, urllib.parse.quote(name, safe=""))
+
+    def __contains__(self, name):
+        return os.path.exists(self._path(name))
+
+    def __getitem__(self, name):
+        try:
+            with open(self._path(name), "rb") as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            raise KeyError(name) from None
+
+    # written aside then renamed, other processes never read a partial file
+    def __setitem__(self, name, value):
+        os.makedirs(self.directory, exist_ok=True)
+        os.makedirs(self.temp_directory, exist_ok=True)
+        temp_path = os.path.join(self.temp_directory, f"{os.getpid()}_{threading.get_ident()}")
+        with open(temp_path, "wb") as file:
+            pickle.dump(value, file)
+        os.replace(temp_path, self._path(name))
+
+    def __delitem__(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            raise KeyError(name) from None
+
+    def __iter__(self):
+        if not os.path.isdir(self.directory):
+            return iter([])
+        return iter([urllib.parse.unquote(name) for name in os.listdir(self.directory)])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+class StandInStore:
+    # Blobs and files of every stand-in account, keyed by account url then container or file system,
+    # in memory or under a local directory
+    def __init__(self, latency=DEFAULT_LATENCY, directory=None):
+        self.latency = latency
+        self.directory = directory
+        self.accounts = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+    def container(self, account_url, name):
+        account_url = account_url.rstrip("/")
+        with self.lock:
+            if self.directory is not None:
+                return StandInDirectoryFiles(os.path.join(
+                    self.directory, urllib.parse.quote(account_url, safe=""), urllib.parse.quote(name, safe="")))
+            return self.accounts.setdefault(account_url, {}).setdefault(name, {})
+
+
+class StandInBlob:
+    def __init__(self, data, creation_time=None, metadata=None):
+        self.data = data
+        self.creation_time = creation_time or datetime.datetime.now(datetime.timezone.utc)
+        self.metadata = metadata or {}
+
+
+class StandInDownload:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+        self.properties = SimpleNamespace(etag=get_etag(data), size=len(data))
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def readall(self):
+        return self.stream.read()
+
+
+class StandInBlobClient:
+    def __init__(self, service, container_name, blob_name):
+        self.service = service
+        self.container_name = container_name
+        self.blob_name = blob_name
+
+    @property
+    def blobs(self):
+        return self.service.store.container(self.service.url, self.container_name)
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        self.service.store.call()
+        if not overwrite and self.blob_name in self.blobs:
+            raise ResourceExistsError(self.blob_name)
+        self.blobs[self.blob_name] = StandInBlob(to_bytes(data))
+
+    def download_blob(self, **kwargs):
+        self.service.store.call()
+        if self.blob_name not in self.blobs:
+            raise ResourceNotFoundError(self.blob_name)
+        return StandInDownload(self.blobs[self.blob_name].data)
+
+    # Copies complete right away, from blobs of the same stand-in account. As on the service, the copy is
+    # created now, and keeps the metadata of the source unless metadata is given
+    def start_copy_from_url(self, source_url, metadata=None, **kwargs):
+        self.service.store.call()
+        container_name, blob_name = urllib.parse.urlsplit(source_url).path.lstrip("/").split("/", 1)
+        source = self.service.store.container(self.service.url, container_name)[blob_name]
+        self.blobs[self.blob_name] = StandInBlob(
+            source.data, metadata=dict(source.metadata if metadata is None else metadata))
+        return {"copy_status": "success"}
+
+    def get_blob_properties(self):
+        self.service.store.call()
+        if self.blob_name not in self.blobs:
+            raise ResourceNotFoundError(self.blob_name)
+        return SimpleNamespace(copy=SimpleNamespace(status="success"), size=len(self.blobs[self.blob_name].data))
+
+
+class StandInContainerClient:
+    def __init__(self, service, container_name):
+        self.service = service
+        self.container_name = container_name
+
+    @property
+    def blobs(self):
+        return self.service.store.container(self.service.url, self.container_name)
+
+    def get_blob_client(self, blob):
+        return StandInBlobClient(self.service, self.container_name, blob)
+
+    def upload_blob(self, name, data, overwrite=False, **kwargs):
+        self.get_blob_client(name).upload_blob(data, overwrite=overwrite)
+
+    # metadata is only listed when included, as on the service
+    def list_blobs(self, name_starts_with=None, include=None, **kwargs):
+        self.service.store.call()
+        prefix = name_starts_with or ""
+        return [
+            SimpleNamespace(name=name, creation_time=blob.creation_time, size=len(blob.data),
+                            metadata=dict(blob.metadata) if "metadata" in (include or []) else None)
+            for name, blob in sorted(self.blobs.items()) if name.startswith(prefix)
+        ]
+
+    def walk_blobs(self, name_starts_with=None, delimiter="/", **kwargs):
+        self.service.store.call()
+        prefix = name_starts_with or ""
+        items = {}
+        for name, blob in sorted(self.blobs.items()):
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if delimiter in rest:
+                sub_prefix = prefix + rest.split(delimiter, 1)[0] + delimiter
+                items.setdefault(sub_prefix, BlobPrefix(prefix=sub_prefix, name=sub_prefix))
+            else:
+                items[name] = SimpleNamespace(name=name, creation_time=blob.creation_time, size=len(blob.data))
+        return list(items.values())
+
+    def delete_blobs(self, *names, **kwargs):
+        self.service.store.call()
+        responses = []
+        for name in names:
+            responses.append(SimpleNamespace(status_code=202 if self.blobs.pop(name, None) else 404))
+        return responses
+
+
+class StandInBlobServiceClient:
+    store = None
+
+    def __init__(self, account_url, credential=None, **kwargs):
+        self.url = account_url.rstrip("/")
+
+    def get_container_client(self, container):
+        return StandInContainerClient(self, container)
+
+    def get_blob_client(self, container, blob):
+        return StandInBlobClient(self, container, blob)
+
+
+class StandInFileClient:
+    def __init__(self, file_system, path):
+        self.file_system = file_system
+        self.path = path.strip("/")
+        self.pending = bytearray()
+
+    @property
+    def files(self):
+        return self.file_system.files
+
+    # writes and their conditions are atomic within a process, as they are on the service.
+    # As the SDK, overwrite=False does not create the path: it appends to an existing file
+    # and flushes with If-None-Match: *, so it fails whether the file exists or not
+    def upload_data(self, data, overwrite=False, **kwargs):
+        self.file_system.store.call()
+        data = to_bytes(data)
+        with self.file_system.store.lock:
+            if not overwrite:
+                if self.path not in self.files:
+                    raise ResourceNotFoundError(self.path)
+                raise ResourceModifiedError(self.path)
+            check_match_condition(self.files, self.path, **kwargs)
+            self.files[self.path] = data
+        return {"etag": get_etag(data)}
+
+    def create_file(self, **kwargs):
+        self.file_system.store.call()
+        self.files[self.path] = b""
+        self.pending = bytearray()
+
+    def append_data(self, data, offset, length=None, **kwargs):
+        self.file_system.store.call()
+        self.pending += to_bytes(data)
+
+    # upload_data already committed the data, append_data commits on flush
+    def flush_data(self, offset, **kwargs):
+        self.file_system.store.call()
+        if self.pending:
+            self.files[self.path] = self.files.get(self.path, b"") + bytes(self.pending)
+            self.pending = bytearray()
+
+    def download_file(self, offset=None, length=None, **kwargs):
+        self.file_system.store.call()
+        if self.path not in self.files:
+            raise ResourceNotFoundError(self.path)
+        data = self.files[self.path]
+        if offset is not None:
+            data = data[offset:offset + length if length is not None else None]
+        return StandInDownload(data)
+
+    def get_file_properties(self):
+        self.file_system.store.call()
+        if self.path not in self.files:
+            raise ResourceNotFoundError(self.path)
+        data = self.files[self.path]
+        return SimpleNamespace(size=len(data), etag=get_etag(data))
+
+    def rename_file(self, new_name, **kwargs):
+        self.file_system.store.call()
+        file_system_name, new_path = new_name.split("/", 1)
+        target = self.file_system.service.get_file_system_client(file_system_name)
+        with self.file_system.store.lock:
+            if self.path not in self.files:
+                raise ResourceNotFoundError(self.path)
+            check_match_condition(target.files, new_path, **kwargs)
+            target.files[new_path] = self.files.pop(self.path)
+        return StandInFileClient(target, new_path)
+
+    def delete_file(self, **kwargs):
+        self.file_system.store.call()
+        with self.file_system.store.lock:
+            check_match_condition(self.files, self.path, **kwargs)
+            if self.files.pop(self.path, None) is None:
+                raise ResourceNotFoundError(self.path)
+
+
+class StandInDirectoryClient:
+    def __init__(self, file_system, path):
+        self.file_system = file_system
+        self.path = path.strip("/")
+
+    def get_file_client(self, file):
+        return StandInFileClient(self.file_system, f"{self.path}/{file}")
+
+
+class StandInFileSystemClient:
+    def __init__(self, service, file_system_name):
+        self.service = service
+        self.store = service.store
+        self.account_name = service.url
+        self.file_system_name = file_system_name
+        self.files = service.store.container(service.url, file_system_name)
+
+    def get_file_client(self, file_path):
+        return StandInFileClient(self, file_path)
+
+    def get_directory_client(self, directory):
+        return StandInDirectoryClient(self, directory)
+
+    # directories are implicit in the stand-in
+    def create_directory(self, directory, **kwargs):
+        self.store.call()
+        return StandInDirectoryClient(self, directory)
+
+    def get_paths(self, path=None, recursive=True, **kwargs):
+        self.store.call()
+        prefix = f"{path.strip('/')}/" if path else ""
+        paths = {}
+        for name in sorted(self.files):
+            if not name.startswith(prefix):
+                continue
+            parts = name[len(prefix):].split("/")
+            for depth in range(1, len(parts) if recursive else 1):
+                directory = prefix + "/".join(parts[:depth])
+                paths.setdefault(directory, SimpleNamespace(name=directory, is_directory=True))
+            if recursive or len(parts) == 1:
+                paths[name] = SimpleNamespace(name=name, is_directory=False, content_length=len(self.files[name]))
+            else:
+                directory = prefix + parts[0]
+                paths.setdefault(directory, SimpleNamespace(name=directory, is_directory=True))
+        if path and not paths:
+            raise ResourceNotFoundError(path)
+        return list(paths.values())
+
+
+class StandInDataLakeServiceClient:
+    store = None
+
+    def __init__(self, account_url, credential=None, **kwargs):
+        self.url = account_url.rstrip("/")
+
+    def get_file_system_client(self, file_system):
+        return StandInFileSystemClient(self, file_system)
+
+    def get_file_client(self, file_system, file_path):
+        return StandInFileClient(self.get_file_system_client(file_system), file_path)
+
+
+class StandInQueueClient:
+    # Messages are delivered once, in order, and are gone once received:
+    # a worker failing on a message has to send it again to retry it
+    store = None
+    _ids = itertools.count()
+
+    def __init__(self, account_url, queue_name, credential=None, **kwargs):
+        self.url = account_url.rstrip("/")
+        self.queue_name = queue_name
+
+    @property
+    def messages(self):
+        with self.store.lock:
+            queues = self.store.accounts.setdefault(self.url, {}).setdefault("__queues__", {})
+            return queues.setdefault(self.queue_name, deque())
+
+    def send_message(self, content, **kwargs):
+        self.store.call()
+        self.messages.append(SimpleNamespace(id=str(next(self._ids)), content=content))
+
+    def receive_message(self, **kwargs):
+        self.store.call()
+        try:
+            return self.messages.popleft()
+        except IndexError:
+            return None
+
+    def get_queue_properties(self):
+        return SimpleNamespace(approximate_message_count=len(self.messages))
+
+
+# Route every Blob Storage, Data Lake and Storage Queue client of shared.clients to a new store,
+# in memory, or under directory when given
+def install(latency=DEFAULT_LATENCY, directory=None):
+    store = StandInStore(latency, directory)
+    StandInBlobServiceClient.store = store
+    StandInDataLakeServiceClient.store = store
+    StandInQueueClient.store = store
+    shared.clients.BlobServiceClient = StandInBlobServiceClient
+    shared.clients.DataLakeServiceClient = StandInDataLakeServiceClient
+    azure.storage.queue.QueueClient = StandInQueueClient
+    shared.clients._clients.clear()
+    return store
+
+
+# Emergency room records shaped like the CKAN resources, from the sample extract:
+# the sample establishments repeated at successive extraction times
+def make_ckan_records(rows):
+    sample = pd.read_parquet(SAMPLE_RECORDS_FILE)
+    repeats = -(-rows // len(sample))
+    df = pd.concat([sample] * repeats, ignore_index=True).iloc[:rows]
+
+    extraction = pd.Timestamp("2023-09-21T21:45") + pd.to_timedelta(np.arange(len(df)) // len(sample), unit="h")
+    df["Mise_a_jour"] = extraction.strftime("%Y-%m-%dT%H:%M")
+    df["Heure_de_l'extraction_(image)"] = extraction.strftime("%H:%M:%S")
+    df["_id"] = np.arange(1, len(df) + 1)
+
+    return json.loads(df.to_json(orient="records"))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # CKAN datastore_search and resource_show, and news article pages
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, headers=None):
+        self.server.store.call()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+
+        if parts.path.endswith("/datastore_search"):
+            records = self.server.records
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", 100))
+            page = records[offset:offset + limit]
+            result = {
+                "fields": [{"id": name} for name in records[0]] if records else [],
+                "records": page,
+                "total": len(records),
+                "_links": {"next": "next"} if offset + limit < len(records) else {},
+            }
+            self.send_body(json.dumps({"success": True, "result": result}).encode(), "application/json")
+
+        elif parts.path.endswith("/resource_show"):
+            # a new modification time on every call, so that every run downloads the records
+            self.server.resource_version += 1
+            result = {"id": query.get("id"), "last_modified": f"2023-09-21T21:45:{self.server.resource_version:09d}"}
+            self.send_body(json.dumps({"success": True, "result": result}).encode(), "application/json")
+
+        elif parts.path.startswith("/articles/"):
+            index = int(parts.path.rsplit("/", 1)[-1].split(".")[0])
+            pages = self.server.pages
+            self.send_body(pages[index % len(pages)], "text/html", {"ETag": f'"{index}"'})
+
+        else:
+            self.send_error(404)
+
+
+# Start the stand-in HTTP server on a free local port, in a background thread
+def start_http_server(store, records=(), pages=None):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.store = store
+    server.records = list(records)
+    server.resource_version = 0
+    server.pages = pages or load_article_pages()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_server_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def load_article_pages():
+    pages = []
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith(".html"):
+            with open(os.path.join(FIXTURES_DIR, name), "rb") as page_file:
+                pages.append(page_file.read())
+    return pages
@@ -3,40 +3,60 @@ import logging
 import os
 
 import azure.functions as func
-from azure.keyvault.secrets import SecretClient
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
-from azure.storage.filedatalake import DataLakeServiceClient
-
-from shared.cloudetl import (
-    return_blob_files,
-    run_cloud_etl
-)
-
-from shared.azure_credential import (
-    get_azure_default_credential,
-    get_azure_key_credential,
-)
-from shared.bing_search import get_news
-from shared.hash import get_random_hash
-from shared.key_vault_secret import get_key_vault_secret
-from shared.datalake import upload_to_datalake
-from shared.transform import clean_documents
-from shared.ingest import ingest_from_api
+
+# Only light modules are imported when the functions are indexed. The heavy ones (pandas, pyarrow,
+# the Azure SDKs, bs4, lxml, requests) are imported by the functions that use them, so that a cold start
+# only pays for the trigger it runs. scripts/measure_import_time.py measures both.
+from shared import metrics
+from shared.queues import QUEUE_CONNECTION, REDUCE_QUEUE_NAME, SHARD_QUEUE_NAME
 
 app = func.FunctionApp()
 
+# Output formats of the api_blob_trigger function
+NEWS_OUTPUT_JSON = "json"
+NEWS_OUTPUT_NDJSON = "ndjson"
+
+# Execution modes of the cloud ETL: one invocation, or fanned out to the cloudetl_shard workers
+CLOUDETL_MODE_SINGLE = "single"
+CLOUDETL_MODE_SHARDED = "sharded"
+
 @app.function_name(name="demo_relational_data_cloudetl")
 @app.route(route="cloudetl")  # HTTP Trigger
+@metrics.invocation("demo_relational_data_cloudetl")
 def demo_relational_data_cloudetl(req: func.HttpRequest) -> func.HttpResponse:
+    from datetime import datetime
+
+    from shared.azure_credential import get_azure_default_credential
+    from shared.clients import (
+        get_blob_service_client,
+        get_datalake_service_client,
+        get_queue_client,
+        get_secret_client,
+    )
+    from shared.cloudetl import LAYOUT_FLAT, return_blob_files, run_cloud_etl
+    from shared.sharded_etl import get_queue_service_url, start_sharded_etl
+
     logging.info('Python HTTP trigger function processed a request.')
 
     # Parameters/Configurations
-    arg_date = '2014-07-01'
+    # Extracts landed from ?date= (CLOUDETL_START_DATE by default) to ?end= (today by default),
+    # past ranges are reprocessed day by day with scripts/backfill.py
     std_date_format = '%Y-%m-%d'
+    arg_date = req.params.get('date') or os.environ.get('CLOUDETL_START_DATE', '2014-07-01')
+    end_date = req.params.get('end')
     processed_file_format = 'parquet'
     processed_file_prefix = 'financial_demo'
 
+    # Ingest container layout: files at the root, selected by creation time, or landed under
+    # YYYY/MM/DD/ prefixes (ABS_INGEST_LAYOUT=date_prefix, see get_landing_blob_name)
+    ingest_layout = os.environ.get("ABS_INGEST_LAYOUT", LAYOUT_FLAT)
+
+    # Rows aggregated at a time, bounds memory by the number of groups instead of the input size
+    chunksize = int(os.environ.get("CLOUDETL_CHUNKSIZE", 0)) or None
+
+    # Sharded runs return once the work items are enqueued, cloudetl_reduce writes the result
+    etl_mode = os.environ.get("CLOUDETL_MODE", CLOUDETL_MODE_SINGLE)
+
     # List of columns relevant for analysis
     cols = ['segment', 'country', 'units_sold', 'gross_sales', 'date']
 
@@ -61,34 +81,56 @@ def demo_relational_data_cloudetl(req: func.HttpRequest) -> func.HttpResponse:
         adls_dir_name = os.environ["ADLS_DIRECTORY_NAME"]
 
         # Authenticate and securely retrieve Key Vault secret for access key value.
-        az_credential = DefaultAzureCredential(
+        az_credential = get_azure_default_credential(
             exclude_shared_token_cache_credential=True, exclude_visual_studio_code_credential=True)
 
-        secret_client = SecretClient(
-            vault_url=key_vault_Uri, credential=az_credential)
+        secret_client = get_secret_client(key_vault_Uri, az_credential)
         access_key_secret = secret_client.get_secret(abs_secret_name)
 
-        # Initialize Azure Service SDK Clients
-        abs_service_client = BlobServiceClient(
-            account_url=abs_acct_url,
-            credential=az_credential
-        )
+        # Get the pooled Azure Service SDK Clients
+        abs_service_client = get_blob_service_client(abs_acct_url, az_credential)
 
         abs_container_client = abs_service_client.get_container_client(
             container=abs_container_name)
 
-        adls_service_client = DataLakeServiceClient(
-            account_url=adls_acct_url,
-            credential=az_credential
-        )
+        adls_service_client = get_datalake_service_client(adls_acct_url, az_credential)
 
         # Run ETL Application
         process_file_list = return_blob_files(
             container_client=abs_container_client,
             arg_date=arg_date,
-            std_date_format=std_date_format
+            std_date_format=std_date_format,
+            layout=ingest_layout,
+            end_date=datetime.strptime(end_date, std_date_format).date() if end_date else None
         )
 
+        if not process_file_list:
+            logging.info('no extracts landed since %s', arg_date)
+            return func.HttpResponse(f"This HTTP triggered function found no extracts landed since {arg_date}.")
+
+        if etl_mode == CLOUDETL_MODE_SHARDED:
+            job = start_sharded_etl(
+                queue_client=get_queue_client(get_queue_service_url(), SHARD_QUEUE_NAME, az_credential),
+                datalake_service_client=adls_service_client,
+                job={
+                    "storage_account_url": abs_acct_url,
+                    "source_container": abs_container_name,
+                    "archive_container": archive_container_name,
+                    "datalake_account_url": adls_acct_url,
+                    "filesystem_name": adls_fsys_name,
+                    "dir_name": adls_dir_name,
+                    "file_format": processed_file_format,
+                    "file_prefix": processed_file_prefix,
+                    "columns": cols,
+                    "groupby_columns": groupby_cols,
+                },
+                blob_file_list=process_file_list,
+                chunksize=chunksize
+            )
+
+            return func.HttpResponse(
+                f"This HTTP triggered function started run {job['run_id']} with {job['shards']} shards.")
+
         run_cloud_etl(
             source_container_client=abs_container_client,
             blob_file_list=process_file_list,
@@ -102,11 +144,13 @@ def demo_relational_data_cloudetl(req: func.HttpRequest) -> func.HttpResponse:
             service_client=abs_service_client,
             storage_account_url=abs_acct_url,
             source_container=abs_container_name,
-            archive_container=archive_container_name
+            archive_container=archive_container_name,
+            chunksize=chunksize
         )
 
     except Exception as e:
-        logging.info(e)
+        logging.exception("cloud etl failed: %s", e)
+        metrics.mark_failed()
 
         return func.HttpResponse(
             f"!! This HTTP triggered function executed unsuccessfully. \n\t {e} ",
@@ -116,51 +160,147 @@ def demo_relational_data_cloudetl(req: func.HttpRequest) -> func.HttpResponse:
     return func.HttpResponse("This HTTP triggered function executed successfully.")
 
 
+# Get the clients of a sharded cloud ETL job, with the credential of demo_relational_data_cloudetl
+def get_sharded_etl_clients(job):
+    from shared.azure_credential import get_azure_default_credential
+    from shared.clients import get_blob_service_client, get_datalake_service_client, get_queue_client
+    from shared.sharded_etl import get_queue_service_url
+
+    az_credential = get_azure_default_credential(
+        exclude_shared_token_cache_credential=True, exclude_visual_studio_code_credential=True)
+
+    return (
+        get_blob_service_client(job["storage_account_url"], az_credential),
+        get_datalake_service_client(job["datalake_account_url"], az_credential),
+        get_queue_client(get_queue_service_url(), REDUCE_QUEUE_NAME, az_credential),
+    )
+
+
+# Failed work items are retried by the queue trigger, then moved to the poison queue
+@app.function_name(name="cloudetl_shard")
+@app.queue_trigger(arg_name="msg", queue_name=SHARD_QUEUE_NAME, connection=QUEUE_CONNECTION)
+@metrics.invocation("cloudetl_shard")
+def cloudetl_shard(msg: func.QueueMessage) -> None:
+    from shared.sharded_etl import run_shard
+
+    job = msg.get_json()
+    blob_service_client, datalake_service_client, reduce_queue_client = get_sharded_etl_clients(job)
+
+    run_shard(job, blob_service_client, datalake_service_client, reduce_queue_client)
+
+
+@app.function_name(name="cloudetl_reduce")
+@app.queue_trigger(arg_name="msg", queue_name=REDUCE_QUEUE_NAME, connection=QUEUE_CONNECTION)
+@metrics.invocation("cloudetl_reduce")
+def cloudetl_reduce(msg: func.QueueMessage) -> None:
+    from shared.sharded_etl import reduce_sharded_etl
+
+    job = msg.get_json()
+    blob_service_client, datalake_service_client, reduce_queue_client = get_sharded_etl_clients(job)
+
+    result = reduce_sharded_etl(job, blob_service_client, datalake_service_client, reduce_queue_client)
+    logging.info("run %s: %s", job["run_id"], result)
+
+
 @app.function_name(name="get_data_timed")
 @app.schedule(schedule="0 15 0-23 * * *", 
               arg_name="mytimer") 
+@metrics.invocation("get_data_timed")
 def get_data_timed(mytimer: func.TimerRequest) -> None:
-    url_1 = 'https://www.donneesquebec.ca/recherche/api/3/action/datastore_search?resource_id=a9272cc9-8234-40d1-9806-9f6b4c75c20d'  
-    url_2 = 'https://www.donneesquebec.ca/recherche/api/3/action/datastore_search?resource_id=b256f87f-40ec-4c79-bdba-a23e9c50e741'
-
-    filename_1 = 'Releve_horaire_urgences_7jours'
-    filename_2 = 'Releve_horaire_urgences_7jours_nbpers'
+    from shared.runner import run_ingestion
 
-    ingest_from_api(url_1, filename_1)
-    ingest_from_api(url_2, filename_2)
+    run_ingestion()
 
     return 'true'
 
 @app.function_name(name="get_data_manual")
 @app.route(route="get_data_manual")  # HTTP Trigger
+@metrics.invocation("get_data_manual")
 def get_data_manual(req: func.HttpRequest) -> func.HttpResponse:
-    url_1 = 'https://www.donneesquebec.ca/recherche/api/3/action/datastore_search?resource_id=a9272cc9-8234-40d1-9806-9f6b4c75c20d'  
-    url_2 = 'https://www.donneesquebec.ca/recherche/api/3/action/datastore_search?resource_id=b256f87f-40ec-4c79-bdba-a23e9c50e741'
+    from shared.runner import run_ingestion
+
+    results = run_ingestion()
+
+    return func.HttpResponse(json.dumps(results), mimetype="application/json")
+
+# Latest relevé of the establishments (?establishment=) and regions (?region=) asked for, comma separated,
+# every establishment when none are, of a dataset of resources.json (?dataset=, the first one by default).
+# Answered from an index kept in memory by the worker, see shared/status.py: polling clients send back
+# the ETag in If-None-Match and get a 304 until a new relevé comes in.
+@app.function_name(name="current_status")
+@app.route(route="current_status")  # HTTP Trigger
+@metrics.invocation("current_status")
+def current_status(req: func.HttpRequest) -> func.HttpResponse:
+    from shared.azure_credential import get_azure_default_credential
+    from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+    from shared.reader import get_datalake_source
+    from shared.resources import load_resources
+    from shared.status import get_status_index, matches_etag
+
+    resources = load_resources()
+    dataset_name = req.params.get("dataset") or resources[0]["name"]
+    resource = next((resource for resource in resources if resource["name"] == dataset_name), None)
+    if resource is None:
+        return func.HttpResponse(f"unknown dataset {dataset_name}", status_code=404)
+
+    establishments = [name.strip() for name in req.params.get("establishment", "").split(",") if name.strip()]
+    regions = [name.strip() for name in req.params.get("region", "").split(",") if name.strip()]
 
-    filename_1 = 'Releve_horaire_urgences_7jours'
-    filename_2 = 'Releve_horaire_urgences_7jours_nbpers'
+    try:
+        index = get_status_index(
+            get_datalake_source(
+                get_azure_default_credential(),
+                os.environ.get("ADLS_RESOURCE_NAME"),
+                os.environ.get("ADLS_CONTAINER_NAME"),
+            ),
+            os.environ.get("ADLS_DIRECTORY_NAME_BRONZE"),
+            dataset_name,
+            establishment_column=resource.get("establishment_column", DEFAULT_ESTABLISHMENT_COLUMN),
+            watermark_column=resource.get("watermark_column", DEFAULT_WATERMARK_COLUMN),
+        )
+        body, etag = index.get_response(establishments, regions)
 
-    ingest_from_api(url_1, filename_1)
-    ingest_from_api(url_2, filename_2)
+    except Exception as e:
+        logging.exception("current status failed: %s", e)
+        metrics.mark_failed()
+        return func.HttpResponse(f"current status unavailable: {e}", status_code=500)
 
-    return 'true'
+    # clients revalidate every time, an unchanged status costs a 304 without a body
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if matches_etag(req.headers.get("If-None-Match"), etag):
+        return func.HttpResponse(status_code=304, headers=headers)
+
+    return func.HttpResponse(body, mimetype="application/json", headers=headers)
+
+@app.function_name(name="compact_bronze_daily")
+@app.schedule(schedule="0 30 5 * * *",
+              arg_name="mytimer")
+@metrics.invocation("compact_bronze_daily")
+def compact_bronze_daily(mytimer: func.TimerRequest) -> None:
+    from shared.runner import run_compaction
+
+    # 05:30 UTC, once the previous (UTC-4) partition day is finished
+    run_compaction()
 
 
 @app.function_name(name="api_blob_trigger")
 @app.blob_trigger(arg_name="myblob", path="msdocs-python-cloud-etl-news-source/{name}",
                   connection="AzureWebJobsStorage")
+@metrics.invocation("api_blob_trigger")
 def test_function(myblob: func.InputStream):
+    from shared.azure_credential import get_azure_default_credential
+    from shared.datalake import upload_chunks_to_datalake
+    from shared.json_stream import iter_json_array, iter_json_array_chunks, iter_ndjson_chunks
+    from shared.transform import iter_clean_documents
 
     logging.info("Python blob trigger function processed blob \nName: %s \nBlob Size: %s bytes",
                  myblob.name, myblob.length)
-                 
-    # read the blob content as a string.
-    search_results_blob_str = myblob.read()
 
-    # decode the string to Unicode
-    blob_json = search_results_blob_str.decode("utf-8")
+    # Output format: "json" (a JSON array, as before) or "ndjson" (a document per line)
+    output_format = os.environ.get("NEWS_OUTPUT_FORMAT", NEWS_OUTPUT_JSON)
 
-    # parse a valid JSON string and convert it into a Python dict
+    # parse the search results as they are read, clean them a batch at a time
+    # and append them to Data Lake as they are cleaned, so the blob is never held in memory
     try:
 
         # Get environment variables
@@ -171,22 +311,28 @@ def test_function(myblob: func.InputStream):
             "DATALAKE_GEN_2_DIRECTORY_NAME")
 
         # Get Data
-        data = json.loads(blob_json)
+        metrics.record("download", bytes_read=myblob.length or 0)
+        documents = metrics.iter_stage("download", iter_json_array(myblob))
 
         # Clean Data
-        new_data_dictionary = clean_documents(data)
+        new_documents = iter_clean_documents(documents)
 
         # Prepare to upload
-        json_str = json.dumps(new_data_dictionary)
         file_name = myblob.name.split("/")[1]
-        new_file_name = f"processed_{file_name}"
+        if output_format == NEWS_OUTPUT_NDJSON:
+            new_file_name = f"processed_{os.path.splitext(file_name)[0]}.ndjson"
+            chunks = iter_ndjson_chunks(new_documents)
+        else:
+            new_file_name = f"processed_{file_name}"
+            chunks = iter_json_array_chunks(new_documents)
 
         # Get authentication to Azure
         azure_default_credential = get_azure_default_credential()
 
-        # Upload to Data Lake
-        upload_to_datalake(azure_default_credential, datalake_account_name,
-                            datalake_container_name, datalake_directory_name, new_file_name, json_str)
+        # Upload to Data Lake, the documents are read and cleaned as the upload pulls them
+        with metrics.stage("upload"):
+            upload_chunks_to_datalake(azure_default_credential, datalake_account_name,
+                                      datalake_container_name, datalake_directory_name, new_file_name, chunks)
         logging.info(
             "Successfully uploaded to data lake, old: %s, new: %s", myblob.name, new_file_name
         )
@@ -194,3 +340,4 @@ def test_function(myblob: func.InputStream):
     except ValueError as err:
         logging.info(
             "Error converting %s to python dictionary: %s", myblob.name, err)
+        metrics.mark_failed()
@@ -0,0 +1,102 @@
+# ./scripts/backfill.py
+# Reprocess past days with shared/backfill.py: the bronze day partitions of a resource of resources.json,
+# cast to its schema again, or the extracts landed on each day, aggregated again by the cloud ETL.
+# The storage settings are read from the environment variables of the function app (local.settings.json).
+# Running the same command again resumes the backfill: only the days not completed yet are run.
+#
+#   cd AzureFunctionsApp
+#   python scripts/backfill.py bronze --resource Releve_horaire_urgences_7jours --start 2024-01-01 --end 2024-03-31
+#   python scripts/backfill.py cloudetl --start 2014-07-01 --end 2014-12-31 --workers 8
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.backfill import KIND_BRONZE, KIND_CLOUDETL, run_backfill  # noqa: E402
+from shared.cloudetl import LAYOUT_FLAT  # noqa: E402
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN  # noqa: E402
+from shared.resources import load_resources  # noqa: E402
+
+# Settings of the cloudetl function
+CLOUDETL_FILE_FORMAT = "parquet"
+CLOUDETL_FILE_PREFIX = "financial_demo"
+CLOUDETL_COLUMNS = ["segment", "country", "units_sold", "gross_sales", "date"]
+CLOUDETL_GROUPBY_COLUMNS = ["segment", "country", "sale_year", "sale_month"]
+
+
+def get_bronze_job(resource_name, start, end):
+    resources = {resource["name"]: resource for resource in load_resources()}
+    if resource_name not in resources:
+        raise SystemExit(f"unknown resource {resource_name}")
+    resource = resources[resource_name]
+
+    return {
+        "kind": KIND_BRONZE,
+        "start": start,
+        "end": end,
+        "datalake_account_name": os.environ["ADLS_RESOURCE_NAME"],
+        "datalake_container_name": os.environ["ADLS_CONTAINER_NAME"],
+        "datalake_directory_name": os.environ["ADLS_DIRECTORY_NAME_BRONZE"],
+        "dataset_name": resource["name"],
+        "schema": resource.get("schema", resource["name"]),
+        "establishment_column": resource.get("establishment_column", DEFAULT_ESTABLISHMENT_COLUMN),
+        "watermark_column": resource.get("watermark_column", DEFAULT_WATERMARK_COLUMN),
+    }
+
+
+# The extracts are archived once processed, under the name they landed with, in the layout of the ingest container.
+# Their copies are created when archived: in the flat layout, those of the archive container are picked
+# by the landing time kept on them
+def get_cloudetl_job(start, end, source_container):
+    archive_container = os.environ["ABS_CONTAINER_NAME_ARCHIVE"]
+    source_container = source_container or archive_container
+    return {
+        "kind": KIND_CLOUDETL,
+        "start": start,
+        "end": end,
+        "storage_account_url": f"https://{os.environ['ABS_RESOURCE_NAME']}.blob.core.windows.net/",
+        "source_container": source_container,
+        "archived": source_container == archive_container,
+        "layout": os.environ.get("ABS_INGEST_LAYOUT", LAYOUT_FLAT),
+        "datalake_account_name": os.environ["ADLS_RESOURCE_NAME"],
+        "datalake_container_name": os.environ["ADLS_CONTAINER_NAME"],
+        "dir_name": os.environ["ADLS_DIRECTORY_NAME"],
+        "file_format": CLOUDETL_FILE_FORMAT,
+        "file_prefix": CLOUDETL_FILE_PREFIX,
+        "columns": CLOUDETL_COLUMNS,
+        "groupby_columns": CLOUDETL_GROUPBY_COLUMNS,
+        "chunksize": int(os.environ.get("CLOUDETL_CHUNKSIZE", 0)) or None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kind", choices=[KIND_BRONZE, KIND_CLOUDETL])
+    parser.add_argument("--start", required=True, help="first day, YYYY-MM-DD")
+    parser.add_argument("--end", required=True, help="last day, YYYY-MM-DD, included")
+    parser.add_argument("--resource", help="resource of resources.json, for bronze")
+    parser.add_argument("--source-container", help="container of the landed extracts, for cloudetl "
+                        "(ABS_CONTAINER_NAME_ARCHIVE by default)")
+    parser.add_argument("--workers", type=int, help="days processed at the same time "
+                        "(BACKFILL_MAX_WORKERS, the number of CPUs by default)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.kind == KIND_BRONZE:
+        if not args.resource:
+            parser.error("bronze backfills need --resource")
+        job = get_bronze_job(args.resource, args.start, args.end)
+    else:
+        job = get_cloudetl_job(args.start, args.end, args.source_container)
+
+    result = run_backfill(job, max_workers=args.workers)
+    print(json.dumps(result, indent=2))
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
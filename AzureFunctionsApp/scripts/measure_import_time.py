@@ -0,0 +1,103 @@
+# ./scripts/measure_import_time.py
+# Measure the import time paid by a cold start: indexing function_app.py, then the first invocation
+# of each trigger importing its modules. Every measure runs in a fresh interpreter.
+#
+#   cd AzureFunctionsApp
+#   python scripts/measure_import_time.py --repeat 5
+#   python scripts/measure_import_time.py --top 15    # slowest modules of every step, from python -X importtime
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported by the first invocation of each trigger, as in function_app.py,
+# with the Key Vault and Queue SDKs imported by shared/clients.py when the trigger gets such a client
+TRIGGER_IMPORTS = {
+    "demo_relational_data_cloudetl": [
+        "shared.azure_credential", "shared.clients", "shared.cloudetl", "shared.sharded_etl",
+        "azure.keyvault.secrets", "azure.storage.queue",
+    ],
+    "cloudetl_shard": ["shared.azure_credential", "shared.clients", "shared.sharded_etl", "azure.storage.queue"],
+    "cloudetl_reduce": ["shared.azure_credential", "shared.clients", "shared.sharded_etl", "azure.storage.queue"],
+    "get_data_timed": ["shared.runner"],
+    "get_data_manual": ["shared.runner"],
+    "compact_bronze_daily": ["shared.runner"],
+    "current_status": [
+        "shared.azure_credential", "shared.delta", "shared.reader", "shared.resources", "shared.status",
+    ],
+    "api_blob_trigger": [
+        "shared.azure_credential", "shared.datalake", "shared.json_stream", "shared.transform",
+    ],
+}
+
+# Everything function_app.py imported when the functions were indexed, before the imports were deferred
+EAGER_IMPORTS = [
+    "azure.functions", "shared.cloudetl", "shared.clients", "shared.azure_credential", "shared.hash",
+    "shared.key_vault_secret", "shared.datalake", "shared.metrics", "shared.json_stream", "shared.transform",
+    "shared.runner", "shared.sharded_etl",
+]
+
+MEASURE = """
+import time
+start = time.perf_counter()
+{imports}
+print(time.perf_counter() - start)
+"""
+
+
+# Seconds taken by the imports, in a fresh interpreter, after the given modules are already imported
+def time_imports(modules, already_imported=(), importtime=False):
+    code = "\n".join(f"import {module}" for module in already_imported) + MEASURE.format(
+        imports="\n".join(f"import {module}" for module in modules))
+
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    result = subprocess.run(command, cwd=APP_DIR, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def median_ms(modules, already_imported, repeat):
+    return statistics.median(time_imports(modules, already_imported)[0] for _ in range(repeat)) * 1000
+
+
+# Slowest modules imported by a step, by cumulative time, from the -X importtime report
+def print_top_modules(modules, already_imported, top):
+    _, report = time_imports(modules, already_imported, importtime=True)
+    rows = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        rows.append((int(cumulative), name))
+
+    for cumulative, name in sorted(rows, reverse=True)[:top]:
+        print(f"    {cumulative / 1000:>8.1f} ms  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="also list the slowest modules of every step")
+    args = parser.parse_args()
+
+    eager_ms = median_ms(EAGER_IMPORTS, (), args.repeat)
+    index_ms = median_ms(["function_app"], (), args.repeat)
+
+    print(f'{"step":<44} {"median ms":>10}')
+    print(f'{"index, eager imports (before)":<44} {eager_ms:>10.1f}')
+    print(f'{"index function_app (deferred imports)":<44} {index_ms:>10.1f}')
+    if args.top:
+        print_top_modules(["function_app"], (), args.top)
+
+    for trigger, modules in TRIGGER_IMPORTS.items():
+        first_ms = median_ms(modules, ["function_app"], args.repeat)
+        print(f'{"first " + trigger + " invocation":<44} {first_ms:>10.1f}   '
+              f"cold start {index_ms + first_ms:.1f} ms, was {eager_ms:.1f} ms")
+        if args.top:
+            print_top_modules(modules, ["function_app"], args.top)
+
+
+if __name__ == "__main__":
+    main()
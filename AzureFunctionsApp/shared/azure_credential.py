@@ -1,13 +1,26 @@
 # ./shared/azure_credential.py
+import threading
+
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import DefaultAzureCredential
 
+# Credentials are reused by every invocation running on a warm worker,
+# DefaultAzureCredential caches its tokens and refreshes them when they expire
+_credentials = {}
+_credentials_lock = threading.Lock()
+
 
 # Get authentication with environment variables
-def get_azure_default_credential():
-    return DefaultAzureCredential(additionally_allowed_tenants=["*"])
+def get_azure_default_credential(**kwargs):
+    key = tuple(sorted(kwargs.items()))
+
+    with _credentials_lock:
+        if key not in _credentials:
+            _credentials[key] = DefaultAzureCredential(additionally_allowed_tenants=["*"], **kwargs)
+
+        return _credentials[key]
 
 
 # Get authentication with key
 def get_azure_key_credential(key):
-    return AzureKeyCredential(key)
\ No newline at end of file
+    return AzureKeyCredential(key)
@@ -0,0 +1,250 @@
+# ./shared/backfill.py
+import datetime
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from azure.storage.blob import BlobProperties
+
+from shared import metrics
+from shared.azure_credential import get_azure_default_credential
+from shared.clients import get_blob_service_client, get_datalake_account_url, get_datalake_service_client
+from shared.cloudetl import (
+    LAYOUT_FLAT,
+    ingest_relational_data,
+    list_landed_blob_names_by_day,
+    process_relational_data,
+    process_relational_data_in_chunks,
+    write_dataframe_to_datalake,
+)
+from shared.compaction import compact_day
+from shared.datalake import download_from_datalake, get_partition_now, upload_to_datalake
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.schema import get_schema
+
+# Reprocess past data over a range of days, one unit of work per day, on a process pool:
+# - bronze: the day partitions of a dataset are cast to its schema again, rewritten and indexed (see compact_day)
+# - cloudetl: the extracts landed on a day are aggregated again, found in the layout of the container
+#   (see ABS_INGEST_LAYOUT): under the YYYY/MM/DD/ prefix of the day, or in the flat layout created on the day,
+#   or for the archive container landed on the day, as recorded on their copy (see get_landed_date).
+#   The container is listed once by the coordinator, every day gets the names of its blobs
+# A checkpoint file records the days done, so that running the same backfill again only runs the others.
+# A day without input (a weekend, a gap) is recorded as done with no output, and reported as empty.
+# Every day writes to a name of its own, so a day run twice overwrites its previous output.
+
+KIND_BRONZE = "bronze"
+KIND_CLOUDETL = "cloudetl"
+
+# Directory, under the output directory, holding the checkpoint files
+BACKFILL_DIRECTORY_NAME = "_backfill"
+
+# Days processed at the same time, one per process
+DEFAULT_MAX_WORKERS = os.cpu_count() or 1
+
+
+# Days from start to end, both included
+def get_backfill_days(start, end):
+    start = datetime.date.fromisoformat(str(start))
+    end = datetime.date.fromisoformat(str(end))
+    if end < start:
+        raise ValueError(f"empty date range {start} - {end}")
+    return [start + datetime.timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+# Name of the output of a day of a cloud ETL backfill, the same on every run
+def get_backfill_file_name(file_prefix, day, file_format):
+    return f"{file_prefix}_{day.strftime('%Y%m%d')}.{file_format}"
+
+
+# The same job over the same range resumes from the same checkpoint
+def get_job_id(job):
+    name = job["dataset_name"] if job["kind"] == KIND_BRONZE else job["file_prefix"]
+    days = get_backfill_days(job["start"], job["end"])
+    return f"{job['kind']}_{name}_{days[0].strftime('%Y%m%d')}_{days[-1].strftime('%Y%m%d')}"
+
+
+def get_checkpoint_location(job):
+    directory_name = job["datalake_directory_name"] if job["kind"] == KIND_BRONZE else job["dir_name"]
+    return (
+        job["datalake_account_name"],
+        job["datalake_container_name"],
+        f"{directory_name}/{BACKFILL_DIRECTORY_NAME}",
+    )
+
+
+# Days done and failed of a job, empty when it never ran
+def load_checkpoint(azure_credential, job):
+    data = download_from_datalake(azure_credential, *get_checkpoint_location(job), f"{get_job_id(job)}.json")
+    if data is None:
+        return {"completed": {}, "failed": {}}
+    return json.loads(data)
+
+
+def save_checkpoint(azure_credential, job, checkpoint):
+    return upload_to_datalake(
+        azure_credential,
+        *get_checkpoint_location(job),
+        f"{get_job_id(job)}.json",
+        json.dumps(checkpoint, sort_keys=True),
+    )
+
+
+# Cast a day partition of a dataset to its schema again and rewrite its daily file.
+# Returns the path of the file, None when the dataset has no partition on the day
+def backfill_bronze_day(job, day):
+    daily_path = compact_day(
+        get_azure_default_credential(),
+        job["datalake_account_name"],
+        job["datalake_container_name"],
+        job["datalake_directory_name"],
+        job["dataset_name"],
+        day,
+        sort_columns=(
+            job.get("establishment_column", DEFAULT_ESTABLISHMENT_COLUMN),
+            job.get("watermark_column", DEFAULT_WATERMARK_COLUMN),
+        ),
+        schema=get_schema(job.get("schema", job["dataset_name"])),
+        rewrite=True,
+        watermark_column=job.get("watermark_column", DEFAULT_WATERMARK_COLUMN),
+    )
+    if daily_path is None:
+        logging.info("no partition of %s on %s", job["dataset_name"], day)
+
+    return daily_path
+
+
+# Aggregate the extracts landed on a day again, the blobs of blob_names, into the file of that day.
+# Returns the path of the file, None when no extract landed on the day
+def backfill_cloudetl_day(job, day, blob_names):
+    if not blob_names:
+        logging.info("no extracts landed on %s in %s", day, job["source_container"])
+        return None
+
+    azure_credential = get_azure_default_credential()
+    container_client = get_blob_service_client(
+        job["storage_account_url"], azure_credential).get_container_client(job["source_container"])
+    blob_file_list = [BlobProperties(name=blob_name) for blob_name in blob_names]
+
+    chunksize = job.get("chunksize")
+    if chunksize:
+        with metrics.stage("transform"):
+            df = process_relational_data_in_chunks(
+                container_client, blob_file_list, job["columns"], job["groupby_columns"], chunksize)
+    else:
+        with metrics.stage("download"):
+            df = ingest_relational_data(container_client, blob_file_list, job["columns"])
+        with metrics.stage("transform", rows=len(df)):
+            df = process_relational_data(df, job["columns"], job["groupby_columns"])
+
+    file_name = get_backfill_file_name(job["file_prefix"], day, job["file_format"])
+    with metrics.stage("upload"):
+        write_dataframe_to_datalake(
+            df,
+            get_datalake_service_client(get_datalake_account_url(job["datalake_account_name"]), azure_credential),
+            job["datalake_container_name"],
+            job["dir_name"],
+            file_name,
+        )
+
+    return f"{job['dir_name']}/{file_name}"
+
+
+# Names of the blobs of every day of a cloud ETL backfill, from one listing of its source container
+def plan_cloudetl_days(job, days, azure_credential):
+    container_client = get_blob_service_client(
+        job["storage_account_url"], azure_credential).get_container_client(job["source_container"])
+    blob_names = list_landed_blob_names_by_day(
+        container_client, days[0], days[-1], job.get("layout", LAYOUT_FLAT), archived=job.get("archived", False))
+    return {day.isoformat(): (blob_names.get(day, []),) for day in days}
+
+
+BACKFILL_TASKS = {
+    KIND_BRONZE: backfill_bronze_day,
+    KIND_CLOUDETL: backfill_cloudetl_day,
+}
+
+# Inputs of the days of a kind, listed by the coordinator and passed to the task of every day
+BACKFILL_PLANNERS = {
+    KIND_CLOUDETL: plan_cloudetl_days,
+}
+
+
+# Run the day of a job, in a process of the pool
+def run_backfill_day(job, day, *args):
+    with metrics.invocation(f"backfill_{job['kind']}"):
+        try:
+            return BACKFILL_TASKS[job["kind"]](job, datetime.date.fromisoformat(day), *args)
+        except Exception:
+            metrics.mark_failed()
+            raise
+
+
+# Reprocess the days of a job from start to end that its checkpoint does not hold yet, on a process pool.
+# job is a dict of the kind (KIND_BRONZE or KIND_CLOUDETL), the range and the settings of the kind,
+# see scripts/backfill.py. The checkpoint is saved as every day completes: an interrupted backfill
+# resumes with the days left, and the days that failed are run again by the next run.
+# Days without input are completed with None as their output.
+# initializer and initargs are run by every process of the pool before its first day.
+# Returns the days completed, empty (completed without input), failed and skipped
+def run_backfill(job, max_workers=None, azure_credential=None, initializer=None, initargs=()):
+    if job["kind"] not in BACKFILL_TASKS:
+        raise ValueError(f"unknown backfill kind {job['kind']}")
+
+    days = get_backfill_days(job["start"], job["end"])
+    if job["kind"] == KIND_BRONZE and days[-1] >= get_partition_now().date():
+        raise ValueError(f"{days[-1]} is not a finished day")
+
+    if max_workers is None:
+        max_workers = int(os.environ.get("BACKFILL_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    if azure_credential is None:
+        azure_credential = get_azure_default_credential()
+
+    checkpoint = load_checkpoint(azure_credential, job)
+    pending = [day.isoformat() for day in days if day.isoformat() not in checkpoint["completed"]]
+    checkpoint["failed"] = {}
+
+    logging.info(
+        "backfill %s: %s of %s days to run", get_job_id(job), len(pending), len(days)
+    )
+
+    completed = []
+    if pending:
+        planner = BACKFILL_PLANNERS.get(job["kind"])
+        day_args = {}
+        if planner is not None:
+            day_args = planner(job, [datetime.date.fromisoformat(day) for day in pending], azure_credential)
+
+        with ProcessPoolExecutor(
+            max_workers=max(1, min(max_workers, len(pending))), initializer=initializer, initargs=initargs
+        ) as executor:
+            futures = {executor.submit(run_backfill_day, job, day, *day_args.get(day, ())): day for day in pending}
+            for future in as_completed(futures):
+                day = futures[future]
+                try:
+                    checkpoint["completed"][day] = future.result()
+                    completed.append(day)
+                except Exception as e:
+                    logging.error("backfill of %s failed: %s", day, e)
+                    checkpoint["failed"][day] = str(e)
+
+                save_checkpoint(azure_credential, job, checkpoint)
+
+    failed = sorted(checkpoint["failed"])
+    empty = sorted(day for day in completed if checkpoint["completed"][day] is None)
+    logging.info(
+        "backfill %s: %s days completed, %s without input, %s failed %s",
+        get_job_id(job), len(completed), len(empty), len(failed), failed
+    )
+    if empty and len(empty) == len(completed):
+        logging.warning(
+            "backfill %s: no input on any of the days run, check the range and the layout", get_job_id(job)
+        )
+
+    return {
+        "job_id": get_job_id(job),
+        "completed": sorted(completed),
+        "empty": empty,
+        "failed": failed,
+        "skipped": len(days) - len(pending),
+    }
@@ -2,18 +2,15 @@
 import logging
 import os
 
-from azure.storage.blob import BlobServiceClient
+from shared.clients import get_blob_account_url, get_blob_service_client
 
 # Upload a pandas dataframe to Azure Blob Storage
 def upload_df_to_blob(azure_credential, account_name, container_name, blob_name, df):
 
     logging.info("upload_to_blob account_name=%s", account_name)
 
-    # Get the account URL
-    account_url = f"https://{account_name}.blob.core.windows.net"
-
-    # Create a client
-    blob_service_client = BlobServiceClient(account_url, credential=azure_credential)
+    # Get the client
+    blob_service_client = get_blob_service_client(get_blob_account_url(account_name), azure_credential)
 
     output_file_dest = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
 
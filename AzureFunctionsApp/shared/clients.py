@@ -0,0 +1,79 @@
+# ./shared/clients.py
+import threading
+
+from azure.storage.blob import BlobServiceClient
+from azure.storage.filedatalake import DataLakeServiceClient
+
+from shared.azure_credential import get_azure_default_credential
+
+# Service clients are cached per (client type, account url, credential) so that a warm
+# worker reuses their HTTP connection pool instead of paying TLS setup on every invocation.
+# Clients derived from them (file system, directory, container, blob clients) share that pool.
+# The Key Vault and Queue SDKs are only imported by the functions using them, off the cold start of the others.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(client_class, account_url, credential, queue_name=None, make_kwargs=None):
+    if credential is None:
+        credential = get_azure_default_credential()
+
+    # queue clients are bound to their queue
+    key = (client_class.__name__, account_url.rstrip("/"), credential, queue_name)
+
+    with _clients_lock:
+        if key not in _clients:
+            # keyword arguments only needed to build the client are made on a cache miss
+            kwargs = make_kwargs() if make_kwargs else {}
+            if queue_name is not None:
+                kwargs["queue_name"] = queue_name
+            _clients[key] = client_class(account_url, credential=credential, **kwargs)
+
+        return _clients[key]
+
+
+# Get the Data Lake service client of an account url
+def get_datalake_service_client(account_url, credential=None):
+    return _get_client(DataLakeServiceClient, account_url, credential)
+
+
+# Get the Blob Storage service client of an account url
+def get_blob_service_client(account_url, credential=None):
+    return _get_client(BlobServiceClient, account_url, credential)
+
+
+# Base64 message policies, the encoding the queue trigger expects
+def _queue_message_policies():
+    from azure.storage.queue import TextBase64DecodePolicy, TextBase64EncodePolicy
+
+    return {
+        "message_encode_policy": TextBase64EncodePolicy(),
+        "message_decode_policy": TextBase64DecodePolicy(),
+    }
+
+
+# Get the Storage Queue client of a queue, with the base64 messages the queue trigger expects
+def get_queue_client(account_url, queue_name, credential=None):
+    from azure.storage.queue import QueueClient
+
+    return _get_client(QueueClient, account_url, credential, queue_name=queue_name, make_kwargs=_queue_message_policies)
+
+
+# Get the Key Vault secret client of a vault url
+def get_secret_client(vault_url, credential=None):
+    from azure.keyvault.secrets import SecretClient
+
+    return _get_client(SecretClient, vault_url, credential)
+
+
+# Account urls built from resource names
+def get_datalake_account_url(account_name):
+    return f"https://{account_name}.dfs.core.windows.net"
+
+
+def get_blob_account_url(account_name):
+    return f"https://{account_name}.blob.core.windows.net"
+
+
+def get_queue_account_url(account_name):
+    return f"https://{account_name}.queue.core.windows.net"
@@ -1,28 +1,179 @@
+import io
+import logging
+import os
+import time
 import pandas as pd
-from io import StringIO
+import pyarrow as pa
+import pyarrow.compute as pc
+import numpy as np
+from pandas.api.types import is_integer_dtype, is_numeric_dtype
+from pandas.tseries.api import guess_datetime_format
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from azure.storage.blob import StandardBlobTier
+from azure.storage.blob import BlobPrefix, StandardBlobTier
 
-def return_blob_files(container_client, arg_date, std_date_format):
+from shared import metrics
+from shared.parquet import get_buffer_size, write_parquet
+
+# Maximum number of blobs downloaded and parsed at the same time
+DEFAULT_DOWNLOAD_WORKERS = 8
+
+# Bytes requested from the blob stream per read
+DOWNLOAD_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Maximum number of archive copies started or polled at the same time
+DEFAULT_ARCHIVE_WORKERS = 16
+
+# Seconds between two polls of the pending archive copies, and before giving up on them
+ARCHIVE_POLL_INTERVAL = 1
+ARCHIVE_COPY_TIMEOUT = 60
+
+# Maximum number of sub-requests of a blob batch
+DELETE_BATCH_SIZE = 256
+
+# Aggregated columns: output name -> summed column
+AGGREGATIONS = {'total_units_sold': 'units_sold', 'total_gross_sales': 'gross_sales'}
+
+# Suffix of the compensation columns of a partial aggregation
+COMPENSATION_SUFFIX = '__compensation'
+
+# Ingest container layouts: blobs landed under YYYY/MM/DD/ prefixes, or all at the root
+LAYOUT_DATE_PREFIX = 'date_prefix'
+LAYOUT_FLAT = 'flat'
+
+# Metadata of an archived blob holding the time it landed in the ingest container (its creation time there):
+# the archive copy is created when the blob is archived
+LANDED_AT_METADATA = 'landed_at'
+
+# Name under which a file lands in the ingest container: YYYY/MM/DD/<file_name>
+def get_landing_blob_name(file_name, landed_date=None):
+    landed_date = landed_date or datetime.utcnow().date()
+    return f'{landed_date.strftime("%Y/%m/%d")}/{file_name}'
+
+
+# List the YYYY/MM/DD/ prefixes between start_date and end_date, walking one level at a time
+def list_date_prefixes(container_client, start_date, end_date):
+    def walk(prefix):
+        metrics.record('list', http_calls=1)
+        return [item.name for item in container_client.walk_blobs(name_starts_with=prefix, delimiter='/')
+                if isinstance(item, BlobPrefix)]
+
+    for year_prefix in walk(''):
+        if not year_prefix[:-1].isdigit() or not start_date.year <= int(year_prefix[:-1]) <= end_date.year:
+            continue
+
+        for month_prefix in walk(year_prefix):
+            for day_prefix in walk(month_prefix):
+                try:
+                    day = datetime.strptime(day_prefix, '%Y/%m/%d/').date()
+                except ValueError:
+                    continue
+
+                if start_date <= day <= end_date:
+                    yield day_prefix
+
+
+def return_blob_files(container_client, arg_date, std_date_format, layout=LAYOUT_FLAT, end_date=None):
     start_date = datetime.strptime(
         arg_date, std_date_format).date() - timedelta(days=1)
 
-    blob_files = [blob for blob in container_client.list_blobs(
-    ) if blob.creation_time.date() >= start_date]
+    return list_landed_blob_files(container_client, start_date, end_date, layout)
+
+
+# List the blobs landed from start_date to end_date (today when None), both included:
+# under their YYYY/MM/DD/ prefixes, or by creation time in the flat layout
+def list_landed_blob_files(container_client, start_date, end_date=None, layout=LAYOUT_FLAT):
+    with metrics.stage('list'):
+        if layout == LAYOUT_DATE_PREFIX:
+            # Only list the day partitions of the requested range
+            end_date = end_date or datetime.utcnow().date()
+            day_prefixes = list(list_date_prefixes(container_client, start_date, end_date))
+            metrics.record('list', http_calls=len(day_prefixes))
+            return [blob for day_prefix in day_prefixes
+                    for blob in container_client.list_blobs(name_starts_with=day_prefix)]
+
+        metrics.record('list', http_calls=1)
+        blob_files = [blob for blob in container_client.list_blobs(
+        ) if blob.creation_time.date() >= start_date
+            and (end_date is None or blob.creation_time.date() <= end_date)]
 
     return blob_files
 
 
-def read_csv_to_dataframe(container_client, filename, file_delimiter=','):
+# Day a blob of the flat layout landed on: its creation time, or for an archived blob the landing time
+# kept on its copy (LANDED_AT_METADATA). Copies archived before it was kept fall back to their creation time.
+def get_landed_date(blob, archived=False):
+    landed_at = (blob.metadata or {}).get(LANDED_AT_METADATA) if archived else None
+    if landed_at is None:
+        return blob.creation_time.date()
+    return datetime.fromisoformat(landed_at).date()
+
+
+# List the blobs landed from start_date to end_date, both included, once for the whole range,
+# as {day: blob names}. archived dates the blobs of the flat layout by get_landed_date(archived=True)
+def list_landed_blob_names_by_day(container_client, start_date, end_date, layout=LAYOUT_FLAT, archived=False):
+    blob_names = {}
+    if layout == LAYOUT_DATE_PREFIX:
+        for blob in list_landed_blob_files(container_client, start_date, end_date, layout):
+            day = datetime.strptime(blob.name[:len('YYYY/MM/DD')], '%Y/%m/%d').date()
+            blob_names.setdefault(day, []).append(blob.name)
+        return blob_names
+
+    undated = 0
+    with metrics.stage('list', http_calls=1):
+        for blob in container_client.list_blobs(include=['metadata'] if archived else None):
+            day = get_landed_date(blob, archived)
+            if not start_date <= day <= end_date:
+                continue
+
+            blob_names.setdefault(day, []).append(blob.name)
+            if archived and LANDED_AT_METADATA not in (blob.metadata or {}):
+                undated += 1
+
+    if undated:
+        logging.warning('%s archived blobs have no %s metadata, dated by the creation time of their copy',
+                        undated, LANDED_AT_METADATA)
+
+    return blob_names
+
+
+class BlobStreamReader(io.RawIOBase):
+    # Raw byte stream over a blob download, read chunk by chunk
+    def __init__(self, blob_download):
+        self.blob_download = blob_download
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.blob_download.read(len(buffer))
+        buffer[:len(data)] = data
+        metrics.record('download', bytes_read=len(data))
+        return len(data)
+
+
+# Clean a column name for easy consumption: ' Gross Sales ' -> 'gross_sales'
+def clean_column_name(column_name):
+    return column_name.strip().lower().replace(' ', '_').replace('(', '').replace(')', '')
+
+
+# Read a csv blob into a DataFrame, or into an iterator of DataFrames of chunksize rows
+def read_csv_to_dataframe(container_client, filename, file_delimiter=',', columns=None, chunksize=None):
     blob_client = container_client.get_blob_client(blob=filename)
 
     # Retrieve extract blob file
     blob_download = blob_client.download_blob()
+    metrics.record('download', http_calls=1)
+
+    # Only parse the columns relevant for analysis
+    usecols = None
+    if columns is not None:
+        usecols = lambda column_name: clean_column_name(column_name) in columns
 
-    # Read blob file into DataFrame
-    blob_data = StringIO(blob_download.content_as_text())
-    df = pd.read_csv(blob_data, delimiter=file_delimiter)
+    # Parse the blob bytes while they are downloaded, without decoding the whole file to text
+    blob_data = io.BufferedReader(BlobStreamReader(blob_download), buffer_size=DOWNLOAD_BUFFER_SIZE)
+    df = pd.read_csv(blob_data, delimiter=file_delimiter, usecols=usecols, chunksize=chunksize)
     return df
 
 
@@ -33,83 +184,370 @@ def write_dataframe_to_datalake(df, datalake_service_client, filesystem_name, di
     file_client = datalake_service_client.get_file_client(
         filesystem_name, file_path)
 
-    processed_df = df.to_parquet(index=False)
+    processed_df = write_parquet(df)
+    size = get_buffer_size(processed_df)
 
     file_client.upload_data(
-        data=processed_df, overwrite=True, length=len(processed_df))
+        data=processed_df, overwrite=True, length=size)
 
-    file_client.flush_data(len(processed_df))
+    file_client.flush_data(size)
+    metrics.record('upload', http_calls=2, bytes_written=size, rows=len(df))
 
     return True
 
 
-def archive_cooltier_blob_file(blob_service_client, storage_account_url, source_container, archive_container, blob_list):
+# Start the server-side copy of a blob to the archive container, in the 'Cool' access tier.
+# The creation time of the source, when known, is kept as the landing time of the copy
+def start_archive_copy(blob_service_client, storage_account_url, source_container, archive_container, blob_name,
+                       landed_at=None):
+    source_blob_url = f'{storage_account_url}{source_container}/{blob_name}'
+
+    archive_blob_client = blob_service_client.get_blob_client(
+        archive_container, blob_name)
+
+    metadata = {LANDED_AT_METADATA: landed_at.isoformat()} if landed_at is not None else None
+
+    metrics.record('archive', http_calls=1)
+    try:
+        copy = archive_blob_client.start_copy_from_url(
+            source_url=source_blob_url, metadata=metadata, standard_blob_tier=StandardBlobTier.Cool)
+    except Exception as e:
+        logging.error('archive copy of %s failed to start: %s', blob_name, e)
+        return 'failed'
+
+    return copy.get('copy_status', 'pending')
+
+
+# Get the status of the archive copy of a blob
+def get_archive_copy_status(blob_service_client, archive_container, blob_name):
+    metrics.record('archive', http_calls=1)
+    try:
+        properties = blob_service_client.get_blob_client(
+            archive_container, blob_name).get_blob_properties()
+    except Exception as e:
+        logging.warning('archive copy status of %s unavailable: %s', blob_name, e)
+        return 'pending'
+
+    return properties.copy.status or 'pending'
+
+
+# Copy blobs to the archive container and delete the sources whose copy succeeded
+# Returns the outcome of every blob: archived, copy_failed, copy_pending or delete_failed
+def archive_cooltier_blob_file(blob_service_client, storage_account_url, source_container, archive_container, blob_list,
+                               max_workers=None, poll_interval=ARCHIVE_POLL_INTERVAL, timeout=ARCHIVE_COPY_TIMEOUT):
+    if max_workers is None:
+        max_workers = int(os.environ.get("CLOUDETL_ARCHIVE_WORKERS", DEFAULT_ARCHIVE_WORKERS))
+
+    blob_names = [blob.name for blob in blob_list]
+    if not blob_names:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Issue the server-side copies concurrently
+        copy_status = dict(zip(blob_names, executor.map(
+            metrics.bind(lambda blob: start_archive_copy(
+                blob_service_client, storage_account_url, source_container, archive_container, blob.name,
+                getattr(blob, 'creation_time', None))),
+            blob_list)))
+
+        # Poll the pending copies, one concurrent batch of status requests per round
+        deadline = time.monotonic() + timeout
+        pending = [blob_name for blob_name, status in copy_status.items() if status == 'pending']
+        while pending and time.monotonic() < deadline:
+            time.sleep(poll_interval)
+            copy_status.update(zip(pending, executor.map(
+                metrics.bind(lambda blob_name: get_archive_copy_status(
+                    blob_service_client, archive_container, blob_name)),
+                pending)))
+            pending = [blob_name for blob_name in pending if copy_status[blob_name] == 'pending']
+
+    outcomes = {blob_name: 'archived' if status == 'success' else
+                'copy_pending' if status == 'pending' else 'copy_failed'
+                for blob_name, status in copy_status.items()}
+
+    # Delete only the sources whose copy succeeded, with batch deletes
+    copied = [blob_name for blob_name, outcome in outcomes.items() if outcome == 'archived']
+    source_container_client = blob_service_client.get_container_client(source_container)
+    for start in range(0, len(copied), DELETE_BATCH_SIZE):
+        batch = copied[start:start + DELETE_BATCH_SIZE]
+        metrics.record('archive', http_calls=1)
+        try:
+            responses = source_container_client.delete_blobs(
+                *batch, delete_snapshots='include', raise_on_any_failure=False)
+            for blob_name, response in zip(batch, responses):
+                if response.status_code not in (200, 202, 404):
+                    outcomes[blob_name] = 'delete_failed'
+        except Exception as e:
+            logging.error('batch delete of %s source blobs failed: %s', len(batch), e)
+            outcomes.update((blob_name, 'delete_failed') for blob_name in batch)
+
+    not_archived = {blob_name: outcome for blob_name, outcome in outcomes.items() if outcome != 'archived'}
+    logging.info('archived %s of %s blobs, not archived: %s',
+                 len(outcomes) - len(not_archived), len(outcomes), not_archived)
+
+    return outcomes
+
+
+def ingest_relational_data(container_client, blob_file_list, columns=None, max_workers=None):
+    if max_workers is None:
+        max_workers = int(os.environ.get("CLOUDETL_DOWNLOAD_WORKERS", DEFAULT_DOWNLOAD_WORKERS))
+
+    # Download and parse the blobs on a bounded thread pool, keeping the list order
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        frames = list(executor.map(
+            metrics.bind(lambda blob: read_csv_to_dataframe(
+                container_client=container_client, filename=blob.name, columns=columns)),
+            blob_file_list))
+
+    df = pd.concat(frames, ignore_index=True)
+    metrics.record('download', rows=len(df))
 
-    for blob in blob_list:
-        blob_name = blob.name
-        source_blob_url = f'{storage_account_url}{source_container}/{blob_name}'
-
-        # Copy source blob file to archive container and change blob access tier to 'Cool'
-        archive_blob_client = blob_service_client.get_blob_client(
-            archive_container, blob_name)
+    return df
 
-        archive_blob_client.start_copy_from_url(
-            source_url=source_blob_url, standard_blob_tier=StandardBlobTier.Cool)
 
-        (blob_service_client.get_blob_client(source_container,
-         blob_name)).delete_blob(delete_snapshots='include')
+# Strip every distinct value once, extract columns repeat a handful of values
+def strip_strings(series):
+    codes, uniques = pd.factorize(series)
+    if (codes == -1).any():
+        return series.str.strip()
+    return pd.Series(uniques.str.strip().take(codes), index=series.index, name=series.name)
 
-    return True
 
+# Parse '$1,234.50' strings to floats with arrow string kernels, pandas string ops as the fallback
+def parse_currency(series):
+    if is_numeric_dtype(series):
+        return series.astype(float)
 
-def ingest_relational_data(container_client, blob_file_list):
-    df = pd.concat([read_csv_to_dataframe(container_client=container_client,
-                   filename=blob_name.name) for blob_name in blob_file_list], ignore_index=True)
+    try:
+        values = pa.array(series, type=pa.string())
+        values = pc.utf8_trim_whitespace(pc.replace_substring(pc.replace_substring(values, '$', ''), ',', ''))
+        return pd.Series(
+            pc.cast(values, pa.float64()).to_numpy(zero_copy_only=False), index=series.index, name=series.name)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return series.str.replace('$', '', regex=False).str.replace(',', '', regex=False).astype(float)
 
-    return df
 
+# Guess the date format once, from the first non empty value
+def guess_date_format(date_series):
+    first_valid_index = date_series.first_valid_index()
+    if first_valid_index is None:
+        return None
+    return guess_datetime_format(str(date_series.loc[first_valid_index]))
 
-def process_relational_data(df, columns, groupby_columns):
-    # Remove leading and trailing whitespace in df column names
-    processed_df = df.rename(columns=lambda x: x.strip())
 
-    # Clean column names for easy consumption
-    processed_df.columns = processed_df.columns.str.strip()
-    processed_df.columns = processed_df.columns.str.lower()
-    processed_df.columns = processed_df.columns.str.replace(' ', '_')
-    processed_df.columns = processed_df.columns.str.replace('(', '')
-    processed_df.columns = processed_df.columns.str.replace(')', '')
+# Clean, filter and type the relevant columns, and add the dateparts used to aggregate
+# Returns the DataFrame and the date format used to parse the dates
+def prepare_relational_data(df, columns, date_format=None):
+    # Clean column names for easy consumption, in a single pass over the names
+    processed_df = df.rename(columns=clean_column_name)
 
     # Filter DataFrame (df) columns
     processed_df = processed_df.loc[:, columns]
 
     # Filter out all empty rows, if they exist.
-    processed_df.dropna(inplace=True)
+    processed_df = processed_df.dropna()
 
-    # Remove leading and trailing whitespace for all string values in df
-    df_obj_cols = processed_df.select_dtypes(['object'])
-    processed_df[df_obj_cols.columns] = df_obj_cols.apply(
-        lambda x: x.str.strip())
+    # Remove leading and trailing whitespace for all string values in df,
+    # gross_sales is parsed as a float below, which ignores surrounding whitespace
+    for column in processed_df.select_dtypes(['object']).columns:
+        if column != 'gross_sales':
+            processed_df[column] = strip_strings(processed_df[column])
 
-    # Convert column to datetime: attempt to infer date format, return NA where conversion fails.
+    # Convert column to datetime with an explicit (or guessed once) format, return NA where conversion fails.
+    if date_format is None:
+        date_format = guess_date_format(processed_df['date'])
     processed_df['date'] = pd.to_datetime(
-        processed_df['date'], infer_datetime_format=True, errors='coerce')
+        processed_df['date'], format=date_format, errors='coerce', cache=True)
 
     # Convert object/string to numeric and handle special characters for each currency column
-    processed_df['gross_sales'] = processed_df['gross_sales'].replace(
-        {'\$': '', ',': ''}, regex=True).astype(float)
+    processed_df['gross_sales'] = parse_currency(processed_df['gross_sales'])
 
     # Capture dateparts (year and month) in new DataFrame columns
-    processed_df['sale_year'] = pd.DatetimeIndex(processed_df['date']).year
-    processed_df['sale_month'] = pd.DatetimeIndex(processed_df['date']).month
+    processed_df['sale_year'] = processed_df['date'].dt.year
+    processed_df['sale_month'] = processed_df['date'].dt.month
+
+    return processed_df, date_format
+
+
+def process_relational_data(df, columns, groupby_columns, date_format=None):
+    processed_df, _ = prepare_relational_data(df, columns, date_format)
 
-    # Get Gross Sales per Segment, Country, Sale Year, and Sale Month
-    processed_df = processed_df.sort_values(by=['sale_year', 'sale_month']).groupby(
-        groupby_columns, as_index=False).agg(total_units_sold=('units_sold', sum), total_gross_sales=('gross_sales', sum))
+    # Get Gross Sales per Segment, Country, Sale Year, and Sale Month, groupby already sorts the group keys
+    processed_df = processed_df.groupby(
+        groupby_columns, as_index=False).agg(**{name: (column, 'sum') for name, column in AGGREGATIONS.items()})
 
     return processed_df
 
 
+# Continue the compensated (Kahan) sum of a group over its values, one step per value in row order,
+# as pandas groupby sum does. NaN values are skipped, the compensation is reset when it is NaN (infinities).
+# Returns the sum and the compensation
+def continue_group_sum(values, total, compensation):
+    for value in values:
+        if value != value:
+            continue
+        y = value - compensation
+        t = total + y
+        compensation = t - total - y
+        if compensation != compensation:
+            compensation = 0.0
+        total = t
+    return total, compensation
+
+
+class GroupSumAccumulator:
+    # Per group sums carried across chunks, memory is bounded by the number of groups.
+    # The sums continue the compensated (Kahan) summation of pandas groupby sum in row order,
+    # so the result is the one process_relational_data gives on the concatenated chunks.
+    # Integer columns are summed per chunk by pandas: their sums are exact, as long as every chunk is integer.
+    def __init__(self, groupby_columns, aggregations):
+        self.groupby_columns = groupby_columns
+        self.aggregations = aggregations
+        self.group_ids = {}
+        self.keys_df = None
+        self.sums = {name: np.zeros(0) for name in aggregations}
+        self.compensations = {name: np.zeros(0) for name in aggregations}
+        self.integer_columns = {name: True for name in aggregations}
+
+    def _get_group_ids(self, keys):
+        for key in keys:
+            if key not in self.group_ids:
+                self.group_ids[key] = len(self.group_ids)
+
+        n_groups = len(self.group_ids)
+        for name in self.aggregations:
+            missing = n_groups - len(self.sums[name])
+            if missing:
+                self.sums[name] = np.concatenate([self.sums[name], np.zeros(missing)])
+                self.compensations[name] = np.concatenate([self.compensations[name], np.zeros(missing)])
+
+        return np.array([self.group_ids[key] for key in keys], dtype=np.intp)
+
+    def add(self, df):
+        for name, column in self.aggregations.items():
+            self.integer_columns[name] &= is_integer_dtype(df[column])
+
+        grouped = df.groupby(self.groupby_columns, sort=False)
+        sums_df = grouped.agg(**{name: (column, 'sum') for name, column in self.aggregations.items()})
+
+        # group keys in first seen order, as built by groupby
+        chunk_keys_df = sums_df.index.to_frame(index=False)
+
+        # keep the key dtypes pandas would give the concatenated chunks
+        self.keys_df = chunk_keys_df if self.keys_df is None else pd.concat(
+            [self.keys_df, chunk_keys_df], ignore_index=True).drop_duplicates(ignore_index=True)
+
+        if sums_df.empty:
+            return
+
+        ids = self._get_group_ids(list(chunk_keys_df.itertuples(index=False, name=None)))
+
+        # rows of the chunk ordered by group, each group keeping the order of its rows
+        codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.intp)
+        rows = np.argsort(codes, kind='stable')
+        rows = rows[codes[rows] >= 0]
+        bounds = np.flatnonzero(np.diff(codes[rows])) + 1
+
+        for name, column in self.aggregations.items():
+            sums = self.sums[name]
+            if self.integer_columns[name]:
+                # integer sums are exact, the compensations stay zero
+                sums[ids] += sums_df[name].to_numpy(dtype=np.float64)
+                continue
+
+            compensations = self.compensations[name]
+            values = df[column].to_numpy(dtype=np.float64)[rows]
+            for group_rows, group_values in zip(np.split(codes[rows], bounds), np.split(values, bounds)):
+                group_id = ids[group_rows[0]]
+                sums[group_id], compensations[group_id] = continue_group_sum(
+                    group_values.tolist(), float(sums[group_id]), float(compensations[group_id]))
+
+    # One compensated summation step, ids are distinct, used to merge partials
+    def _add_values(self, name, ids, values):
+        not_na = ~np.isnan(values)
+        ids = ids[not_na]
+        values = values[not_na]
+
+        sums = self.sums[name]
+        compensations = self.compensations[name]
+
+        y = values - compensations[ids]
+        t = sums[ids] + y
+        compensation = t - sums[ids] - y
+        compensation[np.isnan(compensation)] = 0
+        compensations[ids] = compensation
+        sums[ids] = t
+
+    # Per group sums and compensations, to be merged by another accumulator.
+    # The integer flags of the aggregations are kept in the attrs of the DataFrame.
+    def to_partial(self):
+        if self.keys_df is None:
+            partial_df = pd.DataFrame(columns=self.groupby_columns)
+        else:
+            partial_df = self.keys_df.iloc[:len(self.group_ids)].reset_index(drop=True)
+
+        for name in self.aggregations:
+            partial_df[name] = self.sums[name]
+            partial_df[f'{name}{COMPENSATION_SUFFIX}'] = self.compensations[name]
+
+        partial_df.attrs['integer_columns'] = dict(self.integer_columns)
+        return partial_df
+
+    # Add the sums of a partial with one compensated step per group. Partials start their sums from zero,
+    # so the merged sums are within rounding of, not bit-identical to, one sum over every row
+    def merge(self, partial_df):
+        for name, is_integer in partial_df.attrs.get('integer_columns', {}).items():
+            self.integer_columns[name] &= is_integer
+
+        if partial_df.empty:
+            return
+
+        keys_df = partial_df[self.groupby_columns]
+        self.keys_df = keys_df if self.keys_df is None else pd.concat(
+            [self.keys_df, keys_df], ignore_index=True).drop_duplicates(ignore_index=True)
+
+        ids = self._get_group_ids(list(keys_df.itertuples(index=False, name=None)))
+        for name in self.aggregations:
+            # the partial sum is off by its compensation
+            self._add_values(name, ids, partial_df[name].to_numpy(dtype=np.float64))
+            self._add_values(name, ids, -partial_df[f'{name}{COMPENSATION_SUFFIX}'].to_numpy(dtype=np.float64))
+
+    def result(self):
+        if self.keys_df is None:
+            return pd.DataFrame(columns=self.groupby_columns + list(self.aggregations))
+
+        # keys_df rows are in group id order
+        result_df = self.keys_df.iloc[:len(self.group_ids)].copy()
+        for name in self.aggregations:
+            result_df[name] = self.sums[name].astype(np.int64) if self.integer_columns[name] else self.sums[name]
+
+        return result_df.sort_values(self.groupby_columns, kind='mergesort', ignore_index=True)
+
+
+# Aggregate the blobs chunk by chunk into an accumulator, without holding the concatenated input in memory
+def accumulate_relational_data(container_client, blob_file_list, columns, groupby_columns, chunksize, date_format=None):
+    accumulator = GroupSumAccumulator(groupby_columns, AGGREGATIONS)
+
+    for blob in blob_file_list:
+        for chunk in read_csv_to_dataframe(
+                container_client=container_client, filename=blob.name, columns=columns, chunksize=chunksize):
+            metrics.record('download', rows=len(chunk))
+            processed_chunk, chunk_date_format = prepare_relational_data(chunk, columns, date_format)
+
+            # the format guessed on the first dates is used for the following chunks
+            if date_format is None and not processed_chunk.empty:
+                date_format = chunk_date_format
+
+            accumulator.add(processed_chunk)
+
+    return accumulator
+
+
+def process_relational_data_in_chunks(container_client, blob_file_list, columns, groupby_columns, chunksize, date_format=None):
+    return accumulate_relational_data(
+        container_client, blob_file_list, columns, groupby_columns, chunksize, date_format).result()
+
+
 def load_relational_data(processed_df, datalake_service_client, filesystem_name, dir_name, file_format, file_prefix):
     now = datetime.today().strftime("%Y%m%d_%H%M%S")
     processed_filename = f'{file_prefix}_{now}.{file_format}'
@@ -118,12 +556,23 @@ def load_relational_data(processed_df, datalake_service_client, filesystem_name,
     return True
 
 
-def run_cloud_etl(service_client, storage_account_url, source_container, archive_container, source_container_client, blob_file_list, columns, groupby_columns, datalake_service_client, filesystem_name, dir_name, file_format, file_prefix):
-    df = ingest_relational_data(source_container_client, blob_file_list)
-    df = process_relational_data(df, columns, groupby_columns)
-    result = load_relational_data(
-        df, datalake_service_client, filesystem_name, dir_name, file_format, file_prefix)
-    result = archive_cooltier_blob_file(
-        service_client, storage_account_url, source_container, archive_container, blob_file_list)
+# chunksize switches to the bounded-memory mode, aggregating chunksize rows at a time
+# (the download is then interleaved with the transform, and timed with it)
+def run_cloud_etl(service_client, storage_account_url, source_container, archive_container, source_container_client, blob_file_list, columns, groupby_columns, datalake_service_client, filesystem_name, dir_name, file_format, file_prefix, chunksize=None):
+    if chunksize:
+        with metrics.stage('transform'):
+            df = process_relational_data_in_chunks(
+                source_container_client, blob_file_list, columns, groupby_columns, chunksize)
+    else:
+        with metrics.stage('download'):
+            df = ingest_relational_data(source_container_client, blob_file_list, columns)
+        with metrics.stage('transform', rows=len(df)):
+            df = process_relational_data(df, columns, groupby_columns)
+    with metrics.stage('upload'):
+        result = load_relational_data(
+            df, datalake_service_client, filesystem_name, dir_name, file_format, file_prefix)
+    with metrics.stage('archive'):
+        result = archive_cooltier_blob_file(
+            service_client, storage_account_url, source_container, archive_container, blob_file_list)
 
     return result
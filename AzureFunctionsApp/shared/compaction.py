@@ -0,0 +1,154 @@
+# ./shared/compaction.py
+import json
+import logging
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from azure.core.exceptions import ResourceNotFoundError
+
+from shared import metrics
+from shared.clients import get_datalake_account_url, get_datalake_service_client
+from shared.datalake import get_partition_now, get_partition_path
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.parquet import get_buffer_size, write_parquet
+from shared.schema import apply_schema
+from shared.watermark_index import get_watermark_range, record_watermarks
+
+# Name of the compacted file of a day partition
+DAILY_FILE_NAME = "daily.parquet"
+
+# Parquet key/value metadata listing the hourly files merged into the daily file
+COMPACTED_FROM_KEY = b"compacted_from"
+
+# Rows per parquet row group of the daily file
+DAILY_ROW_GROUP_SIZE = 128 * 1024
+
+
+# Read a parquet file of the Data Lake into an arrow table
+def read_parquet_file(file_system_client, file_path):
+    data = file_system_client.get_file_client(file_path).download_file().readall()
+    metrics.record("download", http_calls=1, bytes_read=len(data))
+    return pq.read_table(pa.BufferReader(data))
+
+
+# Get the hourly files already merged into the daily file of a partition
+def get_compacted_from(table):
+    metadata = table.schema.metadata or {}
+    return json.loads(metadata.get(COMPACTED_FROM_KEY, b"[]"))
+
+
+# Merge the hourly parquet files of a finished day into one sorted daily file, cast to schema when given
+# Safe to rerun: the daily file records which hourly files it already contains,
+# and hourly files are deleted only after the daily file is in place.
+# rewrite writes the daily file again even when no hourly file is pending, e.g. to cast it to a new schema.
+# watermark_column records the update times of the daily file in the watermark index of the dataset,
+# in place of the hourly files of the day, so that the partitions written before the index are indexed once
+# compacted again. A daily file that is not indexed yet, e.g. after a run stopped before indexing it, is indexed
+# even when no hourly file is pending.
+def compact_day(
+    azure_credential,
+    datalake_account_name,
+    datalake_container_name,
+    datalake_directory_name,
+    dataset_name,
+    day,
+    sort_columns=(DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN),
+    schema=None,
+    rewrite=False,
+    watermark_column=None,
+):
+    if day >= get_partition_now().date():
+        raise ValueError(f"{day} is not a finished day")
+
+    # Get the file system client
+    file_system_client = get_datalake_service_client(
+        get_datalake_account_url(datalake_account_name), azure_credential
+    ).get_file_system_client(file_system=datalake_container_name)
+
+    partition_path = get_partition_path(datalake_directory_name, dataset_name, day)
+    daily_path = f"{partition_path}/{DAILY_FILE_NAME}"
+
+    # List the files of the day partition
+    try:
+        with metrics.stage("list", http_calls=1):
+            file_names = [
+                path.name.rsplit("/", 1)[-1]
+                for path in file_system_client.get_paths(path=partition_path, recursive=False)
+                if not path.is_directory and path.name.endswith(".parquet")
+            ]
+    except ResourceNotFoundError:
+        logging.info("no partition to compact: %s", partition_path)
+        return None
+
+    hourly_names = sorted(name for name in file_names if name != DAILY_FILE_NAME)
+
+    tables = []
+    compacted_from = []
+    df = None
+    if DAILY_FILE_NAME in file_names:
+        with metrics.stage("download"):
+            daily_table = read_parquet_file(file_system_client, daily_path)
+        compacted_from = get_compacted_from(daily_table)
+        tables.append(daily_table)
+
+    # hourly files already merged by an interrupted run are only deleted
+    pending_names = [name for name in hourly_names if name not in compacted_from]
+
+    if pending_names or (rewrite and tables):
+        with metrics.stage("download"):
+            tables.extend(
+                read_parquet_file(file_system_client, f"{partition_path}/{name}")
+                for name in pending_names
+            )
+
+        with metrics.stage("transform"):
+            df = pd.concat(
+                [table.to_pandas() for table in tables], ignore_index=True
+            )
+
+            # hourly files written before the schema, or with other categories, are cast back to it
+            if schema is not None:
+                df = apply_schema(df, schema, dataset_name)
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.replace_schema_metadata({
+                **(table.schema.metadata or {}),
+                COMPACTED_FROM_KEY: json.dumps(sorted(compacted_from + pending_names)).encode(),
+            })
+
+            # sorted by establishment and timestamp, stable so that duplicates keep their file order
+            buffer = write_parquet(
+                table,
+                sort_columns=sort_columns,
+                column_encoding=schema.get("column_encoding") if schema is not None else None,
+                row_group_size=DAILY_ROW_GROUP_SIZE,
+            )
+            size = get_buffer_size(buffer)
+
+        # write next to the daily file then swap it in with an atomic rename
+        with metrics.stage("upload", http_calls=2, bytes_written=size, rows=len(df)):
+            temp_client = file_system_client.get_file_client(f"{daily_path}.tmp")
+            temp_client.upload_data(buffer, overwrite=True, length=size)
+            temp_client.rename_file(f"{datalake_container_name}/{daily_path}")
+
+    # index the daily file in place of the hourly files, the index is only rewritten when it changes
+    if watermark_column is not None and tables:
+        # nothing merged: the range of the daily file read above
+        if df is None:
+            columns = [watermark_column] if watermark_column in tables[0].column_names else []
+            df = tables[0].select(columns).to_pandas()
+        record_watermarks(
+            file_system_client, datalake_directory_name, dataset_name, watermark_column, day,
+            {DAILY_FILE_NAME: get_watermark_range(df, watermark_column)}, replace_day=True)
+
+    # the hourly files are now part of the daily file
+    with metrics.stage("upload", http_calls=len(hourly_names)):
+        for name in hourly_names:
+            file_system_client.get_file_client(f"{partition_path}/{name}").delete_file()
+
+    logging.info(
+        "compacted %s hourly files into %s (%s deleted)", len(pending_names), daily_path, len(hourly_names)
+    )
+
+    return daily_path
@@ -2,8 +2,52 @@
 import logging
 import os
 import datetime
+import threading
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from shared import metrics
+from shared.clients import get_datalake_account_url, get_datalake_service_client
+from shared.parquet import get_buffer_size, write_parquet
+
+# Bytes sent per append_data call when streaming a file
+APPEND_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Partition directories already created by this worker, keyed by account, container and path
+_known_directories = set()
+_known_directories_lock = threading.Lock()
+
+
+# Get the local (UTC-4) time used to partition the bronze directory
+def get_partition_now():
+    return datetime.datetime.utcnow() - datetime.timedelta(hours=4)
+
+
+# Get the <dataset>/year=YYYY/month=MM/day=DD path of a day
+def get_partition_path(datalake_directory_name, dataset_name, day):
+    return (
+        f"{datalake_directory_name}/{dataset_name}/"
+        f"year={day.strftime('%Y')}/month={day.strftime('%m')}/day={day.strftime('%d')}"
+    )
+
+
+# Create a directory and its parents, once per worker
+def ensure_directory(file_system_client, directory_path):
+    key = (file_system_client.account_name, file_system_client.file_system_name, directory_path)
+
+    with _known_directories_lock:
+        if key in _known_directories:
+            return file_system_client.get_directory_client(directory_path)
+
+    # a hierarchical namespace creates the missing parents in the same call
+    directory_client = file_system_client.create_directory(directory_path)
+    metrics.record("upload", http_calls=1)
+
+    with _known_directories_lock:
+        _known_directories.add(key)
+
+    return directory_client
 
-from azure.storage.filedatalake import DataLakeServiceClient
 
 # Upload the data to Azure Data Lake
 # Required RBAC role - Storage Blob Data Owner
@@ -17,9 +61,8 @@ def upload_to_datalake(
 ):
 
     # Get the client
-    service_client = DataLakeServiceClient(
-        account_url=f"https://{datalake_account_name}.dfs.core.windows.net",
-        credential=azure_credential,
+    service_client = get_datalake_service_client(
+        get_datalake_account_url(datalake_account_name), azure_credential
     )
 
     # Get the file system client
@@ -33,9 +76,106 @@ def upload_to_datalake(
 
     # Upload the data
     file_client.upload_data(data_str, overwrite=True)
+    metrics.record("upload", http_calls=1, bytes_written=len(data_str))
+
+    return file_name
+
+# Stream text chunks to a file of Azure Data Lake: the chunks are appended in blocks of about block_size bytes
+# as they are produced, then committed with a single flush.
+# The file is written under a temporary name and renamed once complete, so that readers never see
+# a partial file, and the temporary file is deleted when producing the chunks fails.
+# Required RBAC role - Storage Blob Data Owner
+def upload_chunks_to_datalake(
+    azure_credential,
+    datalake_account_name,
+    datalake_container_name,
+    datalake_directory_name,
+    file_name,
+    chunks,
+    block_size=APPEND_BLOCK_SIZE,
+):
+
+    # Get the client
+    service_client = get_datalake_service_client(
+        get_datalake_account_url(datalake_account_name), azure_credential
+    )
+
+    # Get the directory client
+    directory_client = service_client.get_file_system_client(
+        file_system=datalake_container_name
+    ).get_directory_client(datalake_directory_name)
+
+    # Create the temporary file
+    temp_client = directory_client.get_file_client(f"{file_name}.tmp")
+    temp_client.create_file()
+
+    offset = 0
+    block = []
+    block_length = 0
+
+    def append_block():
+        nonlocal offset, block, block_length
+        data = b"".join(block)
+        temp_client.append_data(data, offset=offset, length=len(data))
+        metrics.record("upload", http_calls=1, bytes_written=len(data))
+        offset += len(data)
+        block = []
+        block_length = 0
+
+    try:
+        for chunk in chunks:
+            data = chunk.encode("utf-8")
+            block.append(data)
+            block_length += len(data)
+            if block_length >= block_size:
+                append_block()
+
+        if block_length:
+            append_block()
+
+        temp_client.flush_data(offset)
+
+    except Exception:
+        temp_client.delete_file()
+        raise
+
+    temp_client.rename_file(f"{datalake_container_name}/{datalake_directory_name}/{file_name}")
+
+    # create, flush and rename
+    metrics.record("upload", http_calls=3)
 
     return file_name
 
+
+# Download a file from Azure Data Lake, None when it does not exist
+def download_from_datalake(
+    azure_credential,
+    datalake_account_name,
+    datalake_container_name,
+    datalake_directory_name,
+    file_name,
+):
+
+    # Get the client
+    service_client = get_datalake_service_client(
+        get_datalake_account_url(datalake_account_name), azure_credential
+    )
+
+    # Get the file client
+    file_client = service_client.get_file_system_client(
+        file_system=datalake_container_name
+    ).get_directory_client(datalake_directory_name).get_file_client(file_name)
+
+    # Download the data
+    metrics.record("download", http_calls=1)
+    try:
+        data = file_client.download_file().readall()
+    except ResourceNotFoundError:
+        return None
+
+    metrics.record("download", bytes_read=len(data))
+    return data
+
 def upload_df_to_datalake(
     azure_credential,
     datalake_account_name,
@@ -43,40 +183,37 @@ def upload_df_to_datalake(
     datalake_directory_name,
     file_name,
     df,
+    time_format="%H:00:00",
+    sort_columns=(),
+    column_encoding=None,
+    now=None,
 ):
 
-    # get current year, month, day
-    now = datetime.datetime.utcnow() - datetime.timedelta(hours=4)
-    year = now.strftime("%Y")
-    month = now.strftime("%m")
-    day = now.strftime("%d")
+    # get current year, month, day, unless the partition time is given
+    now = now or get_partition_now()
 
     # Get the client
-    service_client = DataLakeServiceClient(
-        account_url=f"https://{datalake_account_name}.dfs.core.windows.net",
-        credential=azure_credential,
+    service_client = get_datalake_service_client(
+        get_datalake_account_url(datalake_account_name), azure_credential
     )
 
     # Get the file system client
     file_system_client = service_client.get_file_system_client(file_system=datalake_container_name)
 
-    # Get the directory client
-    directory_client = file_system_client.get_directory_client(datalake_directory_name)
-
-    # create sub directory
-    directory_client = directory_client.create_sub_directory(f"{file_name}")
-
-    # create sub directories year=xxxx/month=xx/day=xx
-    directory_client = directory_client.create_sub_directory(f"year={year}")
-    directory_client = directory_client.create_sub_directory(f"month={month}")
-    directory_client = directory_client.create_sub_directory(f"day={day}")
+    # create the <file_name>/year=xxxx/month=xx/day=xx directory, unless already known
+    directory_client = ensure_directory(
+        file_system_client, get_partition_path(datalake_directory_name, file_name, now)
+    )
 
-    file_name = f"{now.strftime('%H:00:00')}.parquet"
+    file_name = f"{now.strftime(time_format)}.parquet"
 
     # Get the file client
     file_client = directory_client.get_file_client(file_name)
 
-    # Upload the data
-    file_client.upload_data(data=df.to_parquet(compression='gzip'), overwrite=True)
+    # Upload the data, encoded with the shared parquet settings (see shared/parquet.py)
+    buffer = write_parquet(df, sort_columns=sort_columns, column_encoding=column_encoding)
+    size = get_buffer_size(buffer)
+    file_client.upload_data(data=buffer, overwrite=True, length=size)
+    metrics.record("upload", http_calls=1, bytes_written=size, rows=len(df))
 
     return file_name
@@ -0,0 +1,39 @@
+# ./shared/delta.py
+import pandas as pd
+
+# Columns identifying an hourly relevé: the installation and its extraction timestamp
+DEFAULT_ESTABLISHMENT_COLUMN = "No_permis_installation"
+DEFAULT_WATERMARK_COLUMN = "Mise_a_jour"
+
+
+# Keep the rows newer than the watermark of their establishment
+# Returns the new rows and the advanced watermarks
+def select_new_rows(
+    df,
+    watermarks,
+    establishment_column=DEFAULT_ESTABLISHMENT_COLUMN,
+    watermark_column=DEFAULT_WATERMARK_COLUMN,
+):
+    if df.empty:
+        return df, dict(watermarks)
+
+    # dedupe on the stable row key (establishment + extraction timestamp)
+    df = df.drop_duplicates(subset=[establishment_column, watermark_column], keep="last")
+
+    establishments = df[establishment_column].astype(str)
+    timestamps = pd.to_datetime(df[watermark_column], errors="coerce")
+
+    # last persisted timestamp of every establishment, NaT when never seen
+    previous = pd.to_datetime(
+        establishments.map(watermarks), errors="coerce"
+    )
+
+    is_new = timestamps.notna() & (previous.isna() | (timestamps > previous))
+    new_rows = df[is_new]
+
+    new_watermarks = dict(watermarks)
+    latest = timestamps[is_new].groupby(establishments[is_new]).max()
+    for establishment, timestamp in latest.items():
+        new_watermarks[establishment] = timestamp.isoformat()
+
+    return new_rows.reset_index(drop=True), new_watermarks
@@ -0,0 +1,162 @@
+# ./shared/fetch.py
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from shared import metrics
+
+# (connect, read) timeouts of an article request, in seconds
+DEFAULT_TIMEOUT = (5, 15)
+
+# Articles are truncated to this many bytes
+MAX_CONTENT_BYTES = 5 * 1024 * 1024
+
+# Retries of a failed article request, waiting BACKOFF_SECONDS * 2**attempt between attempts
+MAX_RETRIES = 2
+BACKOFF_SECONDS = 0.5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Maximum number of articles downloaded at the same time, overall and per host
+MAX_WORKERS = 16
+MAX_PER_HOST = 4
+
+_session = None
+_session_lock = threading.Lock()
+# Semaphore of every host with requests running or waiting, and their number: a host is
+# dropped once its last request is done, so that following links to many hosts does not grow it
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    pass
+
+
+# Get the pooled HTTP session shared by every article request of the worker
+def get_session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+
+        return _session
+
+
+# Hold one of the MAX_PER_HOST request slots of the host of a url
+@contextmanager
+def host_slot(url):
+    host = urlsplit(url).hostname
+
+    with _host_semaphores_lock:
+        entry = _host_semaphores.get(host)
+        if entry is None:
+            entry = _host_semaphores[host] = [threading.BoundedSemaphore(MAX_PER_HOST), 0]
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _host_semaphores_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _host_semaphores[host]
+
+
+# Read at most max_bytes of a streamed response body
+def read_limited(response, max_bytes=MAX_CONTENT_BYTES):
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            logging.info("truncated %s at %s bytes", response.url, max_bytes)
+            break
+
+    return b"".join(chunks)[:max_bytes]
+
+
+# Get the status, headers and body of a url, retrying connection errors, timeouts and transient statuses
+def fetch_response(url, headers=None, timeout=DEFAULT_TIMEOUT, max_bytes=MAX_CONTENT_BYTES, retries=MAX_RETRIES):
+    session = get_session()
+
+    for attempt in range(retries + 1):
+        metrics.record("download", http_calls=1)
+        try:
+            with host_slot(url):
+                with session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                    if response.status_code in RETRY_STATUS_CODES and attempt < retries:
+                        raise FetchError(f"{response.status_code} for {url}")
+                    response.raise_for_status()
+                    content = read_limited(response, max_bytes)
+                    metrics.record("download", bytes_read=len(content))
+                    return response.status_code, response.headers, content
+
+        except (FetchError, requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise FetchError(str(e)) from e
+            logging.info("retrying %s after: %s", url, e)
+            metrics.record("download", retries=1)
+            time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+
+        except requests.RequestException as e:
+            raise FetchError(str(e)) from e
+
+
+# Get the body of a url
+def fetch_url(url, **kwargs):
+    _, _, content = fetch_response(url, **kwargs)
+    return content
+
+
+# Get the body of a url through the response cache:
+# fresh entries cost no request, stale entries are revalidated with a conditional request
+def fetch_url_cached(url, cache, **kwargs):
+    cached = cache.get(url)
+    if cached is None:
+        status_code, headers, content = fetch_response(url, **kwargs)
+        cache.put(url, content, headers)
+        return content
+
+    meta, body = cached
+    if cache.is_fresh(meta):
+        return body
+
+    status_code, headers, content = fetch_response(url, headers=cache.get_conditional_headers(meta), **kwargs)
+    if status_code == 304:
+        cache.refresh(url, meta)
+        return body
+
+    cache.put(url, content, headers)
+    return content
+
+
+# Download urls concurrently, through the response cache when one is given
+# Returns {url: (content, error)}, error is None on success and content is None on failure
+def fetch_urls(urls, max_workers=MAX_WORKERS, cache=None, **kwargs):
+    def fetch(url):
+        try:
+            if cache is not None:
+                return fetch_url_cached(url, cache, **kwargs), None
+            return fetch_url(url, **kwargs), None
+        except FetchError as e:
+            logging.warning("failed to fetch %s: %s", url, e)
+            return None, str(e)
+
+    unique_urls = list(dict.fromkeys(urls))
+    if not unique_urls:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_urls)))) as executor:
+        return dict(zip(unique_urls, executor.map(metrics.bind(fetch), unique_urls)))
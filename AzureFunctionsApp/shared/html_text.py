@@ -0,0 +1,212 @@
+# ./shared/html_text.py
+import logging
+import os
+import re
+from html.entities import html5
+
+from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import UnicodeDammit
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# Paragraph extractors, selected with the HTML_TEXT_EXTRACTOR environment variable.
+# Both return markup of the paragraphs with a single string, as `str(soup.find_all("p", text=True))`
+# does, that gives the same text once its tags are removed.
+HTML_PARSER_EXTRACTOR = "html.parser"
+LXML_EXTRACTOR = "lxml"
+DEFAULT_EXTRACTOR = LXML_EXTRACTOR
+
+# Elements BeautifulSoup always closes right away, elements whose whitespace it keeps
+# and elements whose text it does not escape
+VOID_TAGS = frozenset(HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS)
+PRESERVE_WHITESPACE_TAGS = frozenset(HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS)
+RAW_TEXT_TAGS = frozenset(["script", "style"])
+
+# BeautifulSoup collapses strings made only of these characters to a single space or line feed
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+# Comments that HTML5 parsers end early, which html.parser does not
+ABRUPT_COMMENTS = ("<!-->", "<!--->", "--!>")
+
+# Comments and script or style bodies, left out of the checks below
+IGNORED_MARKUP = re.compile(r"<(?:!--.*?-->|((script|style)\b[^>]*>).*?</\2\s*>)", re.IGNORECASE | re.DOTALL)
+
+# Markup that libxml2 does not parse the way html.parser does: processing instructions and other declarations,
+# unterminated comments, end tags without a name, tags inside raw text elements, tags that are not closed
+# before the next one and end tags of void elements
+UNSAFE_TAG = re.compile(
+    r"<(?:\?|!(?!doctype)|/(?![A-Za-z])"
+    r"|(textarea|title|iframe|xmp|noembed|noframes|plaintext)\b[^>]*>[^<]*<(?!/\1\s*>)"
+    r"|[A-Za-z/!][^<>]*<"
+    r"|/(?:" + "|".join(sorted(VOID_TAGS)) + r")\b)",
+    re.IGNORECASE,
+)
+
+# Numeric references without their semicolon
+UNSAFE_NUMERIC_REFERENCE = re.compile(r"&#(?![0-9]+;|[xX][0-9a-fA-F]+;)")
+
+# Paragraphs without an end tag are closed differently by the two parsers
+PARAGRAPH_START = re.compile(r"<p[\s/>]", re.IGNORECASE)
+PARAGRAPH_END = re.compile(r"</p[\s>]", re.IGNORECASE)
+
+# Paragraphs inside SVG or MathML, which libxml2 may drop, and markup after </html>, which it drops
+FOREIGN_CONTENT = re.compile(r"<(svg|math)\b.*?(?:</\1\s*>|$)", re.IGNORECASE | re.DOTALL)
+AFTER_DOCUMENT = re.compile(r"</html\s*>(.*)", re.IGNORECASE | re.DOTALL)
+
+# Tags, and named character references
+TAG = re.compile(r"<[A-Za-z/!][^>]*>")
+ENTITY_REFERENCE = re.compile(r"&([A-Za-z][A-Za-z0-9]*)(;?)")
+
+# Entities that are also recognized without their semicolon
+LEGACY_ENTITIES = frozenset(name for name in html5 if not name.endswith(";"))
+
+# Comments and tags, kept as they are, or carriage returns that libxml2 would turn into line feeds
+TAG_OR_CARRIAGE_RETURN = re.compile(r"(<!--.*?-->|" + TAG.pattern + r")|\r", re.DOTALL)
+
+
+# Reference extractor: BeautifulSoup with the pure Python html.parser
+def extract_paragraphs_html_parser(page_html):
+    soup = BeautifulSoup(page_html, "html.parser")
+    return str(soup.find_all("p", string=True))
+
+
+# Both parsers resolve a named reference the same way when it is a known entity followed by a semicolon,
+# or a name that no entity is a prefix of
+def is_entity_reference_safe(name, semicolon):
+    if semicolon:
+        return name + ";" in html5
+    if name in LEGACY_ENTITIES:
+        return True
+    if name + ";" in html5:
+        return False
+    return not any(name[:end] in LEGACY_ENTITIES for end in range(2, len(name)))
+
+
+# Whether libxml2 builds the same paragraphs as html.parser from this markup
+def is_lxml_safe(markup):
+    if "\x00" in markup or any(comment in markup for comment in ABRUPT_COMMENTS):
+        return False
+
+    markup = IGNORED_MARKUP.sub(lambda match: "<" + match.group(1) if match.group(1) else " ", markup)
+    if UNSAFE_TAG.search(markup) or UNSAFE_NUMERIC_REFERENCE.search(markup):
+        return False
+
+    if len(PARAGRAPH_START.findall(markup)) != len(PARAGRAPH_END.findall(markup)):
+        return False
+
+    if any(PARAGRAPH_START.search(match.group(0)) for match in FOREIGN_CONTENT.finditer(markup)):
+        return False
+
+    after_document = AFTER_DOCUMENT.search(markup)
+    if after_document and TAG.search(after_document.group(1)):
+        return False
+
+    references = set(ENTITY_REFERENCE.findall(TAG.sub(" ", markup)))
+    return all(is_entity_reference_safe(name, semicolon) for name, semicolon in references)
+
+
+# Escape carriage returns outside of tags and comments, so that they reach the text nodes unchanged
+def protect_carriage_returns(markup):
+    return TAG_OR_CARRIAGE_RETURN.sub(lambda match: match.group(1) or "&#13;", markup)
+
+
+def escape_minimal(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def collapse_whitespace(text, element):
+    if text.strip(ASCII_SPACES):
+        return text
+    if element.tag in PRESERVE_WHITESPACE_TAGS or any(
+        ancestor.tag in PRESERVE_WHITESPACE_TAGS for ancestor in element.iterancestors()
+    ):
+        return text
+    return "\n" if "\n" in text else " "
+
+
+# Markup of the only string of an element, following single child elements as bs4's Tag.string does.
+# None when the element does not have exactly one string.
+def get_single_string_markup(element):
+    while True:
+        children = len(element) + sum(1 for child in element if child.tail)
+        if element.text:
+            if children:
+                return None
+            text = collapse_whitespace(element.text, element)
+            return text if element.tag in RAW_TEXT_TAGS else escape_minimal(text)
+
+        if children != 1:
+            return None
+
+        element = element[0]
+        if element.tag is etree.Comment:
+            return f"<!--{element.text or ''}-->"
+
+        # libxml2 lets some void elements hold the content that follows them,
+        # BeautifulSoup never gives them a string
+        if not isinstance(element.tag, str) or element.tag in VOID_TAGS:
+            return None
+
+
+# C-backed extractor: libxml2 through lxml, falling back to html.parser for markup it would parse differently
+def extract_paragraphs_lxml(page_html):
+    markup = page_html
+    if isinstance(page_html, bytes):
+        # decode the page exactly as BeautifulSoup does
+        markup = UnicodeDammit(page_html, is_html=True).unicode_markup
+
+    if not markup or not is_lxml_safe(markup):
+        return extract_paragraphs_html_parser(page_html)
+
+    carriage_returns = "\r" in markup
+    if carriage_returns:
+        markup = protect_carriage_returns(markup)
+
+    parser = etree.HTMLParser()
+    try:
+        root = etree.fromstring(markup, parser)
+    except (ValueError, etree.LxmlError):
+        root = None
+
+    # recovered errors mean that libxml2 had to restructure the document
+    if root is None or len(parser.error_log):
+        return extract_paragraphs_html_parser(page_html)
+
+    paragraphs = []
+    for paragraph in root.iter("p"):
+        string_markup = get_single_string_markup(paragraph)
+        if string_markup is None:
+            continue
+
+        # line feeds of a comment may have been carriage returns,
+        # and carriage returns of a script were not turned back into characters
+        if carriage_returns and (
+            string_markup.startswith("<!--") and "\n" in string_markup or "&#13;" in string_markup
+        ):
+            return extract_paragraphs_html_parser(page_html)
+
+        paragraphs.append(f"<p>{string_markup}</p>")
+
+    return "[" + ", ".join(paragraphs) + "]"
+
+
+EXTRACTORS = {
+    HTML_PARSER_EXTRACTOR: extract_paragraphs_html_parser,
+    LXML_EXTRACTOR: extract_paragraphs_lxml,
+}
+
+
+# Get the paragraph extractor configured for the worker, html.parser when lxml is not installed
+def get_extractor(name=None):
+    if name is None:
+        name = os.environ.get("HTML_TEXT_EXTRACTOR", DEFAULT_EXTRACTOR)
+
+    if name == LXML_EXTRACTOR and etree is None:
+        logging.warning("lxml is not installed, extracting article text with %s", HTML_PARSER_EXTRACTOR)
+        name = HTML_PARSER_EXTRACTOR
+
+    return EXTRACTORS[name]
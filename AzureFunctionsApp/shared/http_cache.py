@@ -0,0 +1,166 @@
+# ./shared/http_cache.py
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# Cache location, size bound and freshness, overridable with environment variables
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "article-cache")
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 6 * 60 * 60
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class ResponseCache:
+    # On-disk cache of response bodies keyed by url hash, with their validators
+    # (ETag, Last-Modified) and the text extracted from them.
+    # Entries are evicted least recently used first once their body and metadata files exceed max_bytes.
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self._list_entries())
+
+    def _path(self, url, extension):
+        return os.path.join(self.directory, f"{hashlib.sha256(url.encode()).hexdigest()}.{extension}")
+
+    # Paths of the files of an entry: its body, and the metadata holding its validators and text
+    def _get_entry_paths(self, body_path):
+        return body_path, body_path[:-len(".body")] + ".json"
+
+    def _get_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    # Entries with their last use and the size of both their files
+    def _list_entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".body"):
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                yield entry.path, mtime, sum(map(self._get_size, self._get_entry_paths(entry.path)))
+
+    def _write(self, path, data):
+        previous_size = self._get_size(path)
+
+        # write then rename, so that readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+
+        # bodies and metadata (which grows with the extracted text) count towards max_bytes
+        with self.lock:
+            self.size += len(data) - previous_size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _read_meta(self, url):
+        try:
+            with open(self._path(url, "json"), encoding="utf-8") as meta_file:
+                return json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Get the cached entry of a url: (meta, body), or None
+    def get(self, url):
+        meta = self._read_meta(url)
+        if meta is None:
+            return None
+
+        body_path = self._path(url, "body")
+        try:
+            with open(body_path, "rb") as body_file:
+                body = body_file.read()
+            # mark the entry as recently used
+            os.utime(body_path)
+        except FileNotFoundError:
+            return None
+
+        return meta, body
+
+    def is_fresh(self, meta):
+        return time.time() - meta["fetched_at"] < self.ttl
+
+    # Headers revalidating a stale entry
+    def get_conditional_headers(self, meta):
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    # Store a new body, dropping the text extracted from the previous one
+    def put(self, url, body, headers):
+        meta = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+
+        self._write(self._path(url, "body"), body)
+        self._write(self._path(url, "json"), json.dumps(meta).encode())
+
+    # A 304 response: the cached body is fresh again
+    def refresh(self, url, meta):
+        meta["fetched_at"] = time.time()
+        self._write(self._path(url, "json"), json.dumps(meta).encode())
+
+    def get_text(self, url):
+        meta = self._read_meta(url)
+        return None if meta is None else meta.get("text")
+
+    def set_text(self, url, text):
+        meta = self._read_meta(url)
+        if meta is not None:
+            meta["text"] = text
+            self._write(self._path(url, "json"), json.dumps(meta).encode())
+
+    # Delete least recently used entries until the cache is back under 90% of max_bytes
+    def _evict(self):
+        entries = sorted(self._list_entries(), key=lambda entry: entry[1])
+        self.size = sum(size for _, _, size in entries)
+
+        for body_path, _, size in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            for path in self._get_entry_paths(body_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.size -= size
+
+        logging.info("article cache evicted down to %s bytes", self.size)
+
+
+# Get the article cache of the worker, None when ARTICLE_CACHE_DIR is set to an empty value
+def get_article_cache():
+    global _cache
+
+    directory = os.environ.get("ARTICLE_CACHE_DIR", DEFAULT_CACHE_DIR)
+    if not directory:
+        return None
+
+    with _cache_lock:
+        if _cache is None or _cache.directory != directory:
+            _cache = ResponseCache(
+                directory,
+                max_bytes=int(os.environ.get("ARTICLE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+                ttl=int(os.environ.get("ARTICLE_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+            )
+
+        return _cache
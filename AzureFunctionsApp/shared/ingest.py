@@ -1,16 +1,148 @@
+import hashlib
 import logging
 import os
-import urllib
+import urllib.parse
+import urllib.request
 import json
 import chardet
 import pandas as pd
 
-from azure.storage.blob import BlobServiceClient
-from shared.datalake import upload_df_to_datalake
+from shared import metrics
+from shared.datalake import get_partition_now, upload_df_to_datalake
 from shared.azure_credential import get_azure_default_credential
 from shared.blob_storage import upload_df_to_blob
+from shared.clients import get_datalake_account_url, get_datalake_service_client
+from shared.delta import (
+    DEFAULT_ESTABLISHMENT_COLUMN,
+    DEFAULT_WATERMARK_COLUMN,
+    select_new_rows,
+)
+from shared.schema import apply_schema, get_schema
+from shared.state import load_state, save_state
+from shared.status import update_status_index
+from shared.watermark_index import get_watermark_range, record_watermarks
 
-def ingest_from_api(url, filename):
+# Number of records requested per CKAN datastore_search page
+CKAN_PAGE_LIMIT = 10000
+
+# Number of bytes handed to chardet to guess the payload encoding
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+
+# Set the offset/limit query parameters on a CKAN datastore_search url
+def get_page_url(url, offset, limit):
+    parts = urllib.parse.urlsplit(url)
+    query = dict(urllib.parse.parse_qsl(parts.query))
+    query["offset"] = str(offset)
+    query["limit"] = str(limit)
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+# Detect the encoding from a bounded sample of the payload, starting at offset
+# An ASCII sample says nothing about the accents further on, read it as UTF-8, the encoding of JSON
+def detect_encoding(body, sample_size=ENCODING_SAMPLE_SIZE, offset=0):
+    encoding = chardet.detect(body[offset:offset + sample_size])["encoding"]
+    if encoding is None or encoding.lower() == "ascii":
+        return "utf-8"
+    return encoding
+
+
+# Decode a page: CKAN serves JSON, which is UTF-8 (RFC 8259), the detected encoding is the fallback
+def decode_page(body):
+    try:
+        return body.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # sample from the first byte that is not UTF-8, the ASCII before it tells nothing
+        encoding = detect_encoding(body, offset=e.start)
+        logging.warning("page is not UTF-8, decoded as %s", encoding)
+        return body.decode(encoding, errors="replace")
+
+
+# Get the CKAN resource_show url matching a datastore_search url
+def get_resource_show_url(url):
+    parts = urllib.parse.urlsplit(url)
+    query = dict(urllib.parse.parse_qsl(parts.query))
+    path = parts.path.rsplit("/", 1)[0] + "/resource_show"
+    return urllib.parse.urlunsplit(
+        parts._replace(path=path, query=urllib.parse.urlencode({"id": query["resource_id"]}))
+    )
+
+
+# Get the modification timestamps advertised by CKAN for a resource
+# Returns None when the metadata cannot be read, so that the caller falls back to a full fetch
+def fetch_resource_fingerprint(url):
+    metrics.record("download", http_calls=1)
+    try:
+        with urllib.request.urlopen(get_resource_show_url(url)) as fileobj:
+            result = json.loads(fileobj.read())["result"]
+    except Exception as e:
+        logging.warning("resource_show failed for %s: %s", url, e)
+        return None
+
+    fingerprint = {
+        "last_modified": result.get("last_modified"),
+        "metadata_modified": result.get("metadata_modified"),
+    }
+
+    if not any(fingerprint.values()):
+        return None
+
+    return fingerprint
+
+
+# Hash the content of the records, independently of the page layout
+def get_content_hash(df):
+    row_hashes = pd.util.hash_pandas_object(df, index=False)
+    return hashlib.sha256(row_hashes.values.tobytes()).hexdigest()
+
+
+# Download every page of a CKAN datastore_search resource, one request per page
+def fetch_ckan_records(url, page_limit=CKAN_PAGE_LIMIT):
+    frames = []
+    columns = None
+    offset = 0
+    total = None
+
+    while total is None or offset < total:
+
+        # request the page
+        with urllib.request.urlopen(get_page_url(url, offset, page_limit)) as fileobj:
+            body = fileobj.read()
+        metrics.record("download", http_calls=1, bytes_read=len(body))
+
+        # parse the already downloaded bytes
+        result = json.loads(decode_page(body))["result"]
+        records = result["records"]
+
+        if columns is None:
+            columns = [field["id"] for field in result.get("fields", [])] or None
+
+        total = result.get("total", 0)
+
+        # stop on an empty page or when the server does not advertise a next page
+        if not records:
+            break
+
+        frames.append(pd.DataFrame.from_records(records, columns=columns))
+        offset += len(records)
+        metrics.record("download", rows=len(records))
+
+        if "next" not in result.get("_links", {}):
+            break
+
+    logging.info("fetched %s of %s records from %s", offset, total, url)
+
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+# Ingest a CKAN resource into the bronze directory
+# resource is the registry entry; mode "delta" only writes rows newer than the watermarks
+# Returns "uploaded", "not_modified" or "no_new_rows"
+def ingest_from_api(url, filename, resource=None):
+    resource = resource or {}
 
     # Get environment variables
     datalake_account_name = os.environ.get("ADLS_RESOURCE_NAME")
@@ -20,26 +152,93 @@ def ingest_from_api(url, filename):
     # Get authentication to Key Vault with environment variables
     azure_default_credential = get_azure_default_credential()
 
-    # request the url
-    fileobj = urllib.request.urlopen(url)
-    
-    # use chardet to detect the encoding
-    result = chardet.detect(fileobj.read())
+    with metrics.stage("download"):
+        state = load_state(azure_default_credential, filename)
 
-    # parse the url with the correct encoding
-    df = pd.read_json(url, encoding=result['encoding'])
+        # skip the download when CKAN did not refresh the resource
+        fingerprint = fetch_resource_fingerprint(url)
+    if fingerprint is not None and fingerprint == state.get("fingerprint"):
+        logging.info("not modified: %s (%s)", filename, fingerprint)
+        return "not_modified"
 
-    # get the records from the json
-    records = df['result']['records']
+    # get the records from every page of the resource
+    with metrics.stage("download"):
+        df = fetch_ckan_records(url)
+
+    # skip the upload when the records are the ones of the previous run
+    with metrics.stage("transform", rows=len(df)):
+        content_hash = get_content_hash(df)
+    if content_hash == state.get("content_hash"):
+        logging.info("not modified: %s (same content)", filename)
+        state["fingerprint"] = fingerprint
+        save_state(azure_default_credential, filename, state)
+        return "not_modified"
+
+    state["fingerprint"] = fingerprint
+    state["content_hash"] = content_hash
+
+    # cast the records to the declared types of the dataset (see shared/schema.py)
+    schema = get_schema(resource.get("schema", filename))
+    if schema is not None:
+        with metrics.stage("transform"):
+            df = apply_schema(df, schema, filename)
+
+    # keep only the rows newer than the last run
+    delta = resource.get("mode") == "delta"
+    watermark_column = resource.get("watermark_column", DEFAULT_WATERMARK_COLUMN)
+    if delta:
+        with metrics.stage("transform"):
+            df, state["watermarks"] = select_new_rows(
+                df,
+                state.get("watermarks", {}),
+                establishment_column=resource.get("establishment_column", DEFAULT_ESTABLISHMENT_COLUMN),
+                watermark_column=watermark_column,
+            )
+
+        if df.empty:
+            logging.info("no new rows for %s", filename)
+            save_state(azure_default_credential, filename, state)
+            return "no_new_rows"
 
     # upload the records (dataframe) to blob storage
-    blob_url = upload_df_to_datalake(
-        azure_default_credential,
-        datalake_account_name,
-        datalake_container_name,
-        datalake_directory_name,
-        filename,
-        pd.DataFrame(records)
-    )
-    logging.info("blob uploaded: %s", blob_url)
-    return True
\ No newline at end of file
+    now = get_partition_now()
+    with metrics.stage("upload"):
+        blob_url = upload_df_to_datalake(
+            azure_default_credential,
+            datalake_account_name,
+            datalake_container_name,
+            datalake_directory_name,
+            filename,
+            df,
+            # delta files must not overwrite an earlier delta of the same hour
+            time_format="%H:%M:%S" if delta else "%H:00:00",
+            # sorted so that readers can skip row groups by establishment and timestamp
+            sort_columns=(
+                resource.get("establishment_column", DEFAULT_ESTABLISHMENT_COLUMN),
+                watermark_column,
+            ),
+            column_encoding=schema.get("column_encoding") if schema is not None else None,
+            now=now,
+        )
+        logging.info("blob uploaded: %s (%s rows)", blob_url, len(df))
+
+        # readers find the file from the update times of its rows, whichever partition it landed in
+        record_watermarks(
+            get_datalake_service_client(
+                get_datalake_account_url(datalake_account_name), azure_default_credential
+            ).get_file_system_client(file_system=datalake_container_name),
+            datalake_directory_name,
+            filename,
+            watermark_column,
+            now.date(),
+            {blob_url: get_watermark_range(df, watermark_column)},
+        )
+
+        # advance the fingerprint and watermarks only once the rows are persisted
+        save_state(azure_default_credential, filename, state)
+
+    # the current_status function of this worker serves the new relevés right away
+    with metrics.stage("transform"):
+        update_status_index(filename, df)
+
+    return "uploaded"
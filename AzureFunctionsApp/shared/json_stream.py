@@ -0,0 +1,90 @@
+# ./shared/json_stream.py
+import codecs
+import json
+
+# Bytes read from the stream at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+_element_ends = _whitespace + ",]"
+
+
+# Yield the elements of a JSON array read from a binary stream (anything with read(size)),
+# holding one element and one chunk in memory at a time.
+# Raises ValueError when the stream is not a JSON array, like json.loads.
+def iter_json_array(stream, chunk_size=READ_CHUNK_SIZE):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[position:] + decoder.decode(chunk or b"", final=eof)
+        position = 0
+
+    # Skip whitespace, reading until the next significant character, None at the end of the stream
+    def peek():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in _whitespace:
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if eof:
+                return None
+            read_more()
+
+    if peek() != "[":
+        raise ValueError("expected a JSON array")
+    position += 1
+
+    if peek() == "]":
+        position += 1
+    else:
+        while True:
+            peek()
+
+            # an element is complete once what follows it ends it: a number cut by a chunk may continue
+            while True:
+                try:
+                    element, end = _decoder.raw_decode(buffer, position)
+                    if eof or end < len(buffer) and buffer[end] in _element_ends:
+                        break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                read_more()
+
+            position = end
+            yield element
+
+            separator = peek()
+            position += 1
+            if separator == "]":
+                break
+            if separator != ",":
+                raise ValueError(f"expected ',' or ']' in the JSON array, found {separator!r}")
+
+    if peek() is not None:
+        raise ValueError("extra data after the JSON array")
+
+
+# Serialize elements as a JSON array, a chunk per element: the same text as json.dumps(list(elements))
+def iter_json_array_chunks(elements):
+    separator = "["
+    for element in elements:
+        yield separator + json.dumps(element)
+        separator = ", "
+
+    yield "[]" if separator == "[" else "]"
+
+
+# Serialize elements as newline-delimited JSON, a line per element
+def iter_ndjson_chunks(elements):
+    for element in elements:
+        yield json.dumps(element) + "\n"
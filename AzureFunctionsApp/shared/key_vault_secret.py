@@ -1,7 +1,7 @@
 # ./shared/key_vault_secret.py
 import logging
 
-from azure.keyvault.secrets import SecretClient
+from shared.clients import get_secret_client
 
 
 # Get a secret from Azure Key Vault
@@ -11,7 +11,7 @@ def get_key_vault_secret(azure_credential, key_vault_name, secret_name):
     key_vault_uri = f"https://{key_vault_name}.vault.azure.net"
 
     # Get the client
-    client = SecretClient(vault_url=key_vault_uri, credential=azure_credential)
+    client = get_secret_client(key_vault_uri, azure_credential)
 
     # Get the secret
     key_vault_secret_response = client.get_secret(secret_name)
@@ -0,0 +1,133 @@
+# ./shared/metrics.py
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Stages of the pipelines, in the order of the summary
+STAGES = ("list", "download", "transform", "upload", "archive")
+
+# Counters of a stage, next to its time
+COUNTERS = ("http_calls", "retries", "bytes_read", "bytes_written", "rows")
+
+# Metrics of the running invocation, None outside of one: recording is then a no-op
+_current = contextvars.ContextVar("metrics_invocation", default=None)
+
+# Stages being timed by the current thread, innermost last
+_timers = threading.local()
+
+
+class InvocationMetrics:
+    # Time and counters per stage of one function invocation, updated from any thread.
+    # The time of a stage excludes the stages nested in it, and adds up over the threads running it.
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.status = "succeeded"
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds=0.0, **counters):
+        with self.lock:
+            values = self.stages.setdefault(stage, dict.fromkeys(("seconds",) + COUNTERS, 0))
+            values["seconds"] += seconds
+            for counter, value in counters.items():
+                values[counter] = values.get(counter, 0) + value
+
+    def summary(self):
+        order = {stage: index for index, stage in enumerate(STAGES)}
+        with self.lock:
+            stages = {
+                stage: dict(self.stages[stage], seconds=round(self.stages[stage]["seconds"], 3))
+                for stage in sorted(self.stages, key=lambda stage: (order.get(stage, len(STAGES)), stage))
+            }
+
+        return {
+            "invocation": self.name,
+            "status": self.status,
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "stages": stages,
+        }
+
+
+# Collect the metrics of an invocation, and log their summary as a JSON line when it ends.
+# Also decorates a function, collecting the metrics of each of its calls
+@contextmanager
+def invocation(name):
+    metrics = InvocationMetrics(name)
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    except BaseException:
+        metrics.status = "failed"
+        raise
+    finally:
+        _current.reset(token)
+        logging.info("metrics %s", json.dumps(metrics.summary()))
+
+
+# Mark the current invocation as failed, for errors that are handled instead of raised
+def mark_failed():
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.status = "failed"
+
+
+# Add to the counters of a stage of the current invocation
+def record(stage, **counters):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(stage, **counters)
+
+
+# Time a block as a stage of the current invocation, pausing the stage it is nested in
+@contextmanager
+def stage(name, **counters):
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+
+    stack = _timers.__dict__.setdefault("stack", [])
+    now = time.perf_counter()
+    if stack:
+        stack[-1]["elapsed"] += now - stack[-1]["started"]
+
+    timer = {"started": now, "elapsed": 0.0}
+    stack.append(timer)
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        stack.pop()
+        metrics.add(name, seconds=timer["elapsed"] + now - timer["started"], **counters)
+        if stack:
+            stack[-1]["started"] = now
+
+
+# Time the production of every item of an iterable as a stage, for streamed pipelines
+def iter_stage(name, iterable):
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+# Run a function on a worker thread with the metrics of the invocation submitting it
+def bind(function):
+    metrics = _current.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(metrics)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return run
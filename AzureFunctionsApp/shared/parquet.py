@@ -0,0 +1,77 @@
+# ./shared/parquet.py
+import io
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Parquet settings of the files written to Data Lake and Blob Storage, overridable with environment variables:
+# PARQUET_COMPRESSION (zstd, snappy, gzip or none), PARQUET_COMPRESSION_LEVEL, PARQUET_ROW_GROUP_SIZE (rows),
+# PARQUET_USE_DICTIONARY and PARQUET_WRITE_STATISTICS (true or false)
+DEFAULT_COMPRESSION = "zstd"
+DEFAULT_ROW_GROUP_SIZE = 128 * 1024
+
+
+def get_flag(name, default):
+    return os.environ.get(name, str(default)).strip().lower() in ("1", "true", "yes")
+
+
+# Writer options from the environment, explicit options win
+def get_parquet_options(**options):
+    compression_level = os.environ.get("PARQUET_COMPRESSION_LEVEL")
+    defaults = {
+        "compression": os.environ.get("PARQUET_COMPRESSION", DEFAULT_COMPRESSION),
+        "compression_level": int(compression_level) if compression_level else None,
+        "row_group_size": int(os.environ.get("PARQUET_ROW_GROUP_SIZE", DEFAULT_ROW_GROUP_SIZE)),
+        "use_dictionary": get_flag("PARQUET_USE_DICTIONARY", True),
+        "write_statistics": get_flag("PARQUET_WRITE_STATISTICS", True),
+    }
+    defaults.update((name, value) for name, value in options.items() if value is not None)
+
+    if defaults["compression"].lower() == "none":
+        defaults["compression"] = None
+        defaults["compression_level"] = None
+
+    return defaults
+
+
+# Encode a DataFrame or an arrow table as parquet, in a buffer rewound for upload.
+# Rows are sorted by the sort_columns present, recorded as the sort order of the row groups,
+# so that the statistics of every row group cover a narrow range and readers can skip the others.
+# column_encoding maps columns to a parquet encoding used instead of the dictionary, such as
+# DELTA_BINARY_PACKED for ids and timestamps increasing along the sort order.
+def write_parquet(data, sort_columns=(), column_encoding=None, **options):
+    table = data if isinstance(data, pa.Table) else pa.Table.from_pandas(data, preserve_index=False)
+
+    sort_keys = [(column, "ascending") for column in sort_columns if column in table.column_names]
+    sorting_columns = None
+    if sort_keys:
+        # arrow does not sort dictionary columns, sort on their values
+        keys = pa.table({
+            column: table[column].cast(table[column].type.value_type)
+            if pa.types.is_dictionary(table[column].type) else table[column]
+            for column, _ in sort_keys
+        })
+        table = table.take(pc.sort_indices(keys, sort_keys=sort_keys))
+        sorting_columns = pq.SortingColumn.from_ordering(table.schema, sort_keys)
+
+    options = get_parquet_options(**options)
+    column_encoding = {
+        column: encoding for column, encoding in (column_encoding or {}).items() if column in table.column_names
+    }
+    if column_encoding:
+        options["column_encoding"] = column_encoding
+        if options["use_dictionary"]:
+            options["use_dictionary"] = [column for column in table.column_names if column not in column_encoding]
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, sorting_columns=sorting_columns, **options)
+    buffer.seek(0)
+
+    return buffer
+
+
+# Size of an encoded buffer, without copying it
+def get_buffer_size(buffer):
+    return buffer.getbuffer().nbytes
@@ -0,0 +1,9 @@
+# ./shared/queues.py
+# Queues of the sharded cloud ETL (see shared/sharded_etl.py), named in the queue trigger decorators
+# of function_app.py: this module stays free of heavy imports so that indexing the functions stays cheap.
+
+# Queues of the work items and of the reduce requests, and the app setting prefix of their storage account
+# (identity-based connection: CLOUDETL_QUEUE__queueServiceUri)
+SHARD_QUEUE_NAME = "cloudetl-shards"
+REDUCE_QUEUE_NAME = "cloudetl-reduce"
+QUEUE_CONNECTION = "CLOUDETL_QUEUE"
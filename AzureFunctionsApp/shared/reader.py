@@ -0,0 +1,382 @@
+# ./shared/reader.py
+import datetime
+import io
+import logging
+import operator
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow.parquet as pq
+from azure.core.exceptions import ResourceNotFoundError
+
+from shared import metrics
+from shared.clients import get_datalake_account_url, get_datalake_service_client
+from shared.compaction import DAILY_FILE_NAME
+from shared.datalake import get_partition_now, get_partition_path
+from shared.delta import DEFAULT_WATERMARK_COLUMN
+from shared.schema import apply_schema, get_schema
+from shared.watermark_index import get_day_range, load_watermark_index, overlaps
+
+# Read the bronze <dataset>/year=YYYY/month=MM/day=DD partitions back, from Data Lake or a local copy:
+# only the files whose rows may have been updated in the time range are listed and opened (see
+# shared/watermark_index.py), only the row groups whose statistics may match the filters and only
+# the columns asked for are read.
+
+# Maximum number of partitions listed, and files read, at the same time
+DEFAULT_MAX_WORKERS = 8
+
+# Hourly files are named after the time of the ingestion, truncated to the hour or to the second
+FILE_TIME_FORMAT = "%H:%M:%S"
+FILE_SPAN = datetime.timedelta(hours=1)
+
+# Smaller files are downloaded in one request, larger ones read by ranges: footer, then column chunks
+RANGED_READ_MIN_SIZE = 4 * 1024 * 1024
+
+# Row filters, as (column, operator, value) tuples that must all hold
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda values, value: values.isin(value),
+    "not in": lambda values, value: ~values.isin(value),
+}
+
+
+class LocalSource:
+    # Bronze files under a local directory laid out as the Data Lake container
+    def __init__(self, root):
+        self.root = root
+
+    # Names and sizes of the files of a directory, empty when it does not exist
+    def list_files(self, directory):
+        path = os.path.join(self.root, directory)
+        if not os.path.isdir(path):
+            return []
+        return [
+            (entry.name, entry.stat().st_size) for entry in os.scandir(path) if entry.is_file()
+        ]
+
+    def open(self, file_path, size):
+        return open(os.path.join(self.root, file_path), "rb")
+
+    # Content of a small file, None when it does not exist
+    def read(self, file_path):
+        try:
+            with open(os.path.join(self.root, file_path), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+
+class DataLakeRangeReader(io.RawIOBase):
+    # Seekable byte stream over a Data Lake file, every read is a ranged download
+    def __init__(self, file_client, size):
+        self.file_client = file_client
+        self.size = size
+        self.position = 0
+
+        # parquet reads the column chunks from its own threads
+        self.record = metrics.bind(metrics.record)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+
+        data = self.file_client.download_file(offset=self.position, length=length).readall()
+        self.record("download", http_calls=1, bytes_read=len(data))
+
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class DataLakeSource:
+    # Bronze files of a Data Lake container
+    def __init__(self, file_system_client, ranged_read_min_size=RANGED_READ_MIN_SIZE):
+        self.file_system_client = file_system_client
+        self.ranged_read_min_size = ranged_read_min_size
+
+    def list_files(self, directory):
+        metrics.record("list", http_calls=1)
+        try:
+            paths = self.file_system_client.get_paths(path=directory, recursive=False)
+            return [
+                (path.name.rsplit("/", 1)[-1], path.content_length) for path in paths if not path.is_directory
+            ]
+        except ResourceNotFoundError:
+            return []
+
+    def open(self, file_path, size):
+        file_client = self.file_system_client.get_file_client(file_path)
+        if size >= self.ranged_read_min_size:
+            return DataLakeRangeReader(file_client, size)
+
+        data = file_client.download_file().readall()
+        metrics.record("download", http_calls=1, bytes_read=len(data))
+        return io.BytesIO(data)
+
+    def read(self, file_path):
+        metrics.record("download", http_calls=1)
+        try:
+            data = self.file_system_client.get_file_client(file_path).download_file().readall()
+        except ResourceNotFoundError:
+            return None
+        metrics.record("download", bytes_read=len(data))
+        return data
+
+
+# Source over the Data Lake container of the bronze directory
+def get_datalake_source(azure_credential, datalake_account_name, datalake_container_name):
+    return DataLakeSource(
+        get_datalake_service_client(
+            get_datalake_account_url(datalake_account_name), azure_credential
+        ).get_file_system_client(file_system=datalake_container_name)
+    )
+
+
+# Time of the ingestion of an hourly file, None for the daily file and names that are not data files
+def get_file_time(day, file_name):
+    if not file_name.endswith(".parquet") or file_name == DAILY_FILE_NAME:
+        return None
+    try:
+        time = datetime.datetime.strptime(file_name[:-len(".parquet")], FILE_TIME_FORMAT).time()
+    except ValueError:
+        return None
+    return datetime.datetime.combine(day, time)
+
+
+def get_days(first, last):
+    return [first + datetime.timedelta(days=offset) for offset in range((last - first).days + 1)]
+
+
+# Whether a file of a day partition may hold rows updated between start and end.
+# index_files holds the ranges of the files of the day, None when the day is not indexed.
+def may_hold(day, file_name, start, end, index_files):
+    # temporary and state files are not data files
+    if file_name != DAILY_FILE_NAME and get_file_time(day, file_name) is None:
+        return False
+
+    if index_files is not None:
+        # the daily file holds the rows of the hourly files of the day
+        if file_name in index_files:
+            return overlaps(index_files[file_name], start, end)
+        if file_name == DAILY_FILE_NAME:
+            return overlaps(get_day_range(index_files), start, end)
+
+    # a row is ingested after its update: files ingested before start only hold older rows
+    return file_name == DAILY_FILE_NAME or start < get_file_time(day, file_name) + FILE_SPAN
+
+
+# Files of the day partitions that may hold rows updated between start and end, in time order.
+# Without an index, every partition from start to the newest one may hold late rows; the partitions
+# of an index are only listed when their files hold rows of the range, those before its "since" always.
+def list_partition_files(source, datalake_directory_name, dataset_name, start, end, executor, index=None):
+    indexed = {} if index is None else {
+        datetime.date.fromisoformat(day): files for day, files in index["days"].items()
+    }
+    since = get_partition_now().date() + datetime.timedelta(days=1) if index is None else (
+        datetime.date.fromisoformat(index["since"]))
+
+    days = sorted(
+        {day for day in get_days(start.date(), since - datetime.timedelta(days=1)) if day not in indexed}
+        | {day for day, files in indexed.items() if day >= start.date() and overlaps(get_day_range(files), start, end)}
+    )
+    directories = [get_partition_path(datalake_directory_name, dataset_name, day) for day in days]
+
+    selected = []
+    for day, directory, files in zip(days, directories, executor.map(metrics.bind(source.list_files), directories)):
+        for file_name, size in sorted(files):
+            if may_hold(day, file_name, start, end, indexed.get(day)):
+                selected.append((f"{directory}/{file_name}", size))
+
+    return selected
+
+
+# Files of the day partitions written between start and end, in time order
+def list_ingested_files(source, datalake_directory_name, dataset_name, start, end, executor):
+    last = end - datetime.timedelta(microseconds=1)
+    days = get_days(start.date(), last.date())
+    directories = [get_partition_path(datalake_directory_name, dataset_name, day) for day in days]
+
+    selected = []
+    for day, directory, files in zip(days, directories, executor.map(metrics.bind(source.list_files), directories)):
+        for file_name, size in sorted(files):
+            # the daily file covers the whole day, a partial day is cut by the row filters
+            if file_name == DAILY_FILE_NAME:
+                selected.append((f"{directory}/{file_name}", size))
+                continue
+
+            file_time = get_file_time(day, file_name)
+            if file_time is not None and start < file_time + FILE_SPAN and file_time <= last:
+                selected.append((f"{directory}/{file_name}", size))
+
+    return selected
+
+
+def coerce_value(value, like):
+    if isinstance(like, datetime.datetime) and not isinstance(value, datetime.datetime):
+        return pd.Timestamp(value).to_pydatetime()
+    return value
+
+
+# Whether a row group may hold rows matching the filters, from the min/max statistics of its columns.
+# Filters on columns without statistics, or with values of another type, keep the row group.
+def may_match(row_group, column_indexes, filters):
+    for column, op, value in filters:
+        statistics = row_group.column(column_indexes[column]).statistics
+        if statistics is None or not statistics.has_min_max:
+            continue
+
+        minimum, maximum = statistics.min, statistics.max
+        try:
+            if op in ("==", "in"):
+                values = [coerce_value(item, minimum) for item in (value if op == "in" else [value])]
+                if not any(minimum <= item <= maximum for item in values):
+                    return False
+            elif op in ("<", "<="):
+                value = coerce_value(value, minimum)
+                if minimum > value or (op == "<" and minimum == value):
+                    return False
+            elif op in (">", ">="):
+                value = coerce_value(value, maximum)
+                if maximum < value or (op == ">" and maximum == value):
+                    return False
+        except (TypeError, ValueError):
+            continue
+
+    return True
+
+
+# Keep the rows matching every filter
+def filter_rows(df, filters):
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        mask &= OPERATORS[op](df[column], value).fillna(False).astype(bool)
+    return df[mask]
+
+
+# Read the row groups of a file that may match the filters, and its rows that do
+def read_file(source, file_path, size, columns, filters, schema):
+    with metrics.stage("download"):
+        with source.open(file_path, size) as file:
+            parquet_file = pq.ParquetFile(file, pre_buffer=True)
+            metadata = parquet_file.metadata
+
+            names = parquet_file.schema_arrow.names
+            column_indexes = {name: parquet_file.schema_arrow.get_field_index(name) for name in names}
+            missing = [column for column, _, _ in filters if column not in column_indexes]
+            if missing:
+                raise ValueError(f"{file_path} has no columns {missing} to filter on")
+
+            row_groups = [
+                index for index in range(metadata.num_row_groups)
+                if may_match(metadata.row_group(index), column_indexes, filters)
+            ]
+            filter_columns = {column for column, _, _ in filters}
+            read_columns = None if columns is None else [
+                name for name in names if name in columns or name in filter_columns
+            ]
+            table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+
+    with metrics.stage("transform", rows=table.num_rows):
+        df = table.to_pandas()
+
+        # files written before the schema hold strings, cast them before comparing
+        if schema is not None:
+            df = apply_schema(df, schema, file_path, partial=True)
+
+        df = filter_rows(df, filters)
+        if columns is not None:
+            df = df[[column for column in columns if column in df.columns]]
+
+    logging.info(
+        "read %s of %s row groups, %s rows from %s", len(row_groups), metadata.num_row_groups, len(df), file_path
+    )
+    return df
+
+
+# Read the rows of a bronze dataset updated between start (included) and end (excluded), as one frame.
+# source is a LocalSource or a DataLakeSource (see get_datalake_source).
+# columns projects the columns to return, filters are (column, operator, value) tuples that must all hold,
+# with the operators of OPERATORS, e.g. [("No_permis_installation", "==", "51218980")].
+# time_column holds the update time of the rows, the files are selected from the watermark index of the
+# dataset when it is on that column. None reads the files ingested in the time range instead, every row of them.
+def read_dataset(
+    source,
+    datalake_directory_name,
+    dataset_name,
+    start,
+    end,
+    columns=None,
+    filters=(),
+    time_column=DEFAULT_WATERMARK_COLUMN,
+    max_workers=None,
+):
+    start = pd.Timestamp(start).to_pydatetime()
+    end = pd.Timestamp(end).to_pydatetime()
+    if end <= start:
+        raise ValueError(f"empty time range {start} - {end}")
+
+    if max_workers is None:
+        max_workers = int(os.environ.get("READER_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+
+    filters = list(filters)
+    if time_column is not None:
+        filters += [(time_column, ">=", start), (time_column, "<", end)]
+
+    for _, op, _ in filters:
+        if op not in OPERATORS:
+            raise ValueError(f"unknown filter operator {op}")
+
+    schema = get_schema(dataset_name)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        with metrics.stage("list"):
+            if time_column is None:
+                files = list_ingested_files(source, datalake_directory_name, dataset_name, start, end, executor)
+            else:
+                index = load_watermark_index(source, datalake_directory_name, dataset_name)
+                if index is not None and index["column"] != time_column:
+                    index = None
+                files = list_partition_files(
+                    source, datalake_directory_name, dataset_name, start, end, executor, index)
+
+        frames = list(executor.map(
+            metrics.bind(lambda file: read_file(source, *file, columns, filters, schema)), files
+        ))
+
+    logging.info("read %s rows of %s from %s files", sum(map(len, frames)), dataset_name, len(files))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    # an empty frame still carries the columns and their types
+    frames = [frame for frame in frames if not frame.empty] or frames[:1]
+
+    # categories differ from file to file, cast the result back to the schema
+    df = pd.concat(frames, ignore_index=True)
+    if schema is not None:
+        df = apply_schema(df, schema, dataset_name, partial=True)
+
+    return df
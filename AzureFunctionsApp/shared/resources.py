@@ -0,0 +1,34 @@
+# ./shared/resources.py
+import json
+import os
+
+CKAN_API_URL = "https://www.donneesquebec.ca/recherche/api/3/action"
+
+# Registry file shipped next to function_app.py
+DEFAULT_RESOURCES_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "resources.json"
+)
+
+
+# Build the datastore_search url of a CKAN resource
+def get_resource_url(resource):
+    if resource.get("url"):
+        return resource["url"]
+    return f"{CKAN_API_URL}/datastore_search?resource_id={resource['resource_id']}"
+
+
+# Load the resources to ingest from the registry file
+# INGEST_RESOURCES_FILE points to another registry
+def load_resources(resources_file=None):
+    resources_file = resources_file or os.environ.get(
+        "INGEST_RESOURCES_FILE", DEFAULT_RESOURCES_FILE
+    )
+
+    with open(resources_file, encoding="utf-8") as registry:
+        resources = json.load(registry)
+
+    for resource in resources:
+        if "name" not in resource or not ("resource_id" in resource or "url" in resource):
+            raise ValueError(f"Invalid resource in {resources_file}: {resource}")
+
+    return resources
@@ -0,0 +1,336 @@
+# ./shared/rollups.py
+import datetime
+import json
+import logging
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+from shared import metrics
+from shared.clients import get_datalake_account_url, get_datalake_service_client
+from shared.datalake import download_from_datalake, get_partition_now, upload_to_datalake
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN, select_new_rows
+from shared.parquet import get_buffer_size, write_parquet
+from shared.reader import DataLakeSource, read_dataset
+
+# Daily and weekly occupancy of the emergency rooms, per establishment and per region, kept in the gold
+# directory as <dataset>/rollups/<period>_<level>/year=YYYY.parquet. Each row holds mergeable state
+# (sums, counts, maxima) next to the means and rates computed from it, so that the relevés ingested
+# since the last run are aggregated and merged in, without reading the history again.
+
+# Relevé measures rolled up, by the name of their columns in the rollups; absent columns are skipped
+MEASURES = {
+    "occupied_stretchers": "Nombre_de_civieres_occupees",
+    "functional_stretchers": "Nombre_de_civieres_fonctionnelles",
+    "patients_over_24h": "Nombre_de_patients_sur_civiere_plus_de_24_heures",
+    "patients_over_48h": "Nombre_de_patients_sur_civiere_plus_de_48_heures",
+    "patients_present": "Nombre_total_de_patients_presents_a_l'urgence",
+    "patients_waiting": "Nombre_de_patients_en_attente_de_PEC",
+}
+
+# Occupancy rate: occupied over functional stretchers, summed over the relevés reporting both
+RATE_NUMERATOR = "occupied_stretchers"
+RATE_DENOMINATOR = "functional_stretchers"
+
+# Grouping levels: their key columns, and label columns carried along (last value seen)
+LEVELS = {
+    "establishment": {
+        "keys": [DEFAULT_ESTABLISHMENT_COLUMN],
+        "labels": ["Nom_installation", "Nom_etablissement", "Region"],
+    },
+    "region": {
+        "keys": ["Region"],
+        "labels": [],
+    },
+}
+
+PERIODS = ("daily", "weekly")
+PERIOD_COLUMN = "period_start"
+REPORTS_COLUMN = "reports"
+
+ROLLUPS_DIRECTORY_NAME = "rollups"
+CURSOR_FILE_NAME = "_cursor.json"
+
+# Parquet key/value metadata of a rollup file: last relevé merged in, per establishment
+WATERMARKS_KEY = b"watermarks"
+
+# Relevés read on the first run, the datasets publish the last 7 days
+INITIAL_LOOKBACK = datetime.timedelta(days=8)
+
+# Attempts to merge into a rollup file rewritten by another run in the meantime
+MAX_MERGE_ATTEMPTS = 5
+
+
+def get_rollups_path(datalake_directory_name, dataset_name):
+    return f"{datalake_directory_name}/{dataset_name}/{ROLLUPS_DIRECTORY_NAME}"
+
+
+def get_rollup_directory(datalake_directory_name, dataset_name, period, level):
+    return f"{get_rollups_path(datalake_directory_name, dataset_name)}/{period}_{level}"
+
+
+def get_rollup_file_name(year):
+    return f"year={year}.parquet"
+
+
+# First day of the period of every timestamp, weeks start on Monday
+def get_period_start(timestamps, period):
+    days = timestamps.dt.normalize()
+    if period == "weekly":
+        return days - pd.to_timedelta(days.dt.weekday, unit="D")
+    return days
+
+
+# Mergeable state of the relevés, per period and group
+def aggregate(df, period, keys, labels, measures, watermark_column):
+    values = {name: df[column].astype("float64") for name, column in measures.items()}
+    work = pd.DataFrame({
+        PERIOD_COLUMN: get_period_start(pd.to_datetime(df[watermark_column], errors="coerce"), period),
+        **{column: df[column] for column in keys + labels},
+        REPORTS_COLUMN: 1,
+    })
+
+    aggregations = {REPORTS_COLUMN: (REPORTS_COLUMN, "sum")}
+    for name, series in values.items():
+        work[name] = series
+        aggregations.update({
+            f"{name}_sum": (name, "sum"),
+            f"{name}_count": (name, "count"),
+            f"{name}_max": (name, "max"),
+        })
+
+    if RATE_NUMERATOR in values and RATE_DENOMINATOR in values:
+        both = values[RATE_NUMERATOR].notna() & values[RATE_DENOMINATOR].notna()
+        work["rate_numerator"] = values[RATE_NUMERATOR].where(both)
+        work["rate_denominator"] = values[RATE_DENOMINATOR].where(both)
+        aggregations["rate_numerator_sum"] = ("rate_numerator", "sum")
+        aggregations["rate_denominator_sum"] = ("rate_denominator", "sum")
+
+    for label in labels:
+        aggregations[label] = (label, "last")
+
+    return work.groupby([PERIOD_COLUMN] + keys, observed=True, sort=False).agg(**aggregations).reset_index()
+
+
+# Merge rollup rows of the same period and group, then compute the means and rates from the merged state
+def merge(frames, keys):
+    df = pd.concat(frames, ignore_index=True)
+
+    aggregations = {}
+    for column in df.columns:
+        if column in [PERIOD_COLUMN] + keys or column.endswith("_mean") or column == "occupancy_rate":
+            continue
+        if column.endswith("_max"):
+            aggregations[column] = "max"
+        elif column == REPORTS_COLUMN or column.endswith("_sum") or column.endswith("_count"):
+            aggregations[column] = "sum"
+        else:
+            aggregations[column] = "last"
+
+    df = df.groupby([PERIOD_COLUMN] + keys, observed=True, sort=True).agg(aggregations).reset_index()
+
+    for column in list(df.columns):
+        if column.endswith("_count"):
+            name = column[:-len("_count")]
+            df[f"{name}_mean"] = df[f"{name}_sum"] / df[column].where(df[column] > 0)
+    if "rate_numerator_sum" in df.columns:
+        df["occupancy_rate"] = df["rate_numerator_sum"] / df["rate_denominator_sum"].where(
+            df["rate_denominator_sum"] > 0)
+
+    return df
+
+
+# Rows, watermarks and ETag of a rollup file, None for the rows and ETag of a missing one
+def read_rollup_file(file_system_client, file_path):
+    try:
+        downloader = file_system_client.get_file_client(file_path).download_file()
+        data = downloader.readall()
+    except ResourceNotFoundError:
+        metrics.record("download", http_calls=1)
+        return None, {}, None
+
+    metrics.record("download", http_calls=1, bytes_read=len(data))
+    table = pq.read_table(pa.BufferReader(data))
+    return (
+        table.to_pandas(),
+        json.loads((table.schema.metadata or {}).get(WATERMARKS_KEY, b"{}")),
+        downloader.properties.etag,
+    )
+
+
+# Write a rollup file next to the current one, then swap it in with an atomic rename, only if the
+# current one is still the one read (etag, None when there was none). The temporary file is named
+# for this write, two runs never rename each other's.
+# Raises ResourceModifiedError or ResourceExistsError when another run rewrote the file in the meantime
+def write_rollup_file(file_system_client, datalake_container_name, file_path, df, keys, watermarks, etag):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        WATERMARKS_KEY: json.dumps(watermarks, sort_keys=True).encode(),
+    })
+
+    buffer = write_parquet(table, sort_columns=[PERIOD_COLUMN] + keys)
+    size = get_buffer_size(buffer)
+
+    temp_client = file_system_client.get_file_client(f"{file_path}.{uuid.uuid4().hex}.tmp")
+    temp_client.upload_data(buffer, overwrite=True, length=size)
+    metrics.record("upload", http_calls=1, bytes_written=size, rows=len(df))
+
+    condition = (
+        {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag is not None
+        else {"match_condition": MatchConditions.IfMissing}
+    )
+    try:
+        temp_client.rename_file(f"{datalake_container_name}/{file_path}", **condition)
+    except (ResourceModifiedError, ResourceExistsError):
+        temp_client.delete_file()
+        metrics.record("upload", http_calls=2)
+        raise
+    metrics.record("upload", http_calls=1)
+
+
+# Merge relevés into the rollup files of a period and level, one file per year.
+# Every file records the last relevé merged in per establishment: the relevés it already holds are
+# skipped, so that rereading relevés, or rerunning after a failure, does not count them twice.
+# A file rewritten by another run between the read and the write is read and merged again.
+# Returns the paths of the files updated
+def merge_into_rollups(
+    file_system_client,
+    datalake_container_name,
+    directory,
+    df,
+    period,
+    level,
+    establishment_column=DEFAULT_ESTABLISHMENT_COLUMN,
+    watermark_column=DEFAULT_WATERMARK_COLUMN,
+):
+    keys = LEVELS[level]["keys"]
+    if any(column not in df.columns for column in keys):
+        logging.info("no %s columns %s to roll up", level, keys)
+        return []
+
+    labels = [column for column in LEVELS[level]["labels"] if column in df.columns and column not in keys]
+    measures = {name: column for name, column in MEASURES.items() if column in df.columns}
+
+    updated = []
+    years = get_period_start(pd.to_datetime(df[watermark_column], errors="coerce"), period).dt.year
+    for year in sorted(years.dropna().unique()):
+        file_path = f"{directory}/{get_rollup_file_name(int(year))}"
+
+        for attempt in range(MAX_MERGE_ATTEMPTS):
+            with metrics.stage("download"):
+                rollup_df, watermarks, etag = read_rollup_file(file_system_client, file_path)
+
+            with metrics.stage("transform"):
+                new_rows, watermarks = select_new_rows(
+                    df[years == year], watermarks, establishment_column, watermark_column)
+                if new_rows.empty:
+                    break
+
+                partial_df = aggregate(new_rows, period, keys, labels, measures, watermark_column)
+                rollup_df = merge([frame for frame in (rollup_df, partial_df) if frame is not None], keys)
+
+            try:
+                with metrics.stage("upload"):
+                    write_rollup_file(
+                        file_system_client, datalake_container_name, file_path, rollup_df, keys, watermarks, etag)
+            except (ResourceModifiedError, ResourceExistsError):
+                logging.info("%s rewritten by another run, merging again (attempt %s)", file_path, attempt + 1)
+                continue
+
+            updated.append(file_path)
+            break
+        else:
+            raise RuntimeError(f"{file_path} not updated after {MAX_MERGE_ATTEMPTS} attempts")
+
+    return updated
+
+
+# Roll up the relevés of a dataset ingested since the last run into its daily and weekly rollups.
+# Runs after each upload of the dataset. The cursor only bounds the partitions read: a run
+# after a failed one reads what the failed one did not merge, the rollup files skip what they hold.
+# Returns the paths of the rollup files updated
+def update_rollups(
+    azure_credential,
+    datalake_account_name,
+    datalake_container_name,
+    bronze_directory_name,
+    gold_directory_name,
+    dataset_name,
+    establishment_column=DEFAULT_ESTABLISHMENT_COLUMN,
+    watermark_column=DEFAULT_WATERMARK_COLUMN,
+):
+    file_system_client = get_datalake_service_client(
+        get_datalake_account_url(datalake_account_name), azure_credential
+    ).get_file_system_client(file_system=datalake_container_name)
+
+    rollups_path = get_rollups_path(gold_directory_name, dataset_name)
+    started = get_partition_now()
+
+    cursor = download_from_datalake(
+        azure_credential, datalake_account_name, datalake_container_name, rollups_path, CURSOR_FILE_NAME)
+    start = (
+        datetime.datetime.fromisoformat(json.loads(cursor)["ingested_through"])
+        if cursor is not None else started - INITIAL_LOOKBACK
+    )
+
+    # the partitions written since the last run, every relevé of them
+    df = read_dataset(
+        DataLakeSource(file_system_client),
+        bronze_directory_name,
+        dataset_name,
+        start,
+        started,
+        time_column=None,
+    )
+
+    updated = []
+    if not df.empty:
+        for period in PERIODS:
+            for level in LEVELS:
+                updated += merge_into_rollups(
+                    file_system_client,
+                    datalake_container_name,
+                    get_rollup_directory(gold_directory_name, dataset_name, period, level),
+                    df,
+                    period,
+                    level,
+                    establishment_column,
+                    watermark_column,
+                )
+
+    upload_to_datalake(
+        azure_credential, datalake_account_name, datalake_container_name, rollups_path, CURSOR_FILE_NAME,
+        json.dumps({"ingested_through": started.isoformat()}),
+    )
+
+    logging.info("rolled up %s relevés of %s into %s files", len(df), dataset_name, len(updated))
+    return updated
+
+
+# Read the rollup rows of the periods starting between start (included) and end (excluded)
+# source is a LocalSource or a DataLakeSource of the gold container (see shared/reader.py)
+def read_rollups(source, datalake_directory_name, dataset_name, period, level, start, end):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    directory = get_rollup_directory(datalake_directory_name, dataset_name, period, level)
+
+    years = range(start.year, end.year + 1)
+    files = dict(source.list_files(directory))
+
+    frames = []
+    for year in years:
+        file_name = get_rollup_file_name(year)
+        if file_name not in files:
+            continue
+        with source.open(f"{directory}/{file_name}", files[file_name]) as file:
+            df = pq.read_table(file, filters=[(PERIOD_COLUMN, ">=", start), (PERIOD_COLUMN, "<", end)]).to_pandas()
+        frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(columns=[PERIOD_COLUMN] + LEVELS[level]["keys"])
+
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,114 @@
+# ./shared/runner.py
+import datetime
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from shared import metrics
+from shared.azure_credential import get_azure_default_credential
+from shared.compaction import compact_day
+from shared.datalake import get_partition_now
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.ingest import ingest_from_api
+from shared.resources import get_resource_url, load_resources
+from shared.rollups import update_rollups
+from shared.schema import get_schema
+
+# Maximum number of resources fetched, parsed and uploaded at the same time
+DEFAULT_MAX_WORKERS = 4
+
+
+# Ingest one resource and report its outcome instead of raising
+def ingest_resource(resource):
+    try:
+        result = ingest_from_api(get_resource_url(resource), resource["name"], resource)
+    except Exception as e:
+        logging.error("ingestion failed for %s: %s", resource["name"], e)
+        return {"name": resource["name"], "status": "failed", "error": str(e)}
+
+    # roll the new relevés up, the next upload catches up a failed rollup
+    if result == "uploaded" and resource.get("rollups"):
+        try:
+            rollup_resource(resource)
+        except Exception as e:
+            logging.error("rollups failed for %s: %s", resource["name"], e)
+            return {"name": resource["name"], "status": "failed", "result": result, "error": str(e)}
+
+    return {"name": resource["name"], "status": "succeeded", "result": result}
+
+
+# Merge the relevés ingested since the last rollup of a resource into its gold rollups
+def rollup_resource(resource):
+    return update_rollups(
+        get_azure_default_credential(),
+        os.environ.get("ADLS_RESOURCE_NAME"),
+        os.environ.get("ADLS_CONTAINER_NAME"),
+        os.environ.get("ADLS_DIRECTORY_NAME_BRONZE"),
+        os.environ.get("ADLS_DIRECTORY_NAME_GOLD"),
+        resource["name"],
+        establishment_column=resource.get("establishment_column", DEFAULT_ESTABLISHMENT_COLUMN),
+        watermark_column=resource.get("watermark_column", DEFAULT_WATERMARK_COLUMN),
+    )
+
+
+# Compact one finished day of a resource and report its outcome instead of raising
+def compact_resource(resource, day):
+    try:
+        result = compact_day(
+            get_azure_default_credential(),
+            os.environ.get("ADLS_RESOURCE_NAME"),
+            os.environ.get("ADLS_CONTAINER_NAME"),
+            os.environ.get("ADLS_DIRECTORY_NAME_BRONZE"),
+            resource["name"],
+            day,
+            sort_columns=(
+                resource.get("establishment_column", DEFAULT_ESTABLISHMENT_COLUMN),
+                resource.get("watermark_column", DEFAULT_WATERMARK_COLUMN),
+            ),
+            schema=get_schema(resource.get("schema", resource["name"])),
+            watermark_column=resource.get("watermark_column", DEFAULT_WATERMARK_COLUMN),
+        )
+    except Exception as e:
+        logging.error("compaction failed for %s: %s", resource["name"], e)
+        return {"name": resource["name"], "status": "failed", "error": str(e)}
+
+    return {"name": resource["name"], "status": "succeeded", "result": result}
+
+
+# Run a task for every resource of the registry on a bounded thread pool
+def run_for_resources(label, task, resources=None, max_workers=None):
+    if resources is None:
+        resources = load_resources()
+
+    if max_workers is None:
+        max_workers = int(os.environ.get("INGEST_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+
+    if not resources:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(resources)))) as executor:
+        results = list(executor.map(metrics.bind(task), resources))
+
+    failed = [result["name"] for result in results if result["status"] == "failed"]
+    if failed:
+        metrics.mark_failed()
+    logging.info(
+        "%s %s resources, %s failed %s", label, len(results), len(failed), failed
+    )
+
+    return results
+
+
+# Ingest every resource of the registry
+def run_ingestion(resources=None, max_workers=None):
+    return run_for_resources("ingested", ingest_resource, resources, max_workers)
+
+
+# Compact a finished day, yesterday by default, of every resource of the registry
+def run_compaction(day=None, resources=None, max_workers=None):
+    if day is None:
+        day = get_partition_now().date() - datetime.timedelta(days=1)
+
+    return run_for_resources(
+        "compacted", lambda resource: compact_resource(resource, day), resources, max_workers
+    )
@@ -0,0 +1,134 @@
+# ./shared/schema.py
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Declared types of the columns of the Releve_horaire_urgences datasets.
+# CKAN serves every value as a string: the counts are cast to narrow nullable integers, the update time
+# to a timestamp, and the names and codes repeated on every relevé to categories (dictionary columns in parquet).
+# The types are fixed, not inferred from each batch, so that every hourly file of a dataset has the same schema.
+CATEGORY = "category"
+TIMESTAMP = "datetime64[ns]"
+COUNT = "Int16"
+ROW_ID = "Int32"
+
+URGENCES_COLUMNS = {
+    "_id": ROW_ID,
+    "Nom_etablissement": CATEGORY,
+    "Nom_installation": CATEGORY,
+    "No_permis_installation": CATEGORY,
+    "Nombre_de_civieres_fonctionnelles": COUNT,
+    "Nombre_de_civieres_occupees": COUNT,
+    "Nombre_de_patients_sur_civiere_plus_de_24_heures": COUNT,
+    "Nombre_de_patients_sur_civiere_plus_de_48_heures": COUNT,
+    "Heure_de_l'extraction_(image)": CATEGORY,
+    "Mise_a_jour": TIMESTAMP,
+}
+
+# Values published in place of a missing count
+MISSING_VALUES = ("", "pas d'information disponible")
+
+# Columns published in some extracts only
+URGENCES_OPTIONAL_COLUMNS = {
+    "Region": CATEGORY,
+}
+
+NBPERS_OPTIONAL_COLUMNS = {
+    **URGENCES_OPTIONAL_COLUMNS,
+    "Nombre_total_de_patients_presents_a_l'urgence": COUNT,
+    "Nombre_de_patients_en_attente_de_PEC": COUNT,
+}
+
+# Sorted by establishment and timestamp, the row ids and timestamps of an establishment grow by a
+# near constant step: their deltas encode in a few bits where a dictionary would hold every value
+URGENCES_COLUMN_ENCODING = {
+    "_id": "DELTA_BINARY_PACKED",
+    "Mise_a_jour": "DELTA_BINARY_PACKED",
+}
+
+# Schemas by dataset name, a resource of the registry can name another one with its "schema" key
+SCHEMAS = {
+    "Releve_horaire_urgences_7jours": {
+        "columns": URGENCES_COLUMNS,
+        "optional_columns": URGENCES_OPTIONAL_COLUMNS,
+        "column_encoding": URGENCES_COLUMN_ENCODING,
+    },
+    "Releve_horaire_urgences_7jours_nbpers": {
+        "columns": URGENCES_COLUMNS,
+        "optional_columns": NBPERS_OPTIONAL_COLUMNS,
+        "column_encoding": URGENCES_COLUMN_ENCODING,
+    },
+}
+
+
+# Schema of a dataset, None when the dataset is not declared
+def get_schema(name):
+    return SCHEMAS.get(name)
+
+
+def cast_integers(values, dtype):
+    if values.dtype == object:
+        # counts repeat a few distinct strings, parse each of them once; code -1 (missing) takes the trailing nan
+        codes, uniques = pd.factorize(values)
+        parsed = pd.to_numeric(pd.Series(uniques, dtype=object), errors="coerce").to_numpy(dtype=float)
+        numbers = np.append(parsed, np.nan)[codes]
+    else:
+        numbers = pd.to_numeric(values, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+    limits = np.iinfo(dtype.lower())
+
+    # out of range values would wrap around, negative counts are not counts
+    minimum = 0 if dtype == COUNT else limits.min
+    with np.errstate(invalid="ignore"):
+        mask = ~((numbers >= minimum) & (numbers <= limits.max) & (numbers % 1 == 0))
+
+    data = np.where(mask, 0, numbers).astype(limits.dtype)
+    return pd.Series(pd.arrays.IntegerArray(data, mask), index=values.index)
+
+
+# Cast a column to its declared type, values that do not parse become missing
+def cast_column(values, dtype):
+    if dtype == CATEGORY:
+        return values.astype(CATEGORY)
+
+    if dtype == TIMESTAMP:
+        return pd.to_datetime(values, errors="coerce", format="ISO8601")
+
+    return cast_integers(values, dtype)
+
+
+# Cast the records of a dataset to its schema and validate them.
+# Raises ValueError when a required column is missing. The missing value markers become missing values,
+# values that do not parse or are out of range too, counted in a warning. Undeclared columns are kept as is.
+# partial casts the declared columns present, for a projection of the records.
+def apply_schema(df, schema, name=None, partial=False):
+    name = name or "records"
+    missing = [column for column in schema["columns"] if column not in df.columns]
+    if missing and not partial:
+        raise ValueError(f"{name} is missing the columns {missing}")
+
+    dtypes = {**schema["columns"], **schema.get("optional_columns", {})}
+
+    undeclared = [column for column in df.columns if column not in dtypes]
+    if undeclared:
+        logging.warning("%s has undeclared columns, kept as is: %s", name, undeclared)
+
+    typed = {}
+    invalid = {}
+    for column in df.columns:
+        if column not in dtypes:
+            typed[column] = df[column]
+            continue
+
+        values = df[column].mask(df[column].isin(MISSING_VALUES))
+        typed[column] = cast_column(values, dtypes[column])
+
+        count = int((values.notna() & typed[column].isna()).sum())
+        if count:
+            invalid[column] = count
+
+    if invalid:
+        logging.warning("%s has invalid values, stored as missing: %s", name, invalid)
+
+    return pd.DataFrame(typed, index=df.index)
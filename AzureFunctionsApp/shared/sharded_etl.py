@@ -0,0 +1,309 @@
+# ./shared/sharded_etl.py
+import io
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import BlobProperties
+
+from shared import metrics
+from shared.cloudetl import (
+    AGGREGATIONS,
+    GroupSumAccumulator,
+    accumulate_relational_data,
+    archive_cooltier_blob_file,
+    write_dataframe_to_datalake,
+)
+from shared.clients import get_queue_account_url
+from shared.queues import QUEUE_CONNECTION
+
+# Sharded mode of the cloud ETL: a coordinator enqueues a work item per group of blobs, workers aggregate
+# their blobs into partial sums written to Data Lake, and the reducer merges the partials once they are all
+# written, then loads the result and archives the blobs as run_cloud_etl does.
+
+# Blobs aggregated by one work item, and rows parsed at a time by its worker
+DEFAULT_BLOBS_PER_SHARD = 8
+DEFAULT_SHARD_CHUNKSIZE = 100_000
+
+# Directory, under the output directory, of the manifest and partial sums of every run,
+# the file marking a run as reduced, and the lock of the reducer merging it
+PARTIALS_DIRECTORY_NAME = "_partials"
+MANIFEST_FILE_NAME = "manifest.json"
+DONE_FILE_NAME = "_SUCCESS"
+LOCK_FILE_NAME = "_REDUCING"
+
+# Seconds after which the lock of a reducer is taken over, longer than the functionTimeout of host.json,
+# and before a reduce request finding the run locked is delivered again
+DEFAULT_REDUCE_LOCK_TIMEOUT = 600
+REDUCE_RETRY_DELAY = 60
+
+# Parquet key/value metadata of a partial, with the integer flags of its aggregations
+INTEGER_COLUMNS_KEY = b"integer_columns"
+
+
+# Url of the queue service, from the identity-based connection setting or the ingest storage account
+def get_queue_service_url():
+    return os.environ.get(f"{QUEUE_CONNECTION}__queueServiceUri") or get_queue_account_url(
+        os.environ.get("ABS_RESOURCE_NAME"))
+
+
+# Runs are named after their start time, as the files written by run_cloud_etl,
+# with a random suffix so that two runs started in the same second do not share their partials
+def get_run_id(now=None):
+    return f'{(now or datetime.today()).strftime("%Y%m%d_%H%M%S")}_{uuid.uuid4().hex[:8]}'
+
+
+# Blobs of the manifest of a run, with their creation time when it was listed
+def get_manifest_blobs(manifest):
+    landed_at = manifest.get("landed_at", {})
+    blobs = []
+    for blob_names in manifest["blobs"]:
+        for blob_name in blob_names:
+            blob = BlobProperties(name=blob_name)
+            if blob_name in landed_at:
+                blob.creation_time = datetime.fromisoformat(landed_at[blob_name])
+            blobs.append(blob)
+    return blobs
+
+
+def get_partials_path(job):
+    return f'{job["dir_name"]}/{PARTIALS_DIRECTORY_NAME}/{job["run_id"]}'
+
+
+def get_shard_file_name(shard):
+    return f"shard-{shard:05d}.parquet"
+
+
+# Split the blobs in groups of blobs_per_shard names, in listing order
+def plan_shards(blob_file_list, blobs_per_shard):
+    blob_names = [blob.name for blob in blob_file_list]
+    return [blob_names[start:start + blobs_per_shard] for start in range(0, len(blob_names), blobs_per_shard)]
+
+
+def upload_file(datalake_service_client, job, file_name, data):
+    file_client = datalake_service_client.get_file_client(
+        job["filesystem_name"], f"{get_partials_path(job)}/{file_name}")
+    file_client.upload_data(data, overwrite=True)
+    metrics.record("upload", http_calls=1, bytes_written=len(data))
+
+
+def download_file(datalake_service_client, job, file_name):
+    data = datalake_service_client.get_file_client(
+        job["filesystem_name"], f"{get_partials_path(job)}/{file_name}").download_file().readall()
+    metrics.record("download", http_calls=1, bytes_read=len(data))
+    return data
+
+
+# Write the manifest of a run and enqueue a work item per shard
+# job holds the settings of run_cloud_etl: storage_account_url, source_container, archive_container,
+# datalake_account_url, filesystem_name, dir_name, file_format, file_prefix, columns and groupby_columns.
+# Returns the job, with its run_id and number of shards.
+def start_sharded_etl(queue_client, datalake_service_client, job, blob_file_list, blobs_per_shard=None, chunksize=None):
+    if blobs_per_shard is None:
+        blobs_per_shard = int(os.environ.get("CLOUDETL_BLOBS_PER_SHARD", DEFAULT_BLOBS_PER_SHARD))
+
+    shards = plan_shards(blob_file_list, max(1, blobs_per_shard))
+    job = dict(
+        job,
+        run_id=job.get("run_id") or get_run_id(),
+        shards=len(shards),
+        chunksize=chunksize or DEFAULT_SHARD_CHUNKSIZE,
+    )
+
+    if not shards:
+        logging.info("no blobs to process for run %s", job["run_id"])
+        return job
+
+    # the manifest lists every blob, with the creation times kept on their archive copies, the work items only theirs
+    landed_at = {blob.name: blob.creation_time.isoformat()
+                 for blob in blob_file_list if getattr(blob, "creation_time", None) is not None}
+    upload_file(datalake_service_client, job, MANIFEST_FILE_NAME,
+                json.dumps(dict(job, blobs=shards, landed_at=landed_at)))
+
+    for shard, blob_names in enumerate(shards):
+        queue_client.send_message(json.dumps(dict(job, shard=shard, blobs=blob_names)))
+    metrics.record("upload", http_calls=len(shards))
+
+    logging.info("run %s: enqueued %s shards of %s blobs", job["run_id"], len(shards), len(blob_file_list))
+    return job
+
+
+# Write the partial sums of a shard, overwriting those of an earlier attempt
+def write_partial(datalake_service_client, job, accumulator):
+    partial_df = accumulator.to_partial()
+
+    table = pa.Table.from_pandas(partial_df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        INTEGER_COLUMNS_KEY: json.dumps(partial_df.attrs["integer_columns"]).encode(),
+    })
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    upload_file(datalake_service_client, job, get_shard_file_name(job["shard"]), buffer.getvalue())
+
+
+def read_partial(datalake_service_client, job, shard):
+    table = pq.read_table(pa.BufferReader(download_file(datalake_service_client, job, get_shard_file_name(shard))))
+
+    partial_df = table.to_pandas()
+    partial_df.attrs["integer_columns"] = json.loads(table.schema.metadata[INTEGER_COLUMNS_KEY])
+    return partial_df
+
+
+# Worker: aggregate the blobs of a work item, write their partial sums and ask for a reduce
+def run_shard(job, blob_service_client, datalake_service_client, reduce_queue_client):
+    container_client = blob_service_client.get_container_client(job["source_container"])
+    blob_file_list = [BlobProperties(name=blob_name) for blob_name in job["blobs"]]
+
+    with metrics.stage("transform"):
+        accumulator = accumulate_relational_data(
+            container_client, blob_file_list, job["columns"], job["groupby_columns"], job["chunksize"])
+
+    with metrics.stage("upload"):
+        write_partial(datalake_service_client, job, accumulator)
+
+    # every finished shard asks, the reducer only proceeds once all the partials are written
+    reduce_queue_client.send_message(json.dumps({key: value for key, value in job.items() if key != "blobs"}))
+    metrics.record("upload", http_calls=1)
+
+    logging.info("run %s: shard %s aggregated %s blobs", job["run_id"], job["shard"], len(blob_file_list))
+
+
+# Names of the files of the run under its partials directory
+def list_partials(file_system_client, job):
+    with metrics.stage("list", http_calls=1):
+        try:
+            return {
+                path.name.rsplit("/", 1)[-1] for path in file_system_client.get_paths(path=get_partials_path(job))
+            }
+        except ResourceNotFoundError:
+            return set()
+
+
+# Create the lock file of the run, only if no other reducer holds it: the create is conditional
+# (IfMissing, If-None-Match: *), so of two reducers creating it at once only one succeeds.
+# overwrite=False would not do: the SDK then appends to the path without creating it.
+# A lock older than the timeout was left by a reducer that died, it is deleted if unchanged since read.
+# Returns the lock file client and the ETag of the lock, None when another reducer holds the lock
+def acquire_reduce_lock(file_system_client, job, lock_timeout=None):
+    if lock_timeout is None:
+        lock_timeout = float(os.environ.get("CLOUDETL_REDUCE_LOCK_TIMEOUT", DEFAULT_REDUCE_LOCK_TIMEOUT))
+
+    file_client = file_system_client.get_file_client(f"{get_partials_path(job)}/{LOCK_FILE_NAME}")
+    lock = json.dumps({"taken_at": datetime.now(timezone.utc).isoformat(), "owner": uuid.uuid4().hex})
+
+    for _ in range(2):
+        try:
+            response = file_client.upload_data(lock, overwrite=True, match_condition=MatchConditions.IfMissing)
+            metrics.record("upload", http_calls=1)
+            return file_client, response["etag"]
+        except ResourceExistsError:
+            pass
+
+        try:
+            downloader = file_client.download_file()
+            held = json.loads(downloader.readall())
+            metrics.record("download", http_calls=1)
+        except ResourceNotFoundError:
+            continue
+
+        taken_at = datetime.fromisoformat(held["taken_at"])
+        if datetime.now(timezone.utc) - taken_at < timedelta(seconds=lock_timeout):
+            return None
+
+        logging.warning("run %s: taking over the lock taken at %s", job["run_id"], held["taken_at"])
+        try:
+            file_client.delete_file(etag=downloader.properties.etag, match_condition=MatchConditions.IfNotModified)
+            metrics.record("upload", http_calls=1)
+        except (ResourceModifiedError, ResourceNotFoundError):
+            pass
+
+    return None
+
+
+# Delete the lock of the run, unless it timed out and another reducer took it over since
+def release_reduce_lock(job, file_client, etag):
+    try:
+        file_client.delete_file(etag=etag, match_condition=MatchConditions.IfNotModified)
+    except (ResourceModifiedError, ResourceNotFoundError):
+        logging.warning("run %s: the lock was taken over by another reducer", job["run_id"])
+    metrics.record("upload", http_calls=1)
+
+
+# Reducer: once every shard of the run wrote its partial, merge them in shard order, load the result
+# and archive the blobs. Safe to rerun: a reduced run is marked done, and its output name is fixed.
+# Only the reducer holding the lock of the run merges it. The others leave, sending the request again
+# with reduce_queue_client, when given, so that a run whose reducer dies is reduced once its lock times out.
+# Returns "reduced", "waiting" (partials missing), "locked" (another reducer is merging) or "done" (already reduced)
+def reduce_sharded_etl(job, blob_service_client, datalake_service_client, reduce_queue_client=None):
+    file_system_client = datalake_service_client.get_file_system_client(file_system=job["filesystem_name"])
+    file_names = list_partials(file_system_client, job)
+
+    if DONE_FILE_NAME in file_names:
+        return "done"
+
+    shard_file_names = [get_shard_file_name(shard) for shard in range(job["shards"])]
+    missing = [file_name for file_name in shard_file_names if file_name not in file_names]
+    if missing:
+        logging.info("run %s: waiting for %s of %s shards", job["run_id"], len(missing), job["shards"])
+        return "waiting"
+
+    lock = acquire_reduce_lock(file_system_client, job)
+    if lock is None:
+        logging.info("run %s: another reducer holds the lock", job["run_id"])
+        if reduce_queue_client is not None:
+            reduce_queue_client.send_message(json.dumps(job), visibility_timeout=REDUCE_RETRY_DELAY)
+            metrics.record("upload", http_calls=1)
+        return "locked"
+
+    try:
+        # a reducer may have finished the run between the listing and the lock
+        if DONE_FILE_NAME in list_partials(file_system_client, job):
+            return "done"
+        processed_df = merge_partials(job, blob_service_client, datalake_service_client, file_system_client)
+    finally:
+        release_reduce_lock(job, *lock)
+
+    logging.info("run %s: reduced %s shards into %s groups", job["run_id"], job["shards"], len(processed_df))
+    return "reduced"
+
+
+# Merge the partials of a run, load the result, archive the blobs and mark the run done
+def merge_partials(job, blob_service_client, datalake_service_client, file_system_client):
+    shard_file_names = [get_shard_file_name(shard) for shard in range(job["shards"])]
+    manifest = json.loads(download_file(datalake_service_client, job, MANIFEST_FILE_NAME))
+
+    accumulator = GroupSumAccumulator(job["groupby_columns"], AGGREGATIONS)
+    for shard in range(job["shards"]):
+        with metrics.stage("download"):
+            partial_df = read_partial(datalake_service_client, job, shard)
+        with metrics.stage("transform"):
+            accumulator.merge(partial_df)
+
+    with metrics.stage("transform"):
+        processed_df = accumulator.result()
+
+    with metrics.stage("upload"):
+        write_dataframe_to_datalake(
+            processed_df, datalake_service_client, job["filesystem_name"], job["dir_name"],
+            f'{job["file_prefix"]}_{job["run_id"]}.{job["file_format"]}')
+
+    with metrics.stage("archive"):
+        archive_cooltier_blob_file(
+            blob_service_client, job["storage_account_url"], job["source_container"], job["archive_container"],
+            get_manifest_blobs(manifest))
+
+    # keep the manifest and the done marker as the record of the run, the partials are not needed anymore
+    upload_file(datalake_service_client, job, DONE_FILE_NAME, b"")
+    with metrics.stage("upload", http_calls=len(shard_file_names)):
+        for file_name in shard_file_names:
+            file_system_client.get_file_client(f"{get_partials_path(job)}/{file_name}").delete_file()
+
+    return processed_df
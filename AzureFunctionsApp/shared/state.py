@@ -0,0 +1,38 @@
+# ./shared/state.py
+import json
+import os
+
+from shared.datalake import download_from_datalake, upload_to_datalake
+
+# Directory, under the bronze directory, holding the per resource state files
+STATE_DIRECTORY_NAME = "_state"
+
+
+# Get the Data Lake location of the state files
+def get_state_location():
+    datalake_account_name = os.environ.get("ADLS_RESOURCE_NAME")
+    datalake_container_name = os.environ.get("ADLS_CONTAINER_NAME")
+    datalake_directory_name = os.environ.get("ADLS_DIRECTORY_NAME_BRONZE")
+
+    return (
+        datalake_account_name,
+        datalake_container_name,
+        f"{datalake_directory_name}/{STATE_DIRECTORY_NAME}",
+    )
+
+
+# Load the persisted state of a resource, empty when it was never saved
+def load_state(azure_credential, name):
+    data = download_from_datalake(azure_credential, *get_state_location(), f"{name}.json")
+
+    if data is None:
+        return {}
+
+    return json.loads(data)
+
+
+# Persist the state of a resource
+def save_state(azure_credential, name, state):
+    return upload_to_datalake(
+        azure_credential, *get_state_location(), f"{name}.json", json.dumps(state, sort_keys=True)
+    )
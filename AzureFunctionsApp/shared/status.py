@@ -0,0 +1,226 @@
+# ./shared/status.py
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+
+from shared.datalake import get_partition_now
+from shared.delta import DEFAULT_ESTABLISHMENT_COLUMN, DEFAULT_WATERMARK_COLUMN
+from shared.reader import read_dataset
+from shared.rollups import MEASURES
+
+# Latest relevé of every establishment of a dataset, kept in memory by the worker to answer the
+# current_status function without reading the lake. An index is warmed from the files ingested over the
+# last WARM_LOOKBACK_DAYS on its first request, updated with the rows of every ingestion the worker runs,
+# and reads the files written since by the other workers once it is older than the refresh interval.
+
+REGION_COLUMN = "Region"
+LABEL_COLUMNS = ["Nom_etablissement", "Nom_installation", REGION_COLUMN]
+
+# Day partitions read to warm an index, the datasets publish the relevés of the last 7 days
+WARM_LOOKBACK_DAYS = 7
+
+# Seconds between two reads of the files written by the other workers
+DEFAULT_REFRESH_INTERVAL = 60
+
+# Serialized responses kept per index, by filter, until the next update
+MAX_CACHED_RESPONSES = 256
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+# JSON value of a cell: ISO timestamps, Python numbers, None for missing values
+def to_json_value(value):
+    if isinstance(value, (list, tuple, dict)):
+        return value
+    if pd.isna(value):
+        return None
+    if isinstance(value, (pd.Timestamp, datetime.datetime)):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+# Whether an If-None-Match header holds the ETag of the response
+def matches_etag(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+
+    # If-None-Match compares weakly
+    return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+
+class StatusIndex:
+    # Latest relevé per establishment, as JSON ready dicts, the establishments of every region,
+    # and the serialized responses already asked for
+    def __init__(
+        self,
+        dataset_name,
+        establishment_column=DEFAULT_ESTABLISHMENT_COLUMN,
+        watermark_column=DEFAULT_WATERMARK_COLUMN,
+    ):
+        self.dataset_name = dataset_name
+        self.establishment_column = establishment_column
+        self.watermark_column = watermark_column
+        self.columns = [establishment_column] + LABEL_COLUMNS + [watermark_column] + list(MEASURES.values())
+
+        self.records = {}
+        self.watermarks = {}
+        self.regions = {}
+        self.responses = {}
+        self.lock = threading.Lock()
+
+        # partition time the lake was read up to, and when
+        self.read_through = None
+        self.refreshed = None
+        self.refresh_lock = threading.Lock()
+
+    # Keep the rows newer than the relevé held for their establishment
+    # Returns the number of establishments updated
+    def update(self, df):
+        if df.empty or self.establishment_column not in df.columns or self.watermark_column not in df.columns:
+            return 0
+
+        df = df[[column for column in self.columns if column in df.columns]].copy()
+        df[self.watermark_column] = pd.to_datetime(df[self.watermark_column], errors="coerce")
+        latest = df.dropna(subset=[self.watermark_column]).sort_values(
+            self.watermark_column, kind="stable").drop_duplicates(self.establishment_column, keep="last")
+
+        updated = 0
+        with self.lock:
+            for row in latest.to_dict("records"):
+                establishment = str(row[self.establishment_column])
+                watermark = row[self.watermark_column]
+                if establishment in self.watermarks and self.watermarks[establishment] > watermark:
+                    continue
+
+                record = {column: to_json_value(value) for column, value in row.items()}
+                record[self.establishment_column] = establishment
+                previous = self.records.get(establishment)
+                if record == previous:
+                    continue
+
+                if previous is not None:
+                    self.regions.get(previous.get(REGION_COLUMN), set()).discard(establishment)
+                self.regions.setdefault(record.get(REGION_COLUMN), set()).add(establishment)
+                self.records[establishment] = record
+                self.watermarks[establishment] = watermark
+                updated += 1
+
+            if updated:
+                self.responses.clear()
+
+        return updated
+
+    # Read the relevés of every day partition of the look-back window and keep the latest of each
+    # establishment, so that the establishments that did not report on the last day are served too
+    def warm(self, source, datalake_directory_name):
+        now = get_partition_now()
+        start = datetime.datetime.combine(
+            now.date() - datetime.timedelta(days=WARM_LOOKBACK_DAYS - 1), datetime.time())
+        df = read_dataset(
+            source, datalake_directory_name, self.dataset_name, start, now,
+            columns=self.columns, time_column=None,
+        )
+
+        updated = self.update(df)
+        self.read_through, self.refreshed = now, time.monotonic()
+        logging.info("status of %s warmed from %s: %s establishments", self.dataset_name, start.date(), updated)
+
+    # Read the files written since the last read, the files of the hour before included
+    def refresh(self, source, datalake_directory_name):
+        now = get_partition_now()
+        df = read_dataset(
+            source, datalake_directory_name, self.dataset_name, self.read_through, now,
+            columns=self.columns, time_column=None,
+        )
+
+        updated = self.update(df)
+        self.read_through, self.refreshed = now, time.monotonic()
+        logging.info("status of %s refreshed: %s establishments updated", self.dataset_name, updated)
+
+    # Body and ETag of the relevés of the establishments and regions asked for, every relevé when none are
+    def get_response(self, establishments=(), regions=()):
+        key = (tuple(sorted(set(establishments))), tuple(sorted(set(regions))))
+
+        with self.lock:
+            response = self.responses.get(key)
+            if response is not None:
+                return response
+
+            if key == ((), ()):
+                names = self.records.keys()
+            else:
+                names = set(key[0])
+                for region in key[1]:
+                    names |= self.regions.get(region, set())
+
+            body = json.dumps({
+                "dataset": self.dataset_name,
+                "establishments": [self.records[name] for name in sorted(names) if name in self.records],
+            }, ensure_ascii=False, sort_keys=True).encode("utf-8")
+
+            # from the content, so that every worker holding the same relevés gives the same ETag
+            response = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+
+            if len(self.responses) >= MAX_CACHED_RESPONSES:
+                self.responses.clear()
+            self.responses[key] = response
+
+        return response
+
+
+# Get the status index of a dataset, warmed on the first call and refreshed once older than refresh_interval.
+# source is a LocalSource or a DataLakeSource of the bronze container (see shared/reader.py).
+# A failed refresh is logged and the relevés already held are served until the next one.
+def get_status_index(
+    source,
+    datalake_directory_name,
+    dataset_name,
+    establishment_column=DEFAULT_ESTABLISHMENT_COLUMN,
+    watermark_column=DEFAULT_WATERMARK_COLUMN,
+    refresh_interval=None,
+):
+    if refresh_interval is None:
+        refresh_interval = float(os.environ.get("STATUS_REFRESH_INTERVAL", DEFAULT_REFRESH_INTERVAL))
+
+    with _indexes_lock:
+        index = _indexes.get(dataset_name)
+        if index is None:
+            index = _indexes[dataset_name] = StatusIndex(dataset_name, establishment_column, watermark_column)
+
+    if index.refreshed is None:
+        with index.refresh_lock:
+            if index.refreshed is None:
+                index.warm(source, datalake_directory_name)
+
+    # one request refreshes, the others are answered from the relevés already held
+    elif time.monotonic() - index.refreshed >= refresh_interval and index.refresh_lock.acquire(blocking=False):
+        try:
+            index.refresh(source, datalake_directory_name)
+        except Exception as e:
+            logging.warning("status of %s not refreshed: %s", dataset_name, e)
+            index.refreshed = time.monotonic()
+        finally:
+            index.refresh_lock.release()
+
+    return index
+
+
+# Update the status index of a dataset, when this worker holds one, with the rows it just ingested
+def update_status_index(dataset_name, df):
+    with _indexes_lock:
+        index = _indexes.get(dataset_name)
+
+    if index is None or index.refreshed is None:
+        return 0
+
+    return index.update(df)
@@ -3,14 +3,25 @@ import html
 import json
 import logging
 import re
+from itertools import islice
 
-import requests
-from bs4 import BeautifulSoup
+from shared import metrics
+from shared.fetch import MAX_WORKERS, fetch_url, fetch_url_cached, fetch_urls
+from shared.html_text import get_extractor
+from shared.http_cache import get_article_cache
 
+# HTML tags, and what normalize_text removes after the numbers
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+NUMBER_PATTERN = re.compile(r"\d+")
+PUNCTUATION_PATTERN = re.compile(r"(@\[A-Za-z0-9]+)|([^0-9A-Za-z \t])|(\w+:\/\/\S+)|^rt|http.+?")
 
-# HTTP request for URL contents
+
+# HTTP request for URL contents, through the article cache when enabled
 def get_content_from_url(url):
-    return requests.get(url).content
+    cache = get_article_cache()
+    if cache is not None:
+        return fetch_url_cached(url, cache)
+    return fetch_url(url)
 
 
 # clean metadata
@@ -26,56 +37,41 @@ def clean_metadata(jsonitem):
     article_descr = remove_html_tags(jsonitem["description"])
 
     # get article contents
-    article_text = get_html_text(requests.get(article_url).content)
+    article_text = get_html_text(get_content_from_url(article_url))
 
     return article_url, article_title, article_descr, article_text
 
 
 # strip HTML tags from a string.
 def remove_html_tags(html_text):
-    return html.escape(re.compile(r"<[^>]+>").sub("", str(html_text)))
+    return html.escape(HTML_TAG_PATTERN.sub("", str(html_text)))
 
 
 # get all text of a news article
 # assume heavy use of `<p>`` (paragraph) HTML tag
-def get_html_text(page_html):
-
-    soup = BeautifulSoup(page_html, "html.parser")
-    text = soup.find_all("p", text=True)
-    text = remove_html_tags(str(text))
+# the paragraphs are found by the extractor configured with HTML_TEXT_EXTRACTOR (see shared/html_text.py)
+def get_html_text(page_html, extractor=None):
+    return remove_html_tags(get_extractor(extractor)(page_html))
 
-    return text
 
-
-# normalize text
+# normalize text: lowercase, remove numbers, then punctuation except words and space, and white space.
+# numbers are removed first so that `^rt` still applies to what follows a leading number.
 def normalize_text(text_string):
+    text = PUNCTUATION_PATTERN.sub("", NUMBER_PATTERN.sub("", text_string.lower())).strip()
 
-    # Lowercase text
-    lower_string = text_string.lower()
-
-    # remove numbers
-    no_number_string = re.sub(r"\d+", "", lower_string)
-
-    # remove punctuation except words and space
-    no_punc_string = re.sub(
-        r"(@\[A-Za-z0-9]+)|([^0-9A-Za-z \t])|(\w+:\/\/\S+)|^rt|http.+?",
-        "",
-        no_number_string,
-    )
-
-    # remove white space
-    no_wspace_string = no_punc_string.strip()
-
-    # decode unicode to handle special characters
-    json_bytes = no_wspace_string.encode()
-    json_str_decoded = json.dumps(json_bytes.decode("utf-8", errors="ignore"))
-
-    return json_str_decoded
+    # quote and escape special characters
+    return json.dumps(text)
 
 
 # Loop through and process each search result
 def clean_documents(data_dictionary):
 
+    # download every news article concurrently, before processing the results.
+    # articles already in the cache cost at most a conditional request.
+    cache = get_article_cache()
+    with metrics.stage("download"):
+        articles = fetch_urls((item["url"] for item in data_dictionary), cache=cache)
+
     for item in data_dictionary:
 
         # get news article URL.
@@ -88,17 +84,43 @@ def clean_documents(data_dictionary):
         # get and remove any html tags in the short description of the news article.
         item["description"] = remove_html_tags(item["description"])
 
-        # get the new article contents and store text.
-        article_text = get_html_text(requests.get(article_url).content)
+        # mark the articles that could not be downloaded instead of failing the batch.
+        article_content, fetch_error = articles[article_url]
+        if fetch_error is not None:
+            item["article_text"] = ""
+            item["fetch_error"] = fetch_error
+            continue
+
+        # reuse the text extracted from the same article body.
+        article_text_norm = cache.get_text(article_url) if cache is not None else None
+
+        if article_text_norm is None:
+            # get the new article contents and store text.
+            article_text = get_html_text(article_content)
 
-        # remove any html tags in the news article's text.
-        article_text = remove_html_tags(article_text)
+            # remove any html tags in the news article's text.
+            article_text = remove_html_tags(article_text)
 
-        # preprocess/normalize new article's text to make it easier to
-        # consume by analytic applications.
-        article_text_norm = normalize_text(article_text)
+            # preprocess/normalize new article's text to make it easier to
+            # consume by analytic applications.
+            article_text_norm = normalize_text(article_text)
+
+            if cache is not None:
+                cache.set_text(article_url, article_text_norm)
 
         # add new data to dictionary
         item["article_text"] = article_text_norm
 
-    return data_dictionary
\ No newline at end of file
+    return data_dictionary
+
+
+# Clean documents as they arrive, a batch at a time so that their articles are still downloaded concurrently
+def iter_clean_documents(documents, batch_size=MAX_WORKERS):
+    documents = iter(documents)
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            return
+        with metrics.stage("transform", rows=len(batch)):
+            batch = clean_documents(batch)
+        yield from batch
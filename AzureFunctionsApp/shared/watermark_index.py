@@ -0,0 +1,102 @@
+# ./shared/watermark_index.py
+import json
+import logging
+
+import pandas as pd
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+from shared import metrics
+from shared.state import STATE_DIRECTORY_NAME
+
+# Update times of the rows of every bronze file of a dataset, kept next to the state files as
+# <bronze>/_state/<dataset>.watermarks.json. A file lands in the partition of its ingestion time, while
+# its rows may be days older (the first delta run, a run catching up after an outage): readers select the
+# files from the range of their rows, not from their partition.
+#   {"column": "Mise_a_jour", "since": "2023-09-24",
+#    "days": {"2023-09-24": {"10:00:00.parquet": ["2023-09-21T10:00:00", "2023-09-24T09:00:00"]}}}
+# The partitions before "since" were written before the index, only those indexed since are in it.
+
+WATERMARK_INDEX_SUFFIX = ".watermarks.json"
+
+# Attempts of an update losing the race to another writer of the index
+MAX_UPDATE_ATTEMPTS = 5
+
+
+def get_watermark_index_path(datalake_directory_name, dataset_name):
+    return f"{datalake_directory_name}/{STATE_DIRECTORY_NAME}/{dataset_name}{WATERMARK_INDEX_SUFFIX}"
+
+
+# First and last update time of the rows of a frame, as ISO strings, None when it has none
+def get_watermark_range(df, watermark_column):
+    if watermark_column not in df.columns:
+        return None
+
+    values = pd.to_datetime(df[watermark_column], errors="coerce").dropna()
+    if values.empty:
+        return None
+
+    return [values.min().isoformat(), values.max().isoformat()]
+
+
+# Range covering the ranges of the files of a day, None when it has none
+def get_day_range(files):
+    ranges = [watermarks for watermarks in files.values() if watermarks is not None]
+    if not ranges:
+        return None
+    return [min(watermarks[0] for watermarks in ranges), max(watermarks[1] for watermarks in ranges)]
+
+
+# Whether a range holds update times between start (included) and end (excluded)
+def overlaps(watermarks, start, end):
+    return (
+        watermarks is not None
+        and pd.Timestamp(watermarks[0]) < end
+        and pd.Timestamp(watermarks[1]) >= start
+    )
+
+
+# Load the index of a dataset from a LocalSource or a DataLakeSource (see shared/reader.py), None when missing
+def load_watermark_index(source, datalake_directory_name, dataset_name):
+    data = source.read(get_watermark_index_path(datalake_directory_name, dataset_name))
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+# Record the ranges of files written to the partition of a day, as {file name: range}.
+# replace_day drops the other files of the day, e.g. the hourly files merged into its daily file.
+# The index is rewritten only if changed, and unchanged since read (ETag); it is read again when another writer won.
+def record_watermarks(file_system_client, datalake_directory_name, dataset_name, watermark_column, day, ranges,
+                      replace_day=False):
+    file_client = file_system_client.get_file_client(
+        get_watermark_index_path(datalake_directory_name, dataset_name))
+
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        try:
+            downloader = file_client.download_file()
+            index = json.loads(downloader.readall())
+            condition = {"etag": downloader.properties.etag, "match_condition": MatchConditions.IfNotModified}
+        except ResourceNotFoundError:
+            index = {"column": watermark_column, "since": day.isoformat(), "days": {}}
+            condition = {"match_condition": MatchConditions.IfMissing}
+        metrics.record("download", http_calls=1)
+
+        if index["column"] != watermark_column:
+            raise ValueError(f"{dataset_name} is indexed on {index['column']}, not {watermark_column}")
+
+        files = index["days"].get(day.isoformat(), {})
+        updated = dict(ranges) if replace_day else {**files, **ranges}
+        if updated == files and "etag" in condition:
+            return index
+        index["days"][day.isoformat()] = updated
+
+        data = json.dumps(index, sort_keys=True)
+        try:
+            file_client.upload_data(data, overwrite=True, **condition)
+            metrics.record("upload", http_calls=1, bytes_written=len(data))
+            return index
+        except (ResourceModifiedError, ResourceExistsError):
+            logging.info("watermark index of %s changed while updating it, attempt %s", dataset_name, attempt + 1)
+
+    raise RuntimeError(f"watermark index of {dataset_name} not updated after {MAX_UPDATE_ATTEMPTS} attempts")